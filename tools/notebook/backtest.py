@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+
+################################################################################
+
+# Backtest of buying after price drop. Trade is opened once per drop period
+# (see function common.drawdown) at close price of the first date when
+# price is at least 'depth' below previous maximum ('price-drop' column)
+# and drop lasts at least 'duration' days ('drop-period' column). Trade is
+# closed at close price of the first date 'holding' days after entry or, if
+# exit at previous maximum is enabled, at the first date when price reaches
+# previous maximum ('price-drop' is 1 again) whichever comes first. Trades which
+# are not closed before end of history are closed at the last date.
+#
+# Example:
+#   common.enrich(history, steps = ['price-ratio', 'price-drop', 'drop-period'])
+#   bt = backtest.Backtest(history)
+#   res = bt.run(depths = [0.1, 0.2, 0.3], durations = [30, 90, 180], holdings = [90, 365, None])
+#   backtest.cube(res, 'annual-return')
+#
+# All symbols are evaluated at once by array operations over concatenated
+# histories, grid cells of every depth can be evaluated by pool of processes.
+
+import numpy as np
+import pandas as pd
+import functools
+import instrument
+import moving
+import parallel
+import timerange
+
+################################################################################
+
+## Enrichment columns backtest is based on, see common.enrich
+COLUMNS = ['price-ratio', 'price-drop', 'drop-period']
+
+## Columns of DataFrame returned by Backtest.trades
+TRADE_COLUMNS = ['symbol', 'entry-date', 'exit-date', 'days', 'entry', 'exit', 'return', 'max-loss', 'closed']
+
+## Columns of DataFrame returned by Backtest.run:
+# - 'trades' is number of trades, 'open' is number of trades closed at end of history
+# - 'win-rate' is part of trades with return above 1.0
+# - 'mean-return' and 'median-return' are statistics of ratios of exit price to entry price
+# - 'annual-return' is compound return per year of holding: product of returns powered by 365/total days
+# - 'mean-days' is average holding period in days
+# - 'max-loss' is the largest drop of price below entry price during a trade, 0.25 means 25%
+METRICS = ['trades', 'open', 'win-rate', 'mean-return', 'median-return', 'annual-return', 'mean-days', 'max-loss']
+
+#===============================================================================
+
+## Backtest of buying after price drop over prices history of all symbols
+class Backtest:
+	index = None    # timerange.TimeRangeIndex of the history
+	symbols = None  # list of symbols
+	__arrays = None
+	__min_table = None
+
+	## Prepares backtest of enriched prices history. Prices history should
+	# not be changed while the backtest is used.
+	#
+	# @param[in] history -- dictionary Symbol -> Price History DataFrame with COLUMNS. See function common.enrich
+	def __init__(self, history):
+		missing = sorted(set(column for h in history.values() for column in COLUMNS if column not in h))
+		if missing:
+			raise ValueError('Prices history should be enriched with columns: %s' % ', '.join(missing))
+		self.index = timerange.TimeRangeIndex(history, windows = [])
+		self.symbols = self.index.symbols
+		frames = [history[symbol] for symbol in self.symbols]
+		self.__arrays = _arrays(self.index, dict((column, np.concatenate([h[column].values for h in frames]) if frames else np.zeros(0)) for column in COLUMNS))
+		self.__min_table = _min_table(self.__arrays['price-ratio'], self.__arrays['max_length'])
+
+	def __repr__(self):
+		return 'backtest.Backtest(%i symbols, %i rows)' % (len(self.symbols), len(self.index.date_ns))
+
+	#---------------------------------------------------------------------------
+
+	## Returns DataFrame of trades of one parameters set with TRADE_COLUMNS:
+	# 'entry' and 'exit' are price ratios at entry and exit dates, 'return' is
+	# their ratio, 'closed' is False for trades closed at end of history.
+	#
+	# @param[in] depth       -- minimal drop below previous maximum to buy at, for example 0.2 for 20%
+	# @param[in] duration    -- minimal number of days since previous maximum to buy at
+	# @param[in] holding     -- number of days to hold. None - until exit at previous maximum or end of history
+	# @param[in] exit_at_max -- sell when price reaches previous maximum. Default: True
+	def trades(self, depth, duration, holding, exit_at_max = True):
+		a = self.__arrays
+		entry = _entries(a, depth, duration)
+		(exit, closed) = _exits(a, entry, _holding_exits(a, entry, holding), exit_at_max)
+		res = _trade_values(a, self.__min_table, entry, exit)
+		return pd.DataFrame({'symbol': np.array(self.symbols, dtype=object)[a['symbol'][entry]]
+			, 'entry-date': a['date_ns'][entry].view('datetime64[ns]')
+			, 'exit-date': a['date_ns'][exit].view('datetime64[ns]')
+			, 'days': res['days']
+			, 'entry': a['price-ratio'][entry]
+			, 'exit': a['price-ratio'][exit]
+			, 'return': res['return']
+			, 'max-loss': res['max-loss']
+			, 'closed': closed}
+			, columns = TRADE_COLUMNS)
+
+	## Evaluates grid of parameters and returns DataFrame with METRICS columns
+	# indexed by all combinations of parameters (MultiIndex 'depth',
+	# 'duration', 'holding', 'exit-at-max'), see function trades. Use function
+	# cube to get metric as array depths x durations x holdings x exits.
+	#
+	# @param[in] depths      -- list of minimal drops below previous maximum, for example [0.1, 0.2, 0.3]
+	# @param[in] durations   -- list of minimal numbers of days since previous maximum
+	# @param[in] holdings    -- list of numbers of days to hold, None - no limit
+	# @param[in] exit_at_max -- list of exit at previous maximum flags. Default: [False, True]
+	# @param[in] workers     -- number of worker processes evaluating depths, None - number of CPUs. Default: 1
+	@instrument.stage()
+	def run(self, depths, durations, holdings, exit_at_max = [False, True], workers = 1):
+		(depths, durations, holdings, exit_at_max) = (list(depths), list(durations), list(holdings), list(exit_at_max))
+		rows = np.arange(len(self.index.date_ns))
+		holding_exits = [_holding_exits(self.__arrays, rows, holding) for holding in holdings]
+		# sparse table is larger than arrays, so worker processes build their own
+		table = self.__min_table if parallel.count(depths, workers) <= 1 else None
+		cells = parallel.map(functools.partial(_evaluate, self.__arrays, table, durations, holding_exits, exit_at_max), depths, workers)
+		values = np.array(cells).reshape(-1, len(METRICS)) if cells else np.zeros((0, len(METRICS)))
+		index = pd.MultiIndex.from_product([depths, durations, holdings, exit_at_max], names = ['depth', 'duration', 'holding', 'exit-at-max'])
+		res = pd.DataFrame(values, index = index, columns = METRICS)
+		for column in ['trades', 'open']:
+			res[column] = res[column].astype(np.int64)
+		return res
+
+#===============================================================================
+
+## Returns array of metric values depths x durations x holdings x exits for
+# results of function Backtest.run.
+#
+# @param[in] results -- DataFrame returned by function Backtest.run
+# @param[in] metric  -- metric name, see METRICS. Example: 'annual-return'
+def cube(results, metric):
+	shape = [len(pd.unique(results.index.get_level_values(level))) for level in range(results.index.nlevels)]
+	return results[metric].values.reshape(shape)
+
+#-------------------------------------------------------------------------------
+
+# Flat arrays of all symbols used by backtest functions. They are plain
+# arrays, so they are cheap to pass to worker processes. Sparse table of
+# range minimums is built separately, see function _min_table.
+def _arrays(index, columns):
+	lengths = np.diff(index.offsets)
+	symbol = np.repeat(np.arange(len(lengths)), lengths)
+	end = index.offsets[1:][symbol]
+	# drop periods are numbered, new one begins at every maximum and every symbol
+	is_peak = columns['price-drop'] == 1.
+	is_peak[index.offsets[:-1][lengths > 0]] = True
+	peaks = np.flatnonzero(is_peak)
+	next_peak = np.append(peaks, len(is_peak))[np.searchsorted(peaks, np.arange(len(is_peak)), side='right')]
+	res = dict(columns)
+	res.update({'date_ns': index.date_ns, 'keys': index.keys, 'calendar': index.calendar, 'symbol': symbol, 'end': end
+		, 'drop_n': np.cumsum(is_peak), 'next_peak': np.where(next_peak < end, next_peak, -1)
+		, 'max_length': int(lengths.max()) if len(lengths) else 0})
+	return res
+
+## Returns rows of trade entries: the first row of every drop period where
+# drop and its duration reach thresholds
+def _entries(a, depth, duration):
+	rows = np.flatnonzero((a['price-drop'] <= 1. - depth) & (a['drop-period'] >= duration))
+	if not len(rows):
+		return rows
+	first = np.ones(len(rows), dtype=bool)
+	first[1:] = a['drop_n'][rows[1:]] != a['drop_n'][rows[:-1]]
+	return rows[first]
+
+## Returns rows of the first dates 'holding' days after rows, -1 if there is no such date
+def _holding_exits(a, rows, holding):
+	if holding is None or not np.isfinite(holding):
+		return np.full(len(rows), -1, dtype=np.int64)
+	target = a['date_ns'][rows] + int(holding * moving.DAY_NS)
+	exit = np.searchsorted(a['keys'], a['symbol'][rows] * len(a['calendar']) + np.searchsorted(a['calendar'], target, side='left'))
+	return np.where(exit < a['end'][rows], exit, -1)
+
+## Returns pair (exit rows, closed flags) for entry rows and holding exits of them
+def _exits(a, entry, holding_exit, exit_at_max):
+	closed = holding_exit >= 0
+	exit = np.where(closed, holding_exit, a['end'][entry] - 1)
+	if exit_at_max:
+		peak = a['next_peak'][entry]
+		exit = np.where((peak >= 0) & (peak < exit), peak, exit)
+		closed |= peak >= 0
+	return (exit, closed)
+
+## Returns dictionary Column -> array with 'days', 'return' and 'max-loss' of trades
+def _trade_values(a, min_table, entry, exit):
+	price_ratio = a['price-ratio']
+	days = (a['date_ns'][exit] - a['date_ns'][entry]) // moving.DAY_NS
+	with np.errstate(divide = 'ignore', invalid = 'ignore'):
+		ret = price_ratio[exit] / price_ratio[entry]
+		loss = np.maximum(1. - _range_min(min_table, entry, exit) / price_ratio[entry], 0.)
+	return {'days': days, 'return': ret, 'max-loss': loss}
+
+## Returns sparse table of values: level k contains minimums of ranges of
+# 2**k values, NaN values are skipped. Trades never cross symbols, so levels
+# longer than the longest symbol history are not built.
+def _min_table(values, max_length):
+	table = [values]
+	while 2 ** len(table) <= min(len(values), max_length):
+		(prev, half) = (table[-1], 2 ** (len(table) - 1))
+		table.append(np.fmin(prev[:-half], prev[half:]))
+	return table
+
+## Returns minimums of ranges [begin, last] by sparse table, see function _min_table
+def _range_min(table, begin, last):
+	level = np.zeros(len(begin), dtype=np.int64)
+	length = last - begin + 1
+	while (length >= 2 ** (level + 1)).any():
+		level += length >= 2 ** (level + 1)
+	res = np.empty(len(begin))
+	for k in np.unique(level).tolist():
+		n = np.flatnonzero(level == k)
+		res[n] = np.fmin(table[k][begin[n]], table[k][last[n] - 2 ** k + 1])
+	return res
+
+## Evaluates all cells of one depth, returns array durations x holdings x exits x METRICS.
+# Holding exits are rows of the first dates 'holding' days after every row.
+# Sparse table is built from 'price-ratio' if it is None.
+def _evaluate(a, min_table, durations, holding_exits, exit_at_max, depth):
+	if min_table is None:
+		min_table = _min_table(a['price-ratio'], a['max_length'])
+	res = np.full((len(durations), len(holding_exits), len(exit_at_max), len(METRICS)), np.nan)
+	for (i, duration) in enumerate(durations):
+		entry = _entries(a, depth, duration)
+		for (j, holding_exit) in enumerate(holding_exits):
+			for (k, at_max) in enumerate(exit_at_max):
+				(exit, closed) = _exits(a, entry, holding_exit[entry], at_max)
+				res[i, j, k] = _metrics(_trade_values(a, min_table, entry, exit), closed)
+	return res
+
+def _metrics(trades, closed):
+	ret = trades['return']
+	valid = np.isfinite(ret)
+	(ret, days) = (ret[valid], trades['days'][valid])
+	if not len(ret):
+		return [len(closed), (~closed).sum(), np.nan, np.nan, np.nan, np.nan, np.nan, np.nan]
+	total_days = days.sum()
+	with np.errstate(divide = 'ignore', invalid = 'ignore'):
+		annual = np.exp(np.log(ret).sum() * 365. / total_days) if total_days > 0 else np.nan
+	return [len(closed), (~closed).sum(), (ret > 1.).mean(), ret.mean(), np.median(ret), annual, days.mean(), np.nanmax(trades['max-loss'][valid])]
+
+################################################################################
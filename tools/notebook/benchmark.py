@@ -0,0 +1,445 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+################################################################################
+
+import matplotlib
+matplotlib.use('Agg')
+
+import numpy as np
+import pandas as pd
+import argparse
+import contextlib
+import datetime
+import io
+import itertools
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+import backtest
+import common
+import correlation
+import fetch
+import moving
+import panel
+import reference
+import render
+import screener
+import sectors
+import stock
+
+################################################################################
+
+## Benchmarks run by default, see --suites option
+SUITES = ['stages', 'equivalence', 'parse', 'fetch', 'sync']
+
+## Maximal number of symbols of correlation stage, symbols of larger universes
+# are subsampled since pair statistics are matrices symbols x symbols
+PAIR_SYMBOLS = 1000
+
+## Number of rolling windows of correlation stage
+PAIR_WINDOWS = 3
+
+## Returns best time in seconds of several runs of target function
+#
+# @param[in] f      -- function without arguments
+# @param[in] repeat -- number of runs. Default: 5
+def timeit(f, repeat = 5):
+	best = None
+	for _ in range(repeat):
+		begin = time.perf_counter()
+		f()
+		elapsed = time.perf_counter() - begin
+		best = elapsed if best is None else min(best, elapsed)
+	return best
+
+## Returns dictionary with best 'time' in seconds of several runs of target
+# function and 'peak memory' in bytes allocated during one more run traced
+# by tracemalloc. Output of the function is suppressed.
+#
+# @param[in] f      -- function without arguments
+# @param[in] repeat -- number of timed runs. Default: 5
+def profile(f, repeat = 5):
+	with contextlib.redirect_stdout(io.StringIO()):
+		best = timeit(f, repeat)
+		tracemalloc.start()
+		try:
+			f()
+			(_, peak) = tracemalloc.get_traced_memory()
+		finally:
+			tracemalloc.stop()
+	return {'time': best, 'peak memory': peak}
+
+#-------------------------------------------------------------------------------
+
+## Loads recorded AlphaVantage JSON responses from directory.
+# Returns dictionary File name -> response.
+#
+# @param[in] fixtures_dir -- directory with *.json files
+def load_fixtures(fixtures_dir):
+	fixtures = {}
+	for f in sorted(os.listdir(fixtures_dir)):
+		if f.lower().endswith('.json'):
+			with open(os.path.join(fixtures_dir, f)) as fixture:
+				fixtures[f] = json.load(fixture)
+	return fixtures
+
+## Returns TIME_SERIES_DAILY_ADJUSTED response with random prices. It is used
+# when no recorded responses are available.
+#
+# @param[in] symbol -- symbol name. Default: 'TEST'
+# @param[in] bars   -- number of bars. Default: 5000 - about "full" output size
+# @param[in] seed   -- random seed. Default: 0
+def synthetic_response(symbol = 'TEST', bars = 5000, seed = 0):
+	random = np.random.RandomState(seed)
+	(open_price, close, volume, high, low) = __random_prices(random, bars)
+	k = np.where(np.arange(bars) < bars // 2, 0.5, 1.)
+	end = datetime.date(2018, 7, 20)
+	dates = pd.bdate_range(end = end, periods = bars)[::-1]
+	series = {}
+	for (i, date) in enumerate(dates):
+		series[date.strftime('%Y-%m-%d')] = {'1. open': '%.4f' % open_price[i]
+			, '2. high': '%.4f' % high[i]
+			, '3. low': '%.4f' % low[i]
+			, '4. close': '%.4f' % close[i]
+			, '5. adjusted close': '%.4f' % (close[i] * k[i])
+			, '6. volume': '%i' % volume[i]
+			, '7. dividend amount': '0.0000'
+			, '8. split coefficient': '1.0000'}
+	return {'Meta Data': {'2. Symbol': symbol}, 'Time Series (Daily)': series}
+
+## Returns synthetic prices history with random prices: dictionary Symbol ->
+# Price History DataFrame as function common.load_history returns (without
+# 'datenum' column). Every synthetic symbol takes dates of random symbol of
+# base history, so the synthetic universe has 'scale' times more symbols and
+# rows with the same calendar and distribution of history lengths. If
+# 'row_scale' is above 1, dates of base symbol are replaced by business days
+# calendar with 'row_scale' times more dates ending at the same date, so
+# every symbol history is that many times longer and denser.
+#
+# @param[in] base      -- dictionary Symbol -> Price History DataFrame
+# @param[in] scale     -- ratio of numbers of symbols of synthetic and base history. Example: 10
+# @param[in] seed      -- random seed. Default: 0
+# @param[in] row_scale -- ratio of numbers of rows of synthetic and base symbol history. Default: 1
+def synthetic_history(base, scale, seed = 0, row_scale = 1):
+	random = np.random.RandomState(seed)
+	indexes = [h.index for h in base.values() if len(h)]
+	calendars = {}
+	history = {}
+	for n in range(int(len(indexes) * scale)):
+		i = random.randint(len(indexes))
+		if row_scale != 1 and i not in calendars:
+			calendars[i] = __scaled_calendar(indexes[i], row_scale)
+		index = calendars[i] if row_scale != 1 else indexes[i]
+		(open_price, close, volume, high, low) = __random_prices(random, len(index))
+		history['SYN%i' % n] = pd.DataFrame({'open': open_price, 'close': close, 'volume': volume, 'high': high, 'low': low}, index = index)
+	return history
+
+# Business days calendar with row_scale times more dates than index ending at
+# the last date of index. Step in business days is the median step of index
+# divided by row_scale, at least one business day.
+def __scaled_calendar(index, row_scale):
+	days = np.median(np.diff(index.values).astype('timedelta64[D]').astype(np.int64)) if len(index) > 1 else 1.
+	step = max(int(round(days * 5. / 7. / row_scale)), 1)
+	offsets = -step * np.arange(int(round(len(index) * row_scale)))[::-1]
+	dates = np.busday_offset(index[-1].to_datetime64().astype('datetime64[D]'), offsets, roll = 'backward')
+	return pd.DatetimeIndex(dates.astype('datetime64[ns]'), name = index.name)
+
+def __random_prices(random, bars):
+	close = 50. * np.exp(np.cumsum(random.normal(0., 0.02, bars)))
+	open_price = close * np.exp(random.normal(0., 0.01, bars))
+	high = np.maximum(open_price, close) * (1. + random.uniform(0., 0.02, bars))
+	low = np.minimum(open_price, close) * (1. - random.uniform(0., 0.02, bars))
+	volume = random.randint(1000, 10000000, bars)
+	return (open_price, close, volume, high, low)
+
+#-------------------------------------------------------------------------------
+
+## Benchmarks stock.parse_time_series_entries against stock.parse_time_series_columns
+# and checks that both produce the same values. Returns dictionary with timings.
+#
+# @param[in] responses -- dictionary Name -> AlphaVantage JSON response
+# @param[in] repeat    -- number of runs. Default: 5
+def bench_parse(responses, repeat = 5):
+	series = [__time_series(response) for response in responses.values()]
+	bars = sum(len(s) for s in series)
+	for s in series:
+		__check_parse(s)
+	reference = timeit(lambda: [stock.parse_time_series_entries(s) for s in series], repeat)
+	columnar = timeit(lambda: [stock.parse_time_series_columns(s) for s in series], repeat)
+	return {'responses': len(series)
+		, 'bars': bars
+		, 'parse_time_series_entries': reference
+		, 'parse_time_series_columns': columnar
+		, 'speedup': reference / columnar}
+
+def __time_series(response):
+	return next(value for (key, value) in response.items() if 'Time Series' in key)
+
+def __check_parse(time_series):
+	entries = stock.parse_time_series_entries(time_series)
+	columns = stock.parse_time_series_columns(time_series)
+	for (i, (date, entry)) in enumerate(entries.items()):
+		assert columns['date'][i].astype(datetime.date) == date
+		for name in ['open', 'high', 'low', 'close', 'volume']:
+			assert columns[name][i] == getattr(entry, name), (date, name)
+
+#-------------------------------------------------------------------------------
+
+## Benchmarks function fetch.fetch against local fixture server for several
+# numbers of concurrent requests. Returns dictionary with symbols per second
+# for every number of workers.
+#
+# @param[in] responses -- dictionary Symbol -> AlphaVantage JSON response
+# @param[in] workers   -- list of numbers of concurrent requests. Default: [1, 4, 8]
+# @param[in] latency   -- simulated network latency of every response in seconds. Default: 0.05
+def bench_fetch(responses, workers = [1, 4, 8], latency = 0.05):
+	results = {'symbols': len(responses), 'latency': latency}
+	with fetch.FixtureServer(responses, latency) as server:
+		for n in workers:
+			with tempfile.TemporaryDirectory() as history_dir:
+				begin = time.perf_counter()
+				statuses = fetch.fetch(list(responses), history_dir = history_dir, workers = n, requests_per_minute = None, url = server.url)
+				elapsed = time.perf_counter() - begin
+			assert all(s == 'OK' for s in statuses.values()), statuses
+			results['symbols/s (%i workers)' % n] = len(responses) / elapsed
+	return results
+
+## Benchmarks function fetch.sync against full download by function fetch.fetch
+# when local history misses only the newest bars. Returns dictionary with
+# timings and numbers of downloaded bytes.
+#
+# @param[in] responses -- dictionary Symbol -> AlphaVantage daily JSON response
+# @param[in] missing   -- number of newest bars missing in local history. Default: 5
+# @param[in] latency   -- simulated network latency of every response in seconds. Default: 0.05
+def bench_sync(responses, missing = 5, latency = 0.05):
+	results = {'symbols': len(responses), 'missing bars': missing}
+	with tempfile.TemporaryDirectory() as history_dir:
+		for (symbol, response) in responses.items():
+			columns = stock.parse_time_series_columns(__time_series(response))
+			order = np.argsort(columns['date'])[:-missing]
+			fetch.save_history(history_dir, symbol, dict((name, values[order]) for (name, values) in columns.items()))
+		today = max(max(__time_series(r)) for r in responses.values())[:10]
+		with fetch.FixtureServer(responses, latency) as server:
+			begin = time.perf_counter()
+			fetch.fetch(list(responses), requests_per_minute = None, url = server.url)
+			results['full'] = time.perf_counter() - begin
+			results['full bytes'] = server.bytes
+			server.bytes = 0
+			begin = time.perf_counter()
+			synced = fetch.sync(list(responses), history_dir, today = datetime.datetime.strptime(today, '%Y-%m-%d').date(), requests_per_minute = None, url = server.url)
+			results['sync'] = time.perf_counter() - begin
+			results['sync bytes'] = server.bytes
+	assert all(r == ('compact', missing) for r in synced.values()), synced
+	results['speedup'] = results['full'] / results['sync']
+	return results
+
+#-------------------------------------------------------------------------------
+
+## Profiles loading of history directory from CSV files and from compiled
+# store (see module store). Returns pair (history, results), where results is
+# dictionary Stage -> profile (see function profile).
+#
+# @param[in] history_dir -- path to directory with CSV files. Example: "history"
+# @param[in] repeat      -- number of runs. Default: 5
+def bench_load(history_dir, repeat = 5):
+	results = {'load csv': profile(lambda: common.load_history(history_dir, use_store = False), repeat)}
+	with contextlib.redirect_stdout(io.StringIO()):
+		common.load_history(history_dir)
+	results['load store'] = profile(lambda: common.load_history(history_dir), repeat)
+	with contextlib.redirect_stdout(io.StringIO()):
+		history = common.load_history(history_dir)
+	return (history, results)
+
+## Profiles hot paths of modules common, moving, panel, stock and render on
+# prices history. Returns dictionary Stage -> profile (see function profile)
+# plus numbers of 'symbols' and 'rows'. History is enriched by all
+# enrichment steps (see function common.enrich). Correlation stage profiles
+# at most PAIR_SYMBOLS symbols, its 'symbols' is the number of profiled ones.
+#
+# @param[in,out] history    -- dictionary Symbol -> Price History DataFrame. See function common.load_history(history_dir)
+# @param[in] repeat         -- number of runs. Default: 5
+# @param[in] render_symbols -- number of the longest symbols histories to render. Default: 3
+def bench_stages(history, repeat = 5, render_symbols = 3):
+	frames = [h for h in history.values() if len(h)]
+	window_sizes = [365 * years for years in range(1, 6)]
+	results = {'symbols': len(history), 'rows': int(sum(len(h) for h in frames))}
+	results['enrich'] = profile(lambda: common.enrich(history, workers = 1), repeat)
+	results['drawdown'] = profile(lambda: [common.values__drawdown(h) for h in frames], repeat)
+	results['moving windows'] = profile(lambda: [moving.moving_batch(h, window_sizes, moving.METRICS) for h in frames], repeat)
+	results['periods'] = profile(lambda: common.all_periods(history), repeat)
+	results['panel'] = profile(lambda: panel.Panel(history, ['close']), repeat)
+	if os.path.isfile('data/stocks.tcs'):
+		stocks = sectors.load_stocks('data/stocks.tcs')
+		results['sectors'] = profile(lambda: __sector_statistics(panel.Panel(history, ['close', 'drop-period']), stocks), repeat)
+	pair_symbols = list(history)[::max(int(np.ceil(len(history) / PAIR_SYMBOLS)), 1)]
+	pair_history = dict((symbol, history[symbol]) for symbol in pair_symbols)
+	results['correlation'] = dict(profile(lambda: __pair_statistics(panel.Panel(pair_history, ['close', 'drop-period'])), repeat), symbols = len(pair_symbols))
+	series = [__time_series_of(h) for h in frames]
+	results['period_delta'] = profile(lambda: [__outcome(stock.year_delta, s) for s in series], repeat)
+	results['years_are_positive'] = profile(lambda: [stock.years_are_positive(s) for s in series], repeat)
+	results['screener'] = profile(lambda: screener.Screener(history).screen(), repeat)
+	results['backtest'] = profile(lambda: backtest.Backtest(history).run([0.1, 0.2, 0.3, 0.4], [0, 30, 90, 180], [30, 90, 365, None]), repeat)
+	symbols = sorted(history, key = lambda symbol: -len(history[symbol]))[:render_symbols]
+	with tempfile.TemporaryDirectory() as output_dir:
+		results['render'] = profile(lambda: render.draw_columns(history, symbols, {}, output_dir, add = ['periods']), repeat)
+	return results
+
+def __sector_statistics(prices, stocks):
+	for column in sectors.GROUP_COLUMNS:
+		grouping = sectors.Grouping(prices, stocks, column)
+		grouping.aggregate('drop-period', 'median')
+		grouping.index(weighted = True)
+
+def __pair_statistics(prices):
+	pairs = correlation.Correlation(prices)
+	for kind in correlation.KINDS:
+		pairs.matrix(kind)
+		for _ in itertools.islice(pairs.rolling(kind, window_days = 365, step_days = 30), PAIR_WINDOWS):
+			pass
+
+## Checks that optimized functions return the same values as reference
+# implementations (see module reference) for every symbol. Returns dictionary
+# Check -> list of symbols with different values.
+#
+# @param[in] history -- dictionary Symbol -> Price History DataFrame enriched by function common.enrich
+# @param[in] windows -- list windows sizes in years of 'price-growth' columns. Default: [1,2,3,4,5]
+def check_equivalence(history, windows = range(1, 6)):
+	checks = {'max-prev': reference.values__max_prev
+		, 'drop-period': reference.values__price_drop_period
+		, 'drop-min': reference.values__drop_min}
+	for years in windows:
+		checks['price-growth-%iy' % years] = lambda h, window_size = int(365 * years): reference.values__price_growth_ratio(h, window_size)
+	mismatches = dict((check, []) for check in list(checks) + ['periods', 'period_delta', 'years_are_positive', 'screener'])
+	# exact dates a year before as stock.years_are_positive matches
+	year_fails = screener.Screener(history).metrics(tolerance_days = 0)['year-fails']
+	for (symbol, h) in history.items():
+		if not len(h):
+			continue
+		for (column, f) in checks.items():
+			if not __equal(h[column].values, np.array(f(h), dtype=np.float64)):
+				mismatches[column].append(symbol)
+		try:
+			pd.testing.assert_frame_equal(common.periods(h), reference.periods(h), check_dtype = False)
+		except AssertionError:
+			mismatches['periods'].append(symbol)
+		# float prices as parsed by stock.parse_time_series, so zero open price raises ZeroDivisionError
+		entries = dict((date, stock.TSEntry({'open': float(o), 'high': float(hi), 'low': float(lo), 'close': float(c), 'volume': float(v)}))
+			for (date, o, hi, lo, c, v) in zip(h.index.date, h['open'].values, h['high'].values, h['low'].values, h['close'].values, h['volume'].values))
+		series = __time_series_of(h)
+		if __outcome(stock.year_delta, series) != __outcome(reference.period_delta, entries, datetime.timedelta(365)):
+			mismatches['period_delta'].append(symbol)
+		if stock.years_are_positive(series) != reference.years_are_positive(entries):
+			mismatches['years_are_positive'].append(symbol)
+		if (stock.years_are_positive(series) is True) != (year_fails[symbol] == 0):
+			mismatches['screener'].append(symbol)
+	return mismatches
+
+def __equal(values, reference_values):
+	return values.shape == reference_values.shape and np.allclose(values, reference_values, rtol = 1e-12, atol = 0., equal_nan = True)
+
+# Returns result of f or type of ZeroDivisionError it raises
+def __outcome(f, *args):
+	try:
+		return f(*args)
+	except ZeroDivisionError:
+		return ZeroDivisionError
+
+def __time_series_of(h):
+	return stock.TimeSeries({'date': h.index.values.astype('datetime64[D]')
+		, 'open': h['open'].values
+		, 'high': h['high'].values
+		, 'low': h['low'].values
+		, 'close': h['close'].values
+		, 'volume': h['volume'].values})
+
+#-------------------------------------------------------------------------------
+
+## Compares results with baseline results of the same benchmarks. Returns list
+# of regressions: triplets (path, baseline value, current value) for stage
+# times and peak memory which grew more than by tolerance. Values missing in
+# either results are ignored.
+#
+# @param[in] results   -- results of benchmarks, dictionary
+# @param[in] baseline  -- baseline results, for example loaded from JSON file saved with --output option
+# @param[in] tolerance -- allowed relative growth. Default: 0.25
+# @param[in] min_time  -- times shorter than this in seconds are too noisy and ignored. Default: 0.01
+def compare(results, baseline, tolerance = 0.25, min_time = 0.01):
+	regressions = []
+	for (key, value) in results.items():
+		if key not in baseline:
+			continue
+		if isinstance(value, dict) and isinstance(baseline[key], dict):
+			regressions += [('%s/%s' % (key, path), old, new) for (path, old, new) in compare(value, baseline[key], tolerance, min_time)]
+		elif key in ['time', 'peak memory'] and value > baseline[key] * (1. + tolerance):
+			if key != 'time' or max(value, baseline[key]) >= min_time:
+				regressions.append((key, baseline[key], value))
+	return regressions
+
+#===============================================================================
+
+def main():
+	parser = argparse.ArgumentParser(description = 'Benchmarks of notebook tools')
+	parser.add_argument('--fixtures', help = 'directory with recorded AlphaVantage JSON responses. Default: synthetic response')
+	parser.add_argument('--repeat', type = int, default = 5, help = 'number of runs. Default: 5')
+	parser.add_argument('--output', help = 'JSON file to save results to')
+	parser.add_argument('--fetch-symbols', type = int, default = 32, help = 'number of synthetic symbols to fetch if no fixtures specified. Default: 32')
+	parser.add_argument('--latency', type = float, default = 0.05, help = 'simulated latency of fixture server in seconds. Default: 0.05')
+	parser.add_argument('--suites', nargs = '*', choices = SUITES, default = SUITES, help = 'benchmarks to run. Default: all')
+	parser.add_argument('--history', nargs = '*', default = ['history', 'history_daily'], help = 'history directories to profile. Default: history history_daily')
+	parser.add_argument('--scales', nargs = '*', type = float, default = [10], help = 'scales of symbols of synthetic universes built from the first history directory, for example 10 100. Default: 10')
+	parser.add_argument('--row-scales', nargs = '*', type = float, default = [10], help = 'scales of rows of every symbol of synthetic universes with symbols of the first history directory, for example 10 100. Default: 10')
+	parser.add_argument('--render-symbols', type = int, default = 3, help = 'number of symbols to render. Default: 3')
+	parser.add_argument('--baseline', help = 'JSON file with baseline results to flag regressions against')
+	parser.add_argument('--tolerance', type = float, default = 0.25, help = 'allowed relative growth of time and memory against baseline. Default: 0.25')
+	args = parser.parse_args()
+	results = {}
+	failed = False
+	if 'stages' in args.suites or 'equivalence' in args.suites:
+		for (n, history_dir) in enumerate(args.history):
+			(history, load_results) = bench_load(history_dir, args.repeat)
+			if 'stages' in args.suites:
+				results[history_dir] = dict(load_results, **bench_stages(history, args.repeat, args.render_symbols))
+			else:
+				common.enrich(history, workers = 1)
+			if 'equivalence' in args.suites:
+				mismatches = dict((check, symbols) for (check, symbols) in check_equivalence(history).items() if symbols)
+				results.setdefault('equivalence', {})[history_dir] = mismatches or 'OK'
+				failed |= bool(mismatches)
+			if n == 0 and 'stages' in args.suites:
+				for scale in args.scales:
+					results['synthetic %gx' % scale] = bench_stages(synthetic_history(history, scale), args.repeat, args.render_symbols)
+				for row_scale in args.row_scales:
+					results['synthetic %gx rows' % row_scale] = bench_stages(synthetic_history(history, 1, row_scale = row_scale), args.repeat, args.render_symbols)
+	responses = load_fixtures(args.fixtures) if args.fixtures else {'synthetic': synthetic_response()}
+	if 'parse' in args.suites:
+		results['parse'] = bench_parse(responses, args.repeat)
+	if args.fixtures:
+		symbol_responses = fetch.fixture_responses(responses)
+	else:
+		symbol_responses = dict(('TEST%i' % i, synthetic_response('TEST%i' % i, 1000, i)) for i in range(args.fetch_symbols))
+	if 'fetch' in args.suites:
+		results['fetch'] = bench_fetch(symbol_responses, latency = args.latency)
+	if 'sync' in args.suites:
+		results['sync'] = bench_sync(symbol_responses, latency = args.latency)
+	print(json.dumps(results, indent = 2))
+	if args.output:
+		with open(args.output, 'w') as f:
+			json.dump(results, f, indent = 2)
+	if args.baseline:
+		with open(args.baseline) as f:
+			regressions = compare(results, json.load(f), args.tolerance)
+		for (path, old, new) in regressions:
+			print('Regression %s: %.4g -> %.4g (%+.0f%%)' % (path, old, new, 100. * (new / old - 1.)))
+		print('%i regressions against baseline "%s"' % (len(regressions), args.baseline))
+		failed |= bool(regressions)
+	if failed:
+		sys.exit(1)
+
+#===============================================================================
+
+if __name__ == "__main__":
+	main()
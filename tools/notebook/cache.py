@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+################################################################################
+
+import numpy as np
+import pandas as pd
+import argparse
+import hashlib
+import json
+import os
+import pickle
+
+################################################################################
+
+## Default cache directory
+CACHE_DIR = '.cache'
+
+## Default cache size limit in bytes
+MAX_SIZE = 512 * 1024 * 1024
+
+__EXTENSION = '.pkl'
+
+################################################################################
+
+## Returns cache key - hex digest of specified parts. Parts can be numpy
+# arrays, pandas objects or any JSON serializable values (step names,
+# window sizes, etc.)
+#
+# @param[in] parts -- values the cached result depends on
+def key(*parts):
+	digest = hashlib.sha1()
+	for part in parts:
+		if isinstance(part, (pd.DataFrame, pd.Series)):
+			digest.update(pd.util.hash_pandas_object(part).values.tobytes())
+		elif isinstance(part, np.ndarray):
+			digest.update(str(part.dtype).encode())
+			digest.update(np.ascontiguousarray(part).tobytes())
+		else:
+			digest.update(json.dumps(part, sort_keys=True, default=str).encode())
+		digest.update(b'|')
+	return digest.hexdigest()
+
+
+## Returns dictionary Name -> array stored for specified key or None.
+# Entry is marked as recently used.
+#
+# @param[in] key       -- cache key. See function key
+# @param[in] cache_dir -- cache directory. Default: CACHE_DIR
+def get(key, cache_dir = CACHE_DIR):
+	path = __path(key, cache_dir)
+	if not os.path.isfile(path):
+		return None
+	try:
+		with open(path, 'rb') as f:
+			values = pickle.load(f)
+		os.utime(path)
+		return values
+	except Exception as exc:
+		print('Failed to read cache entry "%s": %r' % (path, exc))
+		return None
+
+
+## Stores dictionary Name -> array for specified key. Least recently used
+# entries are evicted if cache size exceeds the limit.
+#
+# @param[in] key       -- cache key. See function key
+# @param[in] values    -- dictionary Name -> array
+# @param[in] cache_dir -- cache directory. Default: CACHE_DIR
+# @param[in] max_size  -- cache size limit in bytes, None - do not evict entries. Default: MAX_SIZE
+def put(key, values, cache_dir = CACHE_DIR, max_size = MAX_SIZE):
+	os.makedirs(cache_dir, exist_ok=True)
+	path = __path(key, cache_dir)
+	with open(path + '.tmp', 'wb') as f:
+		pickle.dump(values, f, protocol = pickle.HIGHEST_PROTOCOL)
+	os.replace(path + '.tmp', path)
+	if max_size is not None:
+		evict(cache_dir, max_size)
+
+
+## Removes least recently used entries until cache size fits the limit.
+# Returns number of removed entries.
+#
+# @param[in] cache_dir -- cache directory. Default: CACHE_DIR
+# @param[in] max_size  -- cache size limit in bytes. Default: MAX_SIZE
+def evict(cache_dir = CACHE_DIR, max_size = MAX_SIZE):
+	entries = sorted(__entries(cache_dir), key = lambda e: e[1])
+	size = sum(e[2] for e in entries)
+	removed = 0
+	for (path, mtime, entry_size) in entries:
+		if size <= max_size:
+			break
+		os.remove(path)
+		size -= entry_size
+		removed += 1
+	return removed
+
+
+## Removes all cache entries. Returns number of removed entries.
+#
+# @param[in] cache_dir -- cache directory. Default: CACHE_DIR
+def clear(cache_dir = CACHE_DIR):
+	entries = __entries(cache_dir)
+	for (path, mtime, size) in entries:
+		os.remove(path)
+	return len(entries)
+
+
+## Returns pair (number of entries, total size in bytes)
+#
+# @param[in] cache_dir -- cache directory. Default: CACHE_DIR
+def info(cache_dir = CACHE_DIR):
+	entries = __entries(cache_dir)
+	return (len(entries), sum(e[2] for e in entries))
+
+
+def __path(key, cache_dir):
+	return os.path.join(cache_dir, key + __EXTENSION)
+
+def __entries(cache_dir):
+	if not os.path.isdir(cache_dir):
+		return []
+	entries = []
+	for f in os.listdir(cache_dir):
+		if f.endswith(__EXTENSION):
+			st = os.stat(os.path.join(cache_dir, f))
+			entries.append((os.path.join(cache_dir, f), st.st_mtime_ns, st.st_size))
+	return entries
+
+#===============================================================================
+
+def main():
+	parser = argparse.ArgumentParser(description = 'Derived metrics cache')
+	parser.add_argument('command', choices = ['info', 'clear', 'evict'])
+	parser.add_argument('--dir', default = CACHE_DIR, help = 'cache directory. Default: %s' % CACHE_DIR)
+	parser.add_argument('--max-size', type = int, default = MAX_SIZE, help = 'cache size limit in bytes for "evict". Default: %i' % MAX_SIZE)
+	args = parser.parse_args()
+	if args.command == 'info':
+		(entries, size) = info(args.dir)
+		print('%i entries, %.1f MB' % (entries, size / 1024. / 1024.))
+	elif args.command == 'clear':
+		print('%i entries removed' % clear(args.dir))
+	else:
+		print('%i entries removed' % evict(args.dir, args.max_size))
+
+#===============================================================================
+
+if __name__ == "__main__":
+	main()
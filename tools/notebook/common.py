@@ -3,27 +3,44 @@
 ################################################################################
 
 import pandas as pd
+import numpy as np
 import os
+import multiprocessing
+import shutil
+import tempfile
 import matplotlib.dates as dates
 import datetime
+import functools
+import re
 import moving
+import cache
+import store
+import parallel
+import instrument
 
 ################################################################################
 
 
-## Load stock prices history from CSV file to DataFame
+## Load stock prices history from CSV file to DataFame. Row numbers column
+# of the file is not loaded, 'symbol' column is categorical.
 #
 # @param[in] file_path  -- path to CSV file. Example: "/history/ADBE.csv"
-def load_history_dataframe(file_path):
+# @param[in] dtype      -- dtype of price columns ('open', 'close', 'high', 'low'), for example np.float32.
+#                          Default: None - float64
+# @param[in] datenum    -- append 'datenum' column, otherwise use function datenum(h). Default: True
+@instrument.stage()
+def load_history_dataframe(file_path, dtype = None, datenum = True):
 	try:
 		fname = os.path.basename(file_path)
 		if not fname.lower().endswith('.csv'):
 			print('Invalid file extension "%s", ".csv" expected' % file_path)
 			return pd.DataFrame()
-		df = pd.read_csv(file_path, index_col=0)
+		column_types = dict([('symbol', 'category')] + [(column, dtype) for column in PRICE_COLUMNS if dtype is not None])
+		df = pd.read_csv(file_path, usecols=HISTORY_FILE_COLUMNS, dtype=column_types)
 		df.index = pd.to_datetime(df['date'])
 		del df['date']
-		df['datenum'] = dates.date2num(df.index)
+		if datenum:
+			df['datenum'] = dates.date2num(df.index)
 		return df.sort_index()
 	except Exception as exc:
 		print('Failed to load file "%s": %r' % (file_path, exc))
@@ -31,12 +48,30 @@ def load_history_dataframe(file_path):
 
 
 ## Load stock prices history from all CSV files in target directory to DataFrames
+# By default prices are loaded from compiled store (see module store), which is
+# built once from CSV files and rebuilt only for changed files.
 #
-# @param[in] file_path  -- path to CSV file. Example: "/history"
-def load_history(history_dir):
+# @param[in] history_dir -- path to directory with CSV files. Example: "/history"
+# @param[in] use_store   -- load prices from compiled store. Default: True
+# @param[in] workers     -- number of processes parsing CSV files, None - number of CPUs. Default: 1
+# @param[in] dtype       -- dtype of price columns ('open', 'close', 'high', 'low'), for example np.float32.
+#                           Default: None - float64
+# @param[in] datenum     -- keep 'datenum' column, otherwise use function datenum(h). Default: True
+@instrument.stage()
+def load_history(history_dir, use_store = True, workers = 1, dtype = None, datenum = True):
+	if use_store:
+		try:
+			history = store.load(history_dir, load_history_dataframe, workers)
+			if dtype is not None or not datenum:
+				history = dict((symbol, __lean_frame(h, dtype, datenum)) for (symbol, h) in history.items())
+			print('%i symbols loaded from compiled store, %.1f MB' % (len(history), memory_usage(history) / 1024. / 1024.))
+			return history
+		except Exception as exc:
+			print('Failed to load compiled store for "%s": %r' % (history_dir, exc))
+
 	history_files = sorted([os.path.join(history_dir, f) for f in os.listdir(history_dir) if os.path.isfile(os.path.join(history_dir, f)) and f.lower().endswith('.csv')])
 	print('%i files with prices hoistory found' % len(history_files))
-	histories = [*filter(lambda h : len(h), [load_history_dataframe(path) for path in history_files])]
+	histories = [*filter(lambda h : len(h), parallel.map(functools.partial(load_history_dataframe, dtype=dtype, datenum=datenum), history_files, workers))]
 	print('%i files with prices hoistory loaded' % len(history_files))
 	print('%i items totaly since %s to %s' % (sum([len(h) for h in histories]), min([h.index.min() for h in histories]), max([h.index.max() for h in histories])))
 	history = []
@@ -46,7 +81,46 @@ def load_history(history_dir):
 		history.append((symbol, h))
 	
 	# history = pd.concat(histories)
-	return dict(history)
+	history = dict(history)
+	print('%.1f MB of prices history loaded' % (memory_usage(history) / 1024. / 1024.))
+	return history
+
+## Price columns of prices history
+PRICE_COLUMNS = ['open', 'close', 'high', 'low']
+
+## Returns 'datenum' values (see matplotlib.dates.date2num) of prices history.
+# They are computed from the index if history has no 'datenum' column.
+#
+# @param[in] h -- prices history DataFrame. See function load_history_dataframe(file_path)
+def datenum(h):
+	return h['datenum'].values if 'datenum' in h else dates.date2num(h.index)
+
+## Returns number of bytes of arrays referenced by prices history DataFrames
+# including their indexes. Arrays shared by several DataFrames (see function
+# history_view) are counted once, memory-mapped store is counted entirely.
+#
+# @param[in] history -- dictionary Symbol -> Price History DataFrame. See function load_history(history_dir)
+def memory_usage(history):
+	seen = set()
+	size = 0
+	for h in history.values():
+		for values in [h.index.values] + [h[column].values for column in h.columns]:
+			if not isinstance(values, np.ndarray):
+				size += values.nbytes
+				continue
+			while isinstance(values.base, np.ndarray):
+				values = values.base
+			if id(values) not in seen:
+				seen.add(id(values))
+				size += values.nbytes
+	return size
+
+# Copies columns of store DataFrame, so it does not keep entire store values
+# matrix mapped, converts prices to dtype and drops 'datenum' if not needed.
+def __lean_frame(h, dtype, datenum):
+	columns = [column for column in h.columns if datenum or column != 'datenum']
+	return pd.DataFrame(dict((column, np.array(h[column].values, dtype=dtype if column in PRICE_COLUMNS else None)) for column in columns)
+		, index = h.index, columns = columns, copy = False)
 
 
 #-------------------------------------------------------------------------------
@@ -76,6 +150,7 @@ def older_than(history, date = datetime.datetime(2016,1,1)):
 # first open price in symbol history.
 #
 # @param[in] h -- prices history DataFrame. See function load_history_dataframe(file_path)
+@instrument.stage()
 def values__price_ratio(h):
 	return h['close'] / h['open'].iloc[0]
 
@@ -83,6 +158,7 @@ def values__price_ratio(h):
 # See function values__price_ratio.
 #
 # @param[in,out] history -- dictionary Symbol -> Price History DataFrame. See function load_history(history_dir)
+@instrument.stage()
 def append_price_ratio_column(history):
     for (symbol, h) in history.items():
         h['price-ratio'] = values__price_ratio(h)
@@ -93,19 +169,15 @@ def append_price_ratio_column(history):
 # begin of symbol history to current date inclusivle.
 #
 # @param[in] h -- prices history DataFrame. See function load_history_dataframe(file_path)
+@instrument.stage()
 def values__max_prev(h):
-	mp = []
-	for price_ration in h['price-ratio']:
-		if mp:
-			mp.append(max(price_ration, mp[-1]))
-		else:
-			mp.append(price_ration)
-	return mp
+	return __max_prev(h['price-ratio'].values)
 
 ## Append 'max-prev' column to all symbols history. 
 # See function values__max_prev.
 #
 # @param[in,out] history -- dictionary Symbol -> Price History DataFrame. See function load_history(history_dir)
+@instrument.stage()
 def append_max_prev_column(history):
     for (symbol, h) in history.items():
         h['max-prev'] = values__max_prev(h)
@@ -116,6 +188,7 @@ def append_max_prev_column(history):
 # last price maximum. If price grow then price drop is 1.
 #
 # @param[in] h -- prices history DataFrame. See function load_history_dataframe(file_path)
+@instrument.stage()
 def values__price_drop(h):
 	return h['price-ratio'] / h['max-prev']
 
@@ -123,6 +196,7 @@ def values__price_drop(h):
 # See function values__price_drop.
 #
 # @param[in,out] history -- dictionary Symbol -> Price History DataFrame. See function load_history(history_dir)
+@instrument.stage()
 def append_price_drop_column(history):
     for (symbol, h) in history.items():
         h['price-drop'] = values__price_drop(h)
@@ -133,21 +207,15 @@ def append_price_drop_column(history):
 # last price maximum.
 #
 # @param[in] h -- prices history DataFrame. See function load_history_dataframe(file_path)
+@instrument.stage()
 def values__price_drop_period(h):
-	last_max_price_date = h.index[0]
-	price_dorp = h['price-drop']
-	pdp = [0]
-	for date_n in range(1, len(h)):
-		date = h.index[date_n]
-		if price_dorp[date_n] == 1.:
-			last_max_price_date = date
-		pdp.append((date - last_max_price_date).days)
-	return pdp
+	return __drop_period(__datetimes(h), __is_peak(h['price-drop'].values))
 
 ## Append 'drop-period' column to all symbols history. 
 # See function values__price_drop_period.
 #
 # @param[in,out] history -- dictionary Symbol -> Price History DataFrame. See function load_history(history_dir)
+@instrument.stage()
 def append_drop_period_column(history):
 	for (symbol, h) in history.items():
 		h['drop-period'] = values__price_drop_period(h)
@@ -160,10 +228,9 @@ def append_drop_period_column(history):
 # @param[in] h         -- prices history DataFrame. See function load_history_dataframe(file_path)
 # @param[in] window_size -- time window size in days. Defautl: 365
 # @param[in] avg_period  -- averaging period in days. Defautl: 365
+@instrument.stage()
 def values__price_growth_ratio(h, window_size = 365, avg_period = 365):
-	avg_growth_ratio__closure = lambda history, begin, end, closed, avg_period = avg_period: \
-		moving.avg_growth_ratio(history, begin, end, closed, avg_period)
-	return moving.moving_f(avg_growth_ratio__closure, h, window_size = window_size)
+	return moving.moving_avg_growth_ratio(h, window_size = window_size, avg_period = avg_period)
 
 ## Append 'price-growth-[YEARS]y' column to all symbols history. 
 # See function values__price_growth_ratio.
@@ -171,11 +238,14 @@ def values__price_growth_ratio(h, window_size = 365, avg_period = 365):
 # @param[in,out] history -- dictionary Symbol -> Price History DataFrame. See function load_history(history_dir)
 # @param[in] windows     -- list windows sizes in years. Default: [1,2,3,4,5]
 # If windows list is empty then 'price-growth' column for all history will be added.
+@instrument.stage()
 def append_price_grouth_column(history, windows = range(1,6)):	
 	if windows:
+		windows = list(windows)
 		for (symbol, h) in history.items():
-			for years in windows:
-				h['price-growth-%iy'%years] = values__price_growth_ratio(h, window_size = int(365 * years), avg_period = 365)
+			values = moving.moving_batch(h, [int(365 * years) for years in windows], metrics = ['avg_growth_ratio'], avg_period = 365)['avg_growth_ratio']
+			for (i, years) in enumerate(windows):
+				h['price-growth-%iy'%years] = values[:, i]
 	else:
 		for (symbol, h) in history.items():
 			h['price-growth'] = h['price-ratio'][-1] / h['price-ratio'][0]
@@ -186,21 +256,15 @@ def append_price_grouth_column(history, windows = range(1,6)):
 # of days passed since last price maximum.
 #
 # @param[in] h -- prices history DataFrame. See function load_history_dataframe(file_path)
+@instrument.stage()
 def values__drop_min(h):
-	price_ratio = h['price-ratio']
-	price_dorp = h['price-drop']
-	dm = [price_ratio[0]]
-	for date_n in range(1, len(h)):
-		if price_dorp[date_n] == 1.:
-			dm.append(price_ratio[date_n])
-		else:
-			dm.append(min(dm[-1], price_ratio[date_n]))
-	return dm
+	return drop_min(h['price-ratio'].values, __is_peak(h['price-drop'].values))
 
 ## Append 'drop-min' column to all symbols history. 
 # See function values__local_min.
 #
 # @param[in,out] history -- dictionary Symbol -> Price History DataFrame. See function load_history(history_dir)
+@instrument.stage()
 def append_drop_min_column(history):	
 	for (symbol, h) in history.items():
 		h['drop-min'] = values__drop_min(h)
@@ -209,19 +273,442 @@ def append_drop_min_column(history):
 #-------------------------------------------------------------------------------
 
 
+## Drawdown engine. Returns dictionary Column -> values with 'price-ratio',
+# 'max-prev', 'price-drop', 'drop-period' and 'drop-min' columns computed 
+# in one pass over prices arrays. Values are the same as ones of functions 
+# values__price_ratio, values__max_prev, values__price_drop, 
+# values__price_drop_period and values__drop_min.
+# Arrays can contain several concatenated series, see 'start' parameter.
+#
+# @param[in] open_price -- array of open prices
+# @param[in] close      -- array of close prices
+# @param[in] date_ns    -- int64 array of dates in ns since epoch
+# @param[in] start      -- bool array, True at first position of every series. Default: None - one series
+@instrument.stage()
+def drawdown(open_price, close, date_ns, start = None):
+	if start is None:
+		start = __first(len(close))
+	with np.errstate(divide='ignore', invalid='ignore'):
+		price_ratio = close / open_price[__last_true(start)]
+		max_prev_values = max_prev(price_ratio, start)
+		price_drop = price_ratio / max_prev_values
+	is_peak = (price_drop == 1.) | start
+	return {'price-ratio': price_ratio
+		, 'max-prev': max_prev_values
+		, 'price-drop': price_drop
+		, 'drop-period': __drop_period(date_ns, is_peak)
+		, 'drop-min': drop_min(price_ratio, is_peak)}
+
+## Returns drawdown columns for specified prices history. 
+# See function drawdown.
+#
+# @param[in] h -- prices history DataFrame. See function load_history_dataframe(file_path)
+@instrument.stage()
+def values__drawdown(h):
+	return drawdown(h['open'].values, h['close'].values, __datetimes(h))
+
+## Append 'price-ratio', 'max-prev', 'price-drop', 'drop-period' and 'drop-min'
+# columns to all symbols history at once. See function drawdown.
+#
+# @param[in,out] history -- dictionary Symbol -> Price History DataFrame. See function load_history(history_dir)
+@instrument.stage()
+def append_drawdown_columns(history):
+	for (symbol, h) in history.items():
+		for (column, values) in values__drawdown(h).items():
+			__set_column(h, column, values)
+
+__DAY_NS = 24 * 3600 * 10**9
+
+# DataFrame.__setitem__ tries to parse new column name as a date when index
+# is DatetimeIndex, DataFrame.insert does not.
+def __set_column(h, column, values):
+	if column in h:
+		h[column] = values
+	else:
+		h.insert(len(h.columns), column, values)
+
+def __datetimes(h):
+	return h.index.values.astype('datetime64[ns]').view('i8')
+
+def __first(n):
+	start = np.zeros(n, dtype=bool)
+	start[:1] = True
+	return start
+
+def __last_true(flags):
+	return np.maximum.accumulate(np.where(flags, np.arange(len(flags)), 0))
+
+def __max_prev(price_ratio):
+	return max_prev(price_ratio, __first(len(price_ratio)))
+
+def __is_peak(price_drop):
+	return (price_drop == 1.) | __first(len(price_drop))
+
+def __drop_period(date_ns, is_peak):
+	return (date_ns - date_ns[__last_true(is_peak)]) // __DAY_NS
+
+## Returns 'max-prev' values for price ratio arrays of one or several
+# concatenated series. NaN price ratio gives NaN and running maximum 
+# starts again after it, as loop of max(price_ratio, previous) does.
+#
+# @param[in] price_ratio -- array of price ratios
+# @param[in] start       -- bool array, True at first position of every series
+def max_prev(price_ratio, start):
+	is_nan = np.isnan(price_ratio)
+	restart = start.copy()
+	restart[1:] |= is_nan[:-1]
+	if not restart[1:].any():
+		return np.maximum.accumulate(price_ratio)
+	res = -running_min(-price_ratio, restart)
+	res[is_nan] = np.nan
+	return res
+
+## Returns 'drop-min' values for price ratio arrays of one or several
+# concatenated series. NaN price ratio at the first position of series
+# gives NaN until the next peak, as loop of min(previous, price_ratio) does.
+#
+# @param[in] price_ratio -- array of price ratios
+# @param[in] is_peak     -- bool array, True at price maximums and at first position of every series
+def drop_min(price_ratio, is_peak):
+	res = running_min(price_ratio, is_peak)
+	nan_start = is_peak & np.isnan(price_ratio)
+	if nan_start.any():
+		segment = np.cumsum(is_peak)
+		res[np.isin(segment, segment[nan_start])] = np.nan
+	return res
+
+## Returns running minimum of values restarted at every position where
+# restart is True. First position should be a restart position. NaN values
+# are ignored. Values are replaced by their ranks and every segment is 
+# shifted below the previous one, so one np.minimum.accumulate call gives
+# exact minimums for all segments.
+#
+# @param[in] values  -- array of values
+# @param[in] restart -- bool array of restart positions
+def running_min(values, restart):
+	n = len(values)
+	order = np.argsort(values, kind='mergesort')
+	rank = np.empty(n, dtype=np.int64)
+	rank[order] = np.arange(n)
+	shift = np.cumsum(restart) * n
+	return values[order[np.minimum.accumulate(rank - shift) + shift]]
+
+
+#-------------------------------------------------------------------------------
+
+
+## Enrichment steps supported by function enrich. Every step appends column
+# with the same name except 'price-growth' step which appends columns like
+# function append_price_grouth_column does.
+ENRICH_STEPS = ['price-ratio', 'max-prev', 'price-drop', 'drop-period', 'drop-min', 'price-growth']
+
+## Appends enrichment columns to all symbols history. Symbols are spread over
+# pool of worker processes. Prices are passed to workers and results are passed
+# back through memory-mapped files, so DataFrames are never pickled. Results
+# do not depend on number of workers.
+#
+# @param[in,out] history -- dictionary Symbol -> Price History DataFrame. See function load_history(history_dir)
+# @param[in] steps       -- list of enrichment steps, see ENRICH_STEPS. Default: ENRICH_STEPS
+# @param[in] windows     -- list windows sizes in years for 'price-growth' step. Default: [1,2,3,4,5]
+# @param[in] workers     -- number of worker processes, None - number of CPUs. Default: None
+# @param[in] cache_dir   -- directory of derived metrics cache, see module cache. Default: None - no caching
+# @param[in] max_size    -- cache size limit in bytes, None - do not evict entries. Default: cache.MAX_SIZE
+@instrument.stage()
+def enrich(history, steps = ENRICH_STEPS, windows = range(1,6), workers = None, cache_dir = None, max_size = cache.MAX_SIZE):
+	unknown = set(steps) - set(ENRICH_STEPS)
+	if unknown:
+		raise ValueError('Unknown enrichment steps: %s' % ', '.join(sorted(unknown)))
+	steps = [step for step in ENRICH_STEPS if step in steps]
+	windows = list(windows)
+	columns = __enrich_columns(steps, windows)
+	if cache_dir:
+		__enrich_cached(history, steps, windows, columns, workers, cache_dir, max_size)
+		return
+	workers = min(workers or os.cpu_count() or 1, len(history))
+	if workers <= 1:
+		for (symbol, h) in history.items():
+			with instrument.symbol(symbol):
+				values = __enrich_arrays(__datetimes(h), h['open'].values, h['close'].values, steps, windows)
+			for column in columns:
+				__set_column(h, column, values[column])
+		return
+
+	offsets = np.zeros(len(history) + 1, dtype=np.int64)
+	offsets[1:] = np.cumsum([len(h) for h in history.values()])
+	shared_dir = tempfile.mkdtemp(prefix='enrich-', dir=__SHARED_MEMORY_DIR if os.path.isdir(__SHARED_MEMORY_DIR) else None)
+	try:
+		date_ns = __shared_array(shared_dir, 'dates', np.int64, (offsets[-1],), 'w+')
+		prices = __shared_array(shared_dir, 'prices', np.float64, (2, offsets[-1]), 'w+')
+		for (h, begin, end) in zip(history.values(), offsets[:-1], offsets[1:]):
+			date_ns[begin:end] = __datetimes(h)
+			prices[0, begin:end] = h['open'].values
+			prices[1, begin:end] = h['close'].values
+		__shared_array(shared_dir, 'values', np.float64, (len(columns), offsets[-1]), 'w+').flush()
+		del date_ns, prices
+
+		bounds = np.unique(np.searchsorted(offsets, np.linspace(0, offsets[-1], workers * 4 + 1)))
+		tasks = [(shared_dir, offsets, begin, end, steps, windows, columns) for (begin, end) in zip(bounds[:-1], bounds[1:])]
+		with multiprocessing.Pool(workers) as pool:
+			pool.map(_enrich_symbols, tasks)
+
+		values = __shared_array(shared_dir, 'values', np.float64, (len(columns), offsets[-1]), 'r')
+		for (h, begin, end) in zip(history.values(), offsets[:-1], offsets[1:]):
+			for (column_n, column) in enumerate(columns):
+				column_values = np.array(values[column_n, begin:end])
+				__set_column(h, column, column_values.astype(np.int64) if column == 'drop-period' else column_values)
+		del values
+	finally:
+		shutil.rmtree(shared_dir, ignore_errors=True)
+
+## Version of enrichment algorithms. It is a part of cache keys, so it
+# should be changed when enrichment results change.
+ENRICH_VERSION = 1
+
+# Takes enrichment columns from cache, computes and caches missing ones.
+# Key depends on symbol dates and prices, steps and windows.
+def __enrich_cached(history, steps, windows, columns, workers, cache_dir, max_size):
+	keys = {}
+	missing = {}
+	for (symbol, h) in history.items():
+		keys[symbol] = cache.key(ENRICH_VERSION, steps, windows, __datetimes(h), h['open'].values, h['close'].values)
+		values = cache.get(keys[symbol], cache_dir)
+		if values is None or set(values) != set(columns):
+			missing[symbol] = h
+			continue
+		for column in columns:
+			__set_column(h, column, values[column])
+	print('%i of %i symbols taken from cache "%s"' % (len(history) - len(missing), len(history), cache_dir))
+	if missing:
+		enrich(missing, steps, windows, workers)
+		for (symbol, h) in missing.items():
+			cache.put(keys[symbol], dict((column, h[column].values) for column in columns), cache_dir, max_size = None)
+		if max_size is not None:
+			cache.evict(cache_dir, max_size)
+
+## Worker of function enrich. Processes symbols with numbers in range [begin, end).
+def _enrich_symbols(task):
+	(shared_dir, offsets, begin, end, steps, windows, columns) = task
+	date_ns = __shared_array(shared_dir, 'dates', np.int64, (offsets[-1],), 'r')
+	prices = __shared_array(shared_dir, 'prices', np.float64, (2, offsets[-1]), 'r')
+	values = __shared_array(shared_dir, 'values', np.float64, (len(columns), offsets[-1]), 'r+')
+	for (row_begin, row_end) in zip(offsets[begin:end], offsets[begin+1:end+1]):
+		res = __enrich_arrays(date_ns[row_begin:row_end], prices[0, row_begin:row_end], prices[1, row_begin:row_end], steps, windows)
+		for (column_n, column) in enumerate(columns):
+			values[column_n, row_begin:row_end] = res[column]
+	values.flush()
+
+__SHARED_MEMORY_DIR = '/dev/shm'
+
+def __shared_array(shared_dir, name, dtype, shape, mode):
+	return np.memmap(os.path.join(shared_dir, name), dtype=dtype, mode=mode, shape=tuple(int(n) for n in shape))
+
+def __enrich_columns(steps, windows):
+	columns = [step for step in steps if step != 'price-growth']
+	if 'price-growth' in steps:
+		columns += ['price-growth-%iy'%years for years in windows] if windows else ['price-growth']
+	return columns
+
+@instrument.stage()
+def __enrich_arrays(date_ns, open_price, close, steps, windows):
+	res = drawdown(open_price, close, date_ns)
+	if 'price-growth' in steps:
+		if windows:
+			values = moving.batch(date_ns, open_price, close, [int(365 * years) for years in windows], metrics = ['avg_growth_ratio'], avg_period = 365)['avg_growth_ratio']
+			for (i, years) in enumerate(windows):
+				res['price-growth-%iy'%years] = values[:, i]
+		else:
+			price_ratio = res['price-ratio']
+			with np.errstate(divide='ignore', invalid='ignore'):
+				res['price-growth'] = np.full(len(price_ratio), price_ratio[-1] / price_ratio[0])
+	return res
+
+
+#-------------------------------------------------------------------------------
+
+
+## Appends new bars to symbol prices history. Bars are appended to the history
+# file in target directory (if specified) and to loaded history. Enrichment
+# columns of loaded history are extended, see function extend_history.
+#
+# @param[in,out] history -- dictionary Symbol -> Price History DataFrame. See function load_history(history_dir)
+# @param[in] symbol      -- target symbol
+# @param[in] bars        -- DataFrame with new bars: date index and columns 'open', 'close', 'volume', 'high', 'low'
+# @param[in] history_dir -- path to directory with CSV files. Default: None - do not write bars to file
+def append_bars(history, symbol, bars, history_dir = None):
+	h = history[symbol]
+	bars = bars.sort_index()
+	bars = bars[bars.index > h.index[-1]]
+	if not len(bars):
+		return
+	if history_dir:
+		append_history_file(os.path.join(history_dir, symbol + '.csv'), symbol, bars)
+	history[symbol] = extend_history(h, bars)
+
+
+## Saves prices history columns to CSV file in the layout of history files,
+# so it can be loaded by function load_history_dataframe. File is replaced
+# atomically.
+#
+# @param[in] file_path -- path to CSV file. Example: "/history/ADBE.csv"
+# @param[in] symbol    -- target symbol
+# @param[in] columns   -- dictionary Column -> array with 'date', 'open', 'close', 'volume', 'high' and 'low' columns,
+#                         for example result of function stock.parse_time_series_columns
+def save_history_file(file_path, symbol, columns):
+	rows = pd.DataFrame(dict([('symbol', symbol)] + [(column, columns[column]) for column in HISTORY_FILE_COLUMNS[1:]])
+		, columns = HISTORY_FILE_COLUMNS)
+	rows.to_csv(file_path + '.tmp')
+	os.replace(file_path + '.tmp', file_path)
+
+## Appends new bars to CSV file with prices history. File is created if it
+# does not exist. Only new rows are written.
+#
+# @param[in] file_path -- path to CSV file. Example: "/history/ADBE.csv"
+# @param[in] symbol    -- target symbol
+# @param[in] bars      -- DataFrame with new bars: date index and columns 'open', 'close', 'volume', 'high', 'low'
+def append_history_file(file_path, symbol, bars):
+	first_n = 0
+	if os.path.isfile(file_path):
+		first_n = __last_row_number(file_path) + 1
+	rows = pd.DataFrame({'symbol': symbol
+		, 'date': bars.index.strftime('%Y-%m-%d')
+		, 'open': bars['open'].values
+		, 'close': bars['close'].values
+		, 'volume': bars['volume'].values
+		, 'high': bars['high'].values
+		, 'low': bars['low'].values}
+		, index = pd.RangeIndex(first_n, first_n + len(bars))
+		, columns = HISTORY_FILE_COLUMNS)
+	rows.to_csv(file_path, mode = 'a', header = not first_n)
+
+## Columns of CSV files with prices history
+HISTORY_FILE_COLUMNS = ['symbol', 'date', 'open', 'close', 'volume', 'high', 'low']
+
+def __last_row_number(file_path):
+	with open(file_path, 'rb') as f:
+		f.seek(0, os.SEEK_END)
+		f.seek(max(0, f.tell() - 4096))
+		lines = f.read().splitlines()
+	for line in reversed(lines):
+		try:
+			return int(line.split(b',')[0])
+		except ValueError:
+			continue
+	return -1
+
+
+## Returns prices history with new bars appended. Enrichment columns 
+# ('price-ratio', 'max-prev', 'price-drop', 'drop-period', 'drop-min', 
+# 'price-growth-[YEARS]y') present in history are extended for new bars by
+# carrying running maximum, last peak date and drop minimum forward, so past
+# values are not recomputed. Values are the same as ones computed for entire
+# history from scratch.
+#
+# @param[in] h    -- prices history DataFrame. See function load_history_dataframe(file_path)
+# @param[in] bars -- DataFrame with bars newer than the last one in history: date index and columns 'open', 'close', 'volume', 'high', 'low'
+@instrument.stage()
+def extend_history(h, bars):
+	bars = bars.sort_index()
+	new = pd.DataFrame(index = bars.index.rename(h.index.name))
+	for column in ['open', 'close', 'volume', 'high', 'low']:
+		if column in h:
+			new[column] = bars[column].values.astype(h[column].dtype)
+	if 'datenum' in h:
+		new['datenum'] = dates.date2num(new.index)
+
+	date_ns = __datetimes(new)
+	close = new['close'].values
+	with np.errstate(divide='ignore', invalid='ignore'):
+		price_ratio = close / h['open'].values[0]
+	if 'price-ratio' in h:
+		new['price-ratio'] = price_ratio
+	if 'max-prev' in h:
+		max_prev_values = max_prev(np.append(h['max-prev'].values[-1], price_ratio), __first(len(new) + 1))[1:]
+		new['max-prev'] = max_prev_values
+		with np.errstate(divide='ignore', invalid='ignore'):
+			price_drop = price_ratio / max_prev_values
+		is_peak = np.append(True, price_drop == 1.)
+		if 'price-drop' in h:
+			new['price-drop'] = price_drop
+		if 'drop-period' in h:
+			last_peak_ns = __last_peak_ns(h)
+			new['drop-period'] = __drop_period(np.append(last_peak_ns, date_ns), is_peak)[1:]
+		if 'drop-min' in h:
+			new['drop-min'] = drop_min(np.append(h['drop-min'].values[-1], price_ratio), is_peak)[1:]
+
+	years = [int(column[len('price-growth-'):-1]) for column in h.columns if re.match(r'^price-growth-\d+y$', column)]
+	if years:
+		tail = __window_tail(h, new, max(years))
+		tail_date_ns = np.append(__datetimes(tail), date_ns)
+		values = moving.batch(tail_date_ns
+			, np.append(tail['open'].values, new['open'].values)
+			, np.append(tail['close'].values, close)
+			, [int(365 * y) for y in years], metrics = ['avg_growth_ratio'], avg_period = 365, since = len(tail))['avg_growth_ratio']
+		for (i, y) in enumerate(years):
+			new['price-growth-%iy'%y] = values[:, i]
+
+	res = pd.concat([h, new], sort = False)
+	if 'price-growth' in h:
+		with np.errstate(divide='ignore', invalid='ignore'):
+			res['price-growth'] = res['close'].values[-1] / res['open'].values[0] / (res['close'].values[0] / res['open'].values[0])
+	return res
+
+# Date of the last price maximum. It is 'drop-period' days before the last
+# date, so only rows of one day are checked.
+def __last_peak_ns(h):
+	date_ns = __datetimes(h)
+	days = int(h['drop-period'].values[-1])
+	begin = np.searchsorted(date_ns, date_ns[-1] - (days + 1) * __DAY_NS, side='right')
+	end = np.searchsorted(date_ns, date_ns[-1] - days * __DAY_NS, side='right')
+	peaks = np.flatnonzero(h['price-drop'].values[begin:end] == 1.) if 'price-drop' in h else []
+	return date_ns[begin + peaks[-1]] if len(peaks) else date_ns[-1] - days * __DAY_NS
+
+# Rows of history needed to find windows ending at new rows: all rows newer
+# than the largest window plus one row before them.
+def __window_tail(h, new, years):
+	date_ns = __datetimes(h)
+	first = np.searchsorted(date_ns, __datetimes(new)[0] - (int(365 * years) + 1) * __DAY_NS, side='right') - 1
+	return h.iloc[max(first, 0):]
+
+## Returns rows of enriched prices history which function extend_history needs
+# to extend it: the first row, the last price maximum and rows of the largest
+# 'price-growth' window before the last date. Extending the tail gives the 
+# same new rows as extending entire history, so long histories can be 
+# enriched by chunks of fixed size.
+#
+# @param[in] h -- prices history DataFrame enriched by function enrich
+def history_tail(h):
+	if not len(h):
+		return h
+	date_ns = __datetimes(h)
+	years = [int(column[len('price-growth-'):-1]) for column in h.columns if re.match(r'^price-growth-\d+y$', column)]
+	first = len(h) - 1
+	if years:
+		first = max(np.searchsorted(date_ns, date_ns[-1] - (int(365 * max(years)) + 1) * __DAY_NS, side='right') - 1, 0)
+	rows = [0]
+	if 'price-drop' in h:
+		peaks = np.flatnonzero(h['price-drop'].values[:first] == 1.)
+		rows += peaks[-1:].tolist()
+	return h.iloc[sorted(set(rows)) + [*range(max(first, 1), len(h))]]
+
+
+#-------------------------------------------------------------------------------
+
+
 ## Returns copy of prices history for specified relative period
 #
 # @param[in] history -- dictionary Symbol -> Price History DataFrame. See function load_history(history_dir)
 # @param[in] since   -- begin of period - float between 0.0 and 1.0. Default: 0.0
 # @param[in] to      -- end of period - float between 0.0 and 1.0. Default: 1.0
-def prepare_history_period(history, since = 0.,  to = 1.):
+# @param[in] copy    -- copy prices, otherwise return views, see function history_view. Default: True
+@instrument.stage()
+def prepare_history_period(history, since = 0.,  to = 1., copy = True):
 	res = {}
 	for (symbol, h) in history.items():
 		begin_n = int(len(h) * since)
 		end_n = int(len(h) * to)
 		begin = h.index[begin_n]
 		end = h.index[end_n - 1]
-		res[symbol] = h.loc[begin:end].copy()
+		res[symbol] = __period(h, begin, end, copy)
 	return res
 
 ## Returns copy of prices history for specified absolute period
@@ -229,14 +716,31 @@ def prepare_history_period(history, since = 0.,  to = 1.):
 # @param[in] history -- dictionary Symbol -> Price History DataFrame. See function load_history(history_dir)
 # @param[in] since   -- begin of period - pandas.datetime
 # @param[in] to      -- end of period - pandas.datetime
-def prepare_history_abs_period(history, since,  to):
+# @param[in] copy    -- copy prices, otherwise return views, see function history_view. Default: True
+@instrument.stage()
+def prepare_history_abs_period(history, since,  to, copy = True):
 	res = {}
 	for (symbol, h) in history.items():
-		hp = h.loc[since:to].copy()
-		if (hp.index[0] - since).days <= 31:
+		hp = __period(h, since, to, copy)
+		if len(hp) and (hp.index[0] - since).days <= 31:
 			res[symbol] = hp
 	return res
 
+## Returns DataFrame with rows [begin, end) of prices history sharing memory
+# with it. Columns appended to the view (for example by function enrich) and
+# columns replaced in it are held by the view only, history is not changed.
+#
+# @param[in] h     -- prices history DataFrame. See function load_history_dataframe(file_path)
+# @param[in] begin -- first row
+# @param[in] end   -- last row plus one
+def history_view(h, begin, end):
+	return pd.DataFrame(dict((column, h[column].values[begin:end]) for column in h.columns), index = h.index[begin:end], copy = False)
+
+def __period(h, since, to, copy):
+	if copy:
+		return h.loc[since:to].copy()
+	return history_view(h, h.index.searchsorted(since, side='left'), h.index.searchsorted(to, side='right'))
+
 #-------------------------------------------------------------------------------
 
 ## Compres 'drop-period' column values to list of triplets (begin_i, end_i, in_drop)
@@ -247,45 +751,106 @@ def prepare_history_abs_period(history, since,  to):
 # in_drop - equals ('drop-period' < 0) for target period.
 #
 # @param[in] h -- prices history DataFrame. See function common.load_history_dataframe(file_path)
+@instrument.stage()
 def drop_periods(h):
-	in_drop = h['drop-period'] > 0
-	drop_intervals = []
-	last_i = 0
-	for i in range(1, len(in_drop)):
-		it_is_last_i = i == len(in_drop)-1
-		if in_drop[last_i] != in_drop[i]:
-			drop_intervals.append((last_i, i, in_drop[last_i]))
-			last_i = i
-	drop_intervals.append((last_i, len(h), in_drop[last_i]))
-	return drop_intervals
+	in_drop = h['drop-period'].values > 0
+	(begins, ends) = __runs(in_drop, __first(len(in_drop)))
+	return [*zip(begins.tolist(), ends.tolist(), in_drop[begins])]
 
 #-------------------------------------------------------------------------------
 
+## Returns DataFrame of drop, takeoff and growth periods of symbol history
+# with columns 'begin', 'end', 'type', 'extremum', 'extremum-date':
+# - 'drop' lasts from begin of drop period to minimal price ratio in it
+# - 'takeoff' is period without drop
+# - 'growth' lasts from minimal price ratio of previous drop to end of this drop
+# 'extremum' is minimal price ratio of drop or maximal one of takeoff and growth.
+#
+# @param[in] h -- prices history DataFrame with 'price-ratio' and 'drop-period' columns
+@instrument.stage()
 def periods(h):
-	ps = drop_periods(h)
-	price_ratio = h['price-ratio']	
-	data = {'begin': [], 'end': [], 'type': [], 'extremum': [], 'extremum-date': []}
-	for (begin_i, end_i, in_drop) in ps:
-		price_ratio_slice = price_ratio.iloc[begin_i:end_i]
-		extremum_date = price_ratio_slice.idxmin() if in_drop else price_ratio_slice.idxmax()
-		extremum = price_ratio.loc[extremum_date]
-
-		if not in_drop and len(data['extremum-date']):
-			data['begin'].append(data['extremum-date'][-1])
-			data['end'].append(h.index[begin_i-1])
-			data['type'].append('growth')
-			data['extremum'].append(extremum)
-			data['extremum-date'].append(extremum_date)
-
-		data['begin'].append(h.index[begin_i])
-		if in_drop:
-			data['end'].append(extremum_date)
-		else:
-			data['end'].append(h.index[end_i-1])
-		data['type'].append('drop' if in_drop else 'takeoff')
-		data['extremum'].append(extremum)
-		data['extremum-date'].append(extremum_date)
+	res = __periods(h['drop-period'].values, h['price-ratio'].values, h.index.values, __first(len(h)))
+	del res['begin-i'], res['end-i']
+	return pd.DataFrame(data = res, columns = PERIODS_COLUMNS)
+
+## Columns of DataFrame returned by function periods
+PERIODS_COLUMNS = ['begin', 'end', 'type', 'extremum', 'extremum-date']
 
-	return pd.DataFrame(data = data)
+
+## Returns periods of all symbols (see function periods) as one long DataFrame
+# with additional columns 'symbol' and 'bars' - number of history entries in period.
+# Rows of every symbol are in the same order as rows of function periods.
+#
+# @param[in] history -- dictionary Symbol -> Price History DataFrame with 'price-ratio' and 'drop-period' columns
+@instrument.stage()
+def all_periods(history):
+	symbols = [*history]
+	lengths = np.array([len(history[symbol]) for symbol in symbols], dtype=np.int64)
+	if not lengths.sum():
+		return pd.DataFrame(columns = ['symbol'] + PERIODS_COLUMNS + ['bars'])
+	start = np.zeros(lengths.sum(), dtype=bool)
+	start[(np.cumsum(lengths) - lengths)[lengths > 0]] = True
+	res = __periods(np.concatenate([history[symbol]['drop-period'].values for symbol in symbols])
+		, np.concatenate([history[symbol]['price-ratio'].values for symbol in symbols])
+		, np.concatenate([history[symbol].index.values for symbol in symbols])
+		, start)
+	owner = np.repeat(np.arange(len(symbols)), lengths)
+	res['symbol'] = np.array(symbols, dtype=object)[owner[res['begin-i']]]
+	res['bars'] = res.pop('end-i') - res.pop('begin-i') + 1
+	return pd.DataFrame(data = res, columns = ['symbol'] + PERIODS_COLUMNS + ['bars'])
+
+
+## Returns pair (begins, ends) of runs of equal values. Runs are also broken
+# at positions where start is True.
+def __runs(values, start):
+	if not len(values):
+		return (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+	breaks = start.copy()
+	breaks[1:] |= values[1:] != values[:-1]
+	begins = np.flatnonzero(breaks)
+	return (begins, np.append(begins[1:], len(values)))
+
+## Returns dictionary Column -> array of periods (see function periods) plus
+# 'begin-i' and 'end-i' - positions of first and last entries of periods.
+def __periods(drop_period, price_ratio, index, start):
+	in_drop = drop_period > 0
+	(begins, ends) = __runs(in_drop, start)
+	drop = in_drop[begins]
+
+	# first position of minimum in drops and maximum in other periods, NaN are skipped
+	signed = np.where(in_drop, price_ratio, -price_ratio)
+	signed[np.isnan(signed)] = np.inf
+	n = len(signed)
+	if len(begins):
+		extremum_i = np.minimum.reduceat(np.where(signed == np.repeat(np.minimum.reduceat(signed, begins), ends - begins), np.arange(n), n), begins)
+	else:
+		extremum_i = np.zeros(0, dtype=np.int64)
+	found = extremum_i < n
+	extremum_i = np.minimum(extremum_i, max(n - 1, 0))
+	extremum = np.where(found, price_ratio[extremum_i] if n else 0., np.nan)
+	extremum_date = index[extremum_i] if n else index[:0]
+	if not found.all():
+		extremum_date = np.where(found, extremum_date, np.datetime64('NaT'))
+
+	# growth period precedes every takeoff except the first period of symbol
+	growth = ~drop & ~start[begins]
+	k = np.flatnonzero(growth)
+	row = np.arange(len(begins)) + np.cumsum(growth)
+	count = len(begins) + len(k)
+	res = {'begin': np.empty(count, dtype=index.dtype)
+		, 'end': np.empty(count, dtype=index.dtype)
+		, 'type': np.empty(count, dtype=object)
+		, 'extremum': np.empty(count)
+		, 'extremum-date': np.empty(count, dtype=index.dtype)
+		, 'begin-i': np.empty(count, dtype=np.int64)
+		, 'end-i': np.empty(count, dtype=np.int64)}
+	end_i = np.where(drop, extremum_i, ends - 1)
+	for (column, values) in [('begin', index[begins]), ('end', index[end_i]), ('type', np.where(drop, 'drop', 'takeoff'))
+			, ('extremum', extremum), ('extremum-date', extremum_date), ('begin-i', begins), ('end-i', end_i)]:
+		res[column][row] = values
+	for (column, values) in [('begin', extremum_date[k - 1]), ('end', index[begins[k] - 1]), ('type', 'growth')
+			, ('extremum', extremum[k]), ('extremum-date', extremum_date[k]), ('begin-i', extremum_i[k - 1]), ('end-i', begins[k] - 1)]:
+		res[column][row[k] - 1] = values
+	return res
 
 ################################################################################
@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+
+################################################################################
+
+# Correlation of returns and co-drawdown of all pairs of symbols. Aligned
+# prices history (see module panel) is turned into matrices dates x symbols
+# of returns and of drawdown state ('drop-period' > 0) once, then every
+# statistic of all pairs is computed from sums over dates both symbols are
+# present, which are products of these matrices:
+#
+#   n   = M' M      - number of common dates (M is presence mask)
+#   sx  = X' M      - sums of returns of the first symbol over common dates
+#   sxx = (X*X)' M  - sums of squares of returns over common dates
+#   sxy = X' X      - sums of products of returns
+#   dd  = D' D      - number of common dates both symbols are in drawdown
+#
+# Products are computed by bands of symbols, so temporary arrays are bounded
+# by band size x number of symbols. Sums of rolling windows are updated by
+# dates entering and leaving the window only.
+#
+# Example:
+#   common.enrich(history, steps = ['price-ratio', 'max-prev', 'price-drop', 'drop-period'])
+#   pairs = correlation.Correlation(panel.Panel(history, ['close', 'drop-period']), cache_dir = '.cache')
+#   correlation.top_pairs(pairs.matrix('co-drawdown'))
+#   for (date, corr) in pairs.rolling('correlation', window_days = 365, step_days = 91): ...
+
+import numpy as np
+import pandas as pd
+import cache
+import instrument
+import moving
+
+################################################################################
+
+## Statistics of pairs of symbols:
+# - 'correlation' is Pearson correlation of returns over dates both symbols
+#   have returns. Return is ratio of close price to close price at the
+#   previous date of symbol history minus 1
+# - 'co-drawdown' is part of dates both symbols are in drawdown
+#   ('drop-period' > 0) among dates both symbols are present
+KINDS = ['correlation', 'co-drawdown']
+
+## Fields panel should have
+FIELDS = ['close', 'drop-period']
+
+## Default minimal number of common dates of pair, statistic is NaN for pairs
+# with less dates. 12 is a year of monthly history.
+MIN_PERIODS = 12
+
+## Default number of symbols of band of products
+BLOCK = 256
+
+## Version of correlation algorithms. It is a part of cache keys, so it
+# should be changed when results change.
+CORRELATION_VERSION = 1
+
+#===============================================================================
+
+## Correlation and co-drawdown of all pairs of symbols of aligned prices history
+class Correlation:
+	panel = None        # panel.Panel of prices history
+	fingerprint = None  # cache key of panel dates, symbols and fields, see function cache.key
+	cache_dir = None    # cache directory, None - no caching
+	__arrays = None
+
+	## Prepares matrices of returns and drawdown state. Panel should not be
+	# changed while the object is used.
+	#
+	# @param[in] panel     -- panel.Panel with FIELDS. See function common.enrich
+	# @param[in] cache_dir -- directory of results cache, see module cache. Default: None - no caching
+	def __init__(self, panel, cache_dir = None):
+		missing = [field for field in FIELDS if field not in panel.fields]
+		if missing:
+			raise ValueError('Panel should have fields: %s' % ', '.join(missing))
+		self.panel = panel
+		self.cache_dir = cache_dir
+		(close, drop_period) = (panel.fields['close'], panel.fields['drop-period'])
+		self.fingerprint = cache.key(CORRELATION_VERSION, panel.symbols, panel.dates.values.view('i8'), close, drop_period)
+		self.__arrays = _arrays(panel.mask, close, drop_period)
+
+	def __repr__(self):
+		return 'correlation.Correlation(%i dates x %i symbols)' % (len(self.panel.dates), len(self.panel.symbols))
+
+	#---------------------------------------------------------------------------
+
+	## Returns DataFrame symbols x symbols with statistic of all pairs over
+	# dates of specified period.
+	#
+	# @param[in] kind        -- statistic, see KINDS. Default: 'correlation'
+	# @param[in] since       -- begin of period - pandas.datetime. Default: None - first date
+	# @param[in] to          -- end of period - pandas.datetime. Default: None - last date
+	# @param[in] min_periods -- minimal number of common dates of pair. Default: MIN_PERIODS
+	# @param[in] block       -- number of symbols of band of products. Default: BLOCK
+	@instrument.stage()
+	def matrix(self, kind = 'correlation', since = None, to = None, min_periods = MIN_PERIODS, block = BLOCK):
+		_check_kind(kind)
+		dates = self.panel.dates
+		begin = 0 if since is None else dates.searchsorted(pd.Timestamp(since), side='left')
+		end = len(dates) if to is None else dates.searchsorted(pd.Timestamp(to), side='right')
+		key = cache.key(self.fingerprint, kind, int(begin), int(end), min_periods)
+		return self.__frame(self.__cached(key, lambda: _statistic(kind, _sums(kind, self.__arrays, begin, end, block), min_periods)))
+
+	## Generates pairs (end date, DataFrame symbols x symbols) with statistic
+	# of all pairs over rolling windows of 'window_days' days up to end date
+	# inclusive. The last window ends at the last date, previous ones end at
+	# the last dates before every 'step_days' days, the first one begins not
+	# earlier than the first date. Only sums of one window are kept in memory,
+	# sums are updated by dates entering and leaving the window.
+	#
+	# @param[in] kind        -- statistic, see KINDS. Default: 'correlation'
+	# @param[in] window_days -- window size in days. Default: 365
+	# @param[in] step_days   -- distance between ends of windows in days. Default: 30
+	# @param[in] min_periods -- minimal number of common dates of pair in window. Default: MIN_PERIODS
+	# @param[in] block       -- number of symbols of band of products. Default: BLOCK
+	def rolling(self, kind = 'correlation', window_days = 365, step_days = 30, min_periods = MIN_PERIODS, block = BLOCK):
+		_check_kind(kind)
+		if step_days <= 0:
+			raise ValueError('Step of rolling windows should be positive, %r given' % step_days)
+		dates = self.panel.dates
+		bounds = _window_bounds(dates.values.view('i8'), int(window_days * moving.DAY_NS), int(step_days * moving.DAY_NS))
+		sums = None
+		(prev_begin, prev_end) = (0, 0)
+		for (begin, end) in bounds:
+			key = cache.key(self.fingerprint, kind, int(begin), int(end), min_periods)
+			values = None if self.cache_dir is None else cache.get(key, self.cache_dir)
+			if values is None:
+				if sums is None or (begin - prev_begin) + (end - prev_end) >= end - begin:
+					sums = _sums(kind, self.__arrays, begin, end, block)
+				else:
+					_add(sums, _sums(kind, self.__arrays, prev_end, end, block), 1.)
+					_add(sums, _sums(kind, self.__arrays, prev_begin, begin, block), -1.)
+				(prev_begin, prev_end) = (begin, end)
+				values = self.__store(key, _statistic(kind, sums, min_periods))
+			else:
+				values = values['matrix']
+			yield (dates[end - 1], self.__frame(values))
+
+	#---------------------------------------------------------------------------
+
+	def __frame(self, values):
+		symbols = pd.Index(self.panel.symbols, name='symbol')
+		return pd.DataFrame(values, index=symbols, columns=symbols, copy=False)
+
+	def __cached(self, key, compute):
+		values = None if self.cache_dir is None else cache.get(key, self.cache_dir)
+		return values['matrix'] if values is not None else self.__store(key, compute())
+
+	def __store(self, key, values):
+		if self.cache_dir is not None:
+			cache.put(key, {'matrix': values}, self.cache_dir)
+		return values
+
+def _check_kind(kind):
+	if kind not in KINDS:
+		raise ValueError('Unknown statistic "%s", expected one of: %s' % (kind, ', '.join(KINDS)))
+
+#===============================================================================
+
+## Returns DataFrame of 'n' pairs of different symbols with the largest
+# values of statistic matrix: 'symbol-a', 'symbol-b' and 'value' columns.
+# NaN values are skipped.
+#
+# @param[in] matrix -- DataFrame symbols x symbols returned by Correlation.matrix or Correlation.rolling
+# @param[in] n      -- number of pairs. Default: 20
+def top_pairs(matrix, n = 20):
+	(rows, columns) = np.triu_indices(len(matrix), k = 1)
+	values = matrix.values[rows, columns]
+	valid = np.flatnonzero(~np.isnan(values))
+	if len(valid) > n:
+		valid = valid[np.argpartition(-values[valid], n - 1)[:n]]
+	valid = valid[np.argsort(-values[valid], kind='stable')]
+	symbols = np.asarray(matrix.index, dtype=object)
+	return pd.DataFrame({'symbol-a': symbols[rows[valid]], 'symbol-b': symbols[columns[valid]], 'value': values[valid]}
+		, columns = ['symbol-a', 'symbol-b', 'value'])
+
+#-------------------------------------------------------------------------------
+
+# Matrices dates x symbols used by functions below: presence mask and returns
+# of dates having returns, presence mask and drawdown state of present dates.
+# Returns are centered by mean return of symbol, it does not change
+# correlation but keeps sums of squares accurate.
+def _arrays(mask, close, drop_period):
+	columns = np.arange(mask.shape[1])
+	rows = np.where(mask, np.arange(len(mask))[:, None], -1)
+	prev = np.full(mask.shape, -1)
+	if len(mask):
+		prev[1:] = np.maximum.accumulate(rows, axis=0)[:-1]
+	prev_close = np.where(prev >= 0, close[np.maximum(prev, 0), columns], np.nan)
+	with np.errstate(divide = 'ignore', invalid = 'ignore'):
+		returns = close / prev_close - 1.
+	has_return = mask & np.isfinite(returns)
+	returns = np.where(has_return, returns, 0.)
+	with np.errstate(divide = 'ignore', invalid = 'ignore'):
+		mean = returns.sum(axis=0) / has_return.sum(axis=0)
+	returns = np.where(has_return, returns - np.where(np.isfinite(mean), mean, 0.), 0.)
+	present = mask & np.isfinite(drop_period)
+	return {'return-mask': has_return.astype(np.float64), 'returns': returns, 'squares': returns * returns
+		, 'present': present.astype(np.float64), 'drawdown': (present & (drop_period > 0)).astype(np.float64)}
+
+## Returns dictionary Name -> matrix symbols x symbols of sums of statistic
+# over dates [begin, end)
+def _sums(kind, a, begin, end, block):
+	if kind == 'correlation':
+		(m, x) = (a['return-mask'][begin:end], a['returns'][begin:end])
+		return {'n': _products(m, m, block), 'sx': _products(x, m, block), 'sxx': _products(a['squares'][begin:end], m, block), 'sxy': _products(x, x, block)}
+	(m, d) = (a['present'][begin:end], a['drawdown'][begin:end])
+	return {'n': _products(m, m, block), 'dd': _products(d, d, block)}
+
+## Returns product left' right computed by bands of 'block' columns of left
+def _products(left, right, block):
+	res = np.empty((left.shape[1], right.shape[1]))
+	for begin in range(0, left.shape[1], block):
+		res[begin:begin + block] = left[:, begin:begin + block].T.dot(right)
+	return res
+
+def _add(sums, delta, sign):
+	for (name, values) in delta.items():
+		sums[name] += sign * values
+
+## Returns matrix symbols x symbols of statistic from sums, NaN for pairs with
+# less than min_periods common dates
+def _statistic(kind, sums, min_periods):
+	n = np.round(sums['n'])
+	valid = n >= max(min_periods, 1)
+	with np.errstate(divide = 'ignore', invalid = 'ignore'):
+		if kind == 'co-drawdown':
+			res = np.round(sums['dd']) / n
+		else:
+			(sx, sxx) = (sums['sx'], sums['sxx'])
+			cov = sums['sxy'] - sx * sx.T / n
+			var = sxx - sx * sx / n
+			# variance of the first symbol over common dates, variance of the second one is transposed
+			var = np.where(var > 0., var, np.nan)
+			res = np.clip(cov / np.sqrt(var * var.T), -1., 1.)
+			np.fill_diagonal(res, np.where(np.isnan(np.diag(res)), np.nan, 1.))
+	return np.where(valid, res, np.nan)
+
+## Returns list of pairs (begin, end) of rows of rolling windows, see
+# Correlation.rolling
+def _window_bounds(date_ns, window_ns, step_ns):
+	if not len(date_ns):
+		return []
+	ends = np.unique(np.searchsorted(date_ns, np.arange(date_ns[-1], date_ns[0] + window_ns - 1, -step_ns), side='right'))
+	# window ends at the last date before its nominal end
+	begins = np.searchsorted(date_ns, date_ns[ends - 1] - window_ns, side='right')
+	return [(int(begin), int(end)) for (begin, end) in zip(begins, ends)]
+
+################################################################################
@@ -0,0 +1,439 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+################################################################################
+
+import numpy as np
+import pandas as pd
+import argparse
+import concurrent.futures
+import datetime
+import http.server
+import json
+import os
+import socketserver
+import threading
+import time
+import urllib.parse
+import requests
+import requests.adapters
+import common
+import stock
+
+################################################################################
+
+## AlphaVantage functions: Name -> (function, response key)
+FUNCTIONS = {'daily': ('TIME_SERIES_DAILY', 'Time Series (Daily)')
+	, 'daily_adjusted': ('TIME_SERIES_DAILY_ADJUSTED', 'Time Series (Daily)')
+	, 'weekly': ('TIME_SERIES_WEEKLY', 'Weekly Time Series')
+	, 'weekly_adjusted': ('TIME_SERIES_WEEKLY_ADJUSTED', 'Weekly Adjusted Time Series')
+	, 'monthly': ('TIME_SERIES_MONTHLY', 'Monthly Time Series')
+	, 'monthly_adjusted': ('TIME_SERIES_MONTHLY_ADJUSTED', 'Monthly Adjusted Time Series')}
+
+## Default requests budget of free AlphaVantage API key
+REQUESTS_PER_MINUTE = 5
+
+## Default number of retries of rate limited or failed request
+RETRIES = 5
+
+## Default back-off in seconds after rate limited request, doubled on every retry
+BACKOFF = 15.
+
+## Number of bars in 'compact' output of daily time series
+COMPACT_BARS = 100
+
+## Number of stored bars compared with downloaded ones to detect adjustment of
+# history (splits, dividends) during sync
+OVERLAP_BARS = 5
+
+################################################################################
+
+## Spreads requests evenly to fit requests per minute budget. It is shared
+# by all threads of one fetch.
+class RateLimiter:
+	interval = None  # seconds between requests, 0 - no limit
+
+	__next = None
+	__lock = None
+
+	## @param[in] requests_per_minute -- requests budget, None or 0 - no limit
+	def __init__(self, requests_per_minute):
+		self.interval = 60. / requests_per_minute if requests_per_minute else 0.
+		self.__next = time.monotonic()
+		self.__lock = threading.Lock()
+
+	## Blocks until the next request is allowed
+	def wait(self):
+		with self.__lock:
+			now = time.monotonic()
+			at = max(now, self.__next)
+			self.__next = at + self.interval
+		if at > now:
+			time.sleep(at - now)
+
+	## Postpones all following requests for specified number of seconds
+	def pause(self, seconds):
+		with self.__lock:
+			self.__next = max(self.__next, time.monotonic() + seconds)
+
+#-------------------------------------------------------------------------------
+
+## Returns True if AlphaVantage refused request because of call frequency
+#
+# @param[in] r -- requests.Response
+def is_rate_limited(r):
+	if r.status_code in (429, 503):
+		return True
+	if r.status_code != 200:
+		return False
+	try:
+		data = r.json()
+	except ValueError:
+		return False
+	return isinstance(data, dict) and ('Note' in data or 'Information' in data) and not any('Time Series' in k for k in data)
+
+
+## Downloads and parses time series of one symbol. Returns dictionary
+# Column -> array (see function stock.parse_time_series_columns) or error
+# in the same form as methods of stock.AlphaVantage do.
+#
+# @param[in] av          -- stock.AlphaVantage
+# @param[in] limiter     -- RateLimiter
+# @param[in] symbol      -- target symbol
+# @param[in] function    -- key of FUNCTIONS. Default: 'daily_adjusted'
+# @param[in] outputsize  -- 'full' or 'compact', used by daily functions only. Default: 'full'
+# @param[in] retries     -- number of retries. Default: RETRIES
+# @param[in] backoff     -- back-off in seconds, doubled on every retry. Default: BACKOFF
+def fetch_symbol(av, limiter, symbol, function = 'daily_adjusted', outputsize = 'full', retries = RETRIES, backoff = BACKOFF):
+	(av_function, response_key) = FUNCTIONS[function]
+	params = {'outputsize': outputsize} if function.startswith('daily') else {}
+	for attempt in range(retries + 1):
+		limiter.wait()
+		try:
+			r = av.query(av_function, symbol, **params)
+		except requests.RequestException as exc:
+			if attempt == retries:
+				return ('error', exc, None)
+			limiter.pause(backoff * 2 ** attempt)
+			continue
+		if is_rate_limited(r) and attempt < retries:
+			limiter.pause(backoff * 2 ** attempt)
+			continue
+		if r.status_code != 200:
+			return 'Status code: %i' % r.status_code
+		data = r.json()
+		if 'Error Message' in data:
+			return data
+		try:
+			return stock.parse_time_series_columns(data[response_key])
+		except Exception as exc:
+			return ('error', exc, data)
+
+
+## Saves parsed time series to "<history_dir>/<symbol>.csv" in the layout
+# of history CSV files. File is replaced atomically. See function
+# common.save_history_file.
+#
+# @param[in] history_dir -- target directory
+# @param[in] symbol      -- target symbol
+# @param[in] columns     -- result of function stock.parse_time_series_columns
+def save_history(history_dir, symbol, columns):
+	common.save_history_file(os.path.join(history_dir, symbol + '.csv'), symbol, columns)
+
+
+## Downloads time series of many symbols concurrently. Connections are reused
+# by pooled session, requests are spread to fit requests per minute budget,
+# rate limited requests are retried with back-off. Every result is saved (and
+# passed to on_result) as soon as it arrives, so memory does not grow with
+# number of symbols.
+# Returns dictionary Symbol -> 'OK' or error. See function stock.ok(response).
+#
+# @param[in] symbols             -- list of symbols
+# @param[in] function            -- key of FUNCTIONS. Default: 'daily_adjusted'
+# @param[in] history_dir         -- directory to save CSV files to, None - do not save. Default: None
+# @param[in] outputsize          -- 'full' or 'compact', used by daily functions only. Default: 'full'
+# @param[in] workers             -- number of concurrent requests. Default: 4
+# @param[in] requests_per_minute -- requests budget, None - no limit. Default: REQUESTS_PER_MINUTE
+# @param[in] url                 -- query URL. Default: stock.AlphaVantage.URL
+# @param[in] apikey              -- AlphaVantage API key. Default: stock.ALPHA_VANTAGE_APIKEY
+# @param[in] retries             -- number of retries. Default: RETRIES
+# @param[in] backoff             -- back-off in seconds, doubled on every retry. Default: BACKOFF
+# @param[in] on_result           -- function (symbol, result) called for every symbol, result is the
+#                                   value of function fetch_symbol. Default: None
+def fetch(symbols, function = 'daily_adjusted', history_dir = None, outputsize = 'full', workers = 4
+		, requests_per_minute = REQUESTS_PER_MINUTE, url = stock.AlphaVantage.URL, apikey = stock.ALPHA_VANTAGE_APIKEY
+		, retries = RETRIES, backoff = BACKOFF, on_result = None):
+	if history_dir:
+		os.makedirs(history_dir, exist_ok=True)
+	limiter = RateLimiter(requests_per_minute)
+	statuses = {}
+	with requests.Session() as session:
+		adapter = requests.adapters.HTTPAdapter(pool_connections = 1, pool_maxsize = workers)
+		session.mount('http://', adapter)
+		session.mount('https://', adapter)
+		av = stock.AlphaVantage(apikey, url, session)
+		with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+			futures = dict((executor.submit(fetch_symbol, av, limiter, symbol, function, outputsize, retries, backoff), symbol) for symbol in symbols)
+			for future in concurrent.futures.as_completed(futures):
+				symbol = futures.pop(future)
+				try:
+					result = future.result()
+				except Exception as exc:
+					result = ('error', exc, None)
+				if isinstance(result, dict) and 'date' in result:
+					if history_dir:
+						save_history(history_dir, symbol, result)
+					statuses[symbol] = 'OK'
+				else:
+					statuses[symbol] = result
+				if on_result is not None:
+					on_result(symbol, result)
+	return statuses
+
+#-------------------------------------------------------------------------------
+
+## Brings history CSV files up to date downloading only missing bars.
+# For every symbol the last stored date is read from "<history_dir>/<symbol>.csv"
+# and 'compact' output is requested if it covers the gap, 'full' otherwise.
+# New bars are appended to the file. If the stored bars differ from the
+# downloaded ones (history was adjusted because of split or dividend) or
+# the gap is not covered, 'full' output is downloaded and the file is
+# replaced. Weekly and monthly time series are always downloaded in full.
+# Returns dictionary Symbol -> pair (output size, number of new bars) or error.
+#
+# @param[in] symbols             -- list of symbols
+# @param[in] history_dir         -- directory with CSV files
+# @param[in] function            -- key of FUNCTIONS. Default: 'daily_adjusted'
+# @param[in] today               -- current date. Default: None - datetime.date.today()
+# @param[in] workers             -- number of concurrent requests. Default: 4
+# @param[in] requests_per_minute -- requests budget, None - no limit. Default: REQUESTS_PER_MINUTE
+# @param[in] url                 -- query URL. Default: stock.AlphaVantage.URL
+# @param[in] apikey              -- AlphaVantage API key. Default: stock.ALPHA_VANTAGE_APIKEY
+# @param[in] retries             -- number of retries. Default: RETRIES
+# @param[in] backoff             -- back-off in seconds, doubled on every retry. Default: BACKOFF
+# @param[in] on_result           -- function (symbol, result) called for every symbol. Default: None
+def sync(symbols, history_dir, function = 'daily_adjusted', today = None, workers = 4
+		, requests_per_minute = REQUESTS_PER_MINUTE, url = stock.AlphaVantage.URL, apikey = stock.ALPHA_VANTAGE_APIKEY
+		, retries = RETRIES, backoff = BACKOFF, on_result = None):
+	os.makedirs(history_dir, exist_ok=True)
+	today = today or datetime.date.today()
+	limiter = RateLimiter(requests_per_minute)
+	results = {}
+	with requests.Session() as session:
+		adapter = requests.adapters.HTTPAdapter(pool_connections = 1, pool_maxsize = workers)
+		session.mount('http://', adapter)
+		session.mount('https://', adapter)
+		av = stock.AlphaVantage(apikey, url, session)
+		with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+			futures = dict((executor.submit(sync_symbol, av, limiter, history_dir, symbol, function, today, retries, backoff), symbol) for symbol in symbols)
+			for future in concurrent.futures.as_completed(futures):
+				symbol = futures.pop(future)
+				try:
+					results[symbol] = future.result()
+				except Exception as exc:
+					results[symbol] = ('error', exc, None)
+				if on_result is not None:
+					on_result(symbol, results[symbol])
+	return results
+
+
+## Returns True if result of function sync_symbol is not an error
+def is_synced(result):
+	return type(()) == type(result) and len(result) == 2
+
+## Brings history CSV file of one symbol up to date. See function sync.
+# Returns pair (output size, number of new bars) or error.
+#
+# @param[in] av          -- stock.AlphaVantage
+# @param[in] limiter     -- RateLimiter
+# @param[in] history_dir -- directory with CSV files
+# @param[in] symbol      -- target symbol
+# @param[in] function    -- key of FUNCTIONS. Default: 'daily_adjusted'
+# @param[in] today       -- current date. Default: None - datetime.date.today()
+# @param[in] retries     -- number of retries. Default: RETRIES
+# @param[in] backoff     -- back-off in seconds, doubled on every retry. Default: BACKOFF
+def sync_symbol(av, limiter, history_dir, symbol, function = 'daily_adjusted', today = None, retries = RETRIES, backoff = BACKOFF):
+	path = os.path.join(history_dir, symbol + '.csv')
+	stored = stored_bars(path)
+	outputsize = 'full'
+	if stored is not None and len(stored) and function.startswith('daily'):
+		gap = np.busday_count(stored.index.values[-1].astype('datetime64[D]'), np.datetime64(today or datetime.date.today(), 'D'))
+		if gap <= COMPACT_BARS - OVERLAP_BARS:
+			outputsize = 'compact'
+	columns = fetch_symbol(av, limiter, symbol, function, outputsize, retries, backoff)
+	if outputsize == 'compact' and isinstance(columns, dict) and 'date' in columns and not __overlaps(stored, columns):
+		outputsize = 'full'
+		columns = fetch_symbol(av, limiter, symbol, function, outputsize, retries, backoff)
+	if not (isinstance(columns, dict) and 'date' in columns):
+		return columns
+	last = stored.index.values[-1] if stored is not None and len(stored) else None
+	new = (columns['date'] > last) if last is not None else np.ones(len(columns['date']), dtype=bool)
+	if outputsize == 'full':
+		save_history(history_dir, symbol, columns)
+	elif new.any():
+		order = np.argsort(columns['date'][new], kind='mergesort')
+		bars = pd.DataFrame(dict((name, columns[name][new][order]) for name in ['open', 'close', 'volume', 'high', 'low'])
+			, index = pd.DatetimeIndex(columns['date'][new][order]))
+		common.append_history_file(path, symbol, bars)
+	return (outputsize, int(new.sum()))
+
+
+## Returns DataFrame with 'open' and 'close' prices of the last stored bars
+# indexed by date or None if file does not exist.
+#
+# @param[in] file_path -- path to CSV file. Example: "/history/ADBE.csv"
+# @param[in] bars      -- number of bars. Default: OVERLAP_BARS
+def stored_bars(file_path, bars = OVERLAP_BARS):
+	if not os.path.isfile(file_path):
+		return None
+	df = pd.read_csv(file_path, usecols = ['date', 'open', 'close'])
+	df.index = pd.DatetimeIndex(df['date'].values.astype('datetime64[D]'))
+	return df[['open', 'close']].sort_index()[-bars:]
+
+def __overlaps(stored, columns, rtol = 1e-6):
+	dates = stored.index.values.astype(columns['date'].dtype)
+	if not len(columns['date']) or columns['date'].min() > dates[0]:
+		return False
+	order = np.argsort(columns['date'])
+	i = order[np.minimum(np.searchsorted(columns['date'], dates, sorter = order), len(order) - 1)]
+	if not (columns['date'][i] == dates).all():
+		return False
+	return bool(np.allclose(columns['open'][i], stored['open'].values, rtol = rtol)
+		and np.allclose(columns['close'][i], stored['close'].values, rtol = rtol))
+
+#===============================================================================
+
+## Local HTTP server answering AlphaVantage queries by recorded responses.
+# Use its url as url argument of function fetch or stock.AlphaVantage.
+class FixtureServer:
+	url = None        # query URL
+	requests = None   # number of served requests
+	bytes = None      # number of sent bytes of response bodies
+	responses = None  # dictionary Symbol -> JSON response
+
+	__server = None
+	__thread = None
+
+	## Starts server in background thread.
+	#
+	# @param[in] responses  -- dictionary Symbol -> recorded AlphaVantage JSON response
+	# @param[in] latency    -- delay of every response in seconds. Default: 0
+	# @param[in] rate_limit -- answer by "Note" response if rate_limit requests were already
+	#                          served during last minute, None - no limit. Default: None
+	def __init__(self, responses, latency = 0., rate_limit = None):
+		self.responses = responses
+		self.requests = 0
+		self.bytes = 0
+		lock = threading.Lock()
+		served = []
+		fixtures = self
+
+		class Handler(http.server.BaseHTTPRequestHandler):
+			def do_GET(self):
+				query = dict(urllib.parse.parse_qsl(urllib.parse.urlparse(self.path).query))
+				now = time.monotonic()
+				with lock:
+					fixtures.requests += 1
+					served[:] = [t for t in served if now - t < 60.]
+					limited = rate_limit is not None and len(served) >= rate_limit
+					if not limited:
+						served.append(now)
+				time.sleep(latency)
+				if limited:
+					data = {'Note': 'Thank you for using Alpha Vantage! Our standard API call frequency is %i calls per minute.' % rate_limit}
+				elif query.get('symbol') in fixtures.responses:
+					data = fixtures.responses[query['symbol']]
+					if query.get('outputsize') == 'compact':
+						data = _compact(data)
+				else:
+					data = {'Error Message': 'Invalid API call. Please retry or visit the documentation (https://www.alphavantage.co/documentation/) for TIME_SERIES_DAILY.'}
+				body = json.dumps(data).encode()
+				with lock:
+					fixtures.bytes += len(body)
+				self.send_response(200)
+				self.send_header('Content-Type', 'application/json')
+				self.send_header('Content-Length', str(len(body)))
+				self.end_headers()
+				self.wfile.write(body)
+
+			def log_message(self, format, *args):
+				pass
+
+		self.__server = _ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+		self.url = 'http://127.0.0.1:%i/query' % self.__server.server_address[1]
+		self.__thread = threading.Thread(target = self.__server.serve_forever, daemon = True)
+		self.__thread.start()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+	## Stops server
+	def close(self):
+		self.__server.shutdown()
+		self.__server.server_close()
+		self.__thread.join()
+
+
+## Returns dictionary Symbol -> response for recorded responses. Symbol is
+# taken from response meta data, file name without extension otherwise.
+#
+# @param[in] fixtures -- dictionary File name -> response. See function benchmark.load_fixtures
+def fixture_responses(fixtures):
+	responses = {}
+	for (name, response) in fixtures.items():
+		symbol = response.get('Meta Data', {}).get('2. Symbol') or os.path.splitext(name)[0]
+		responses[symbol] = response
+	return responses
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+	daemon_threads = True
+
+def _compact(response, size = 100):
+	res = {}
+	for (key, value) in response.items():
+		res[key] = dict(sorted(value.items(), reverse = True)[:size]) if 'Time Series' in key else value
+	return res
+
+#===============================================================================
+
+def main():
+	parser = argparse.ArgumentParser(description = 'Concurrent download of AlphaVantage time series')
+	parser.add_argument('symbols', nargs = '*', help = 'symbols to download')
+	parser.add_argument('--symbols-file', help = 'file with one symbol per line')
+	parser.add_argument('--function', choices = sorted(FUNCTIONS), default = 'daily_adjusted', help = 'time series. Default: daily_adjusted')
+	parser.add_argument('--output', default = 'history_daily', help = 'directory to save CSV files to. Default: history_daily')
+	parser.add_argument('--outputsize', choices = ['full', 'compact'], default = 'full', help = 'output size of daily time series. Default: full')
+	parser.add_argument('--workers', type = int, default = 4, help = 'number of concurrent requests. Default: 4')
+	parser.add_argument('--rpm', type = int, default = REQUESTS_PER_MINUTE, help = 'requests per minute, 0 - no limit. Default: %i' % REQUESTS_PER_MINUTE)
+	parser.add_argument('--url', default = stock.AlphaVantage.URL, help = 'query URL. Default: %s' % stock.AlphaVantage.URL)
+	parser.add_argument('--sync', action = 'store_true', help = 'download only bars missing in output directory, see function sync')
+	args = parser.parse_args()
+	symbols = list(args.symbols)
+	if args.symbols_file:
+		with open(args.symbols_file) as f:
+			symbols += [s.strip() for s in f if s.strip()]
+	done = []
+	def on_result(symbol, result):
+		done.append(symbol)
+		if is_synced(result):
+			res = 'OK, %s, %i new bars' % result
+		else:
+			res = 'OK' if isinstance(result, dict) and 'date' in result else (result if type('') == type(result) else 'FAIL')
+		print('[%i/%i] Loading symbol "%s" - "%s"' % (len(done), len(symbols), symbol, res))
+	begin = time.perf_counter()
+	if args.sync:
+		results = sync(symbols, args.output, args.function, None, args.workers, args.rpm or None, args.url, on_result = on_result)
+		loaded = sum(is_synced(r) for r in results.values())
+	else:
+		statuses = fetch(symbols, args.function, args.output, args.outputsize, args.workers, args.rpm or None, args.url, on_result = on_result)
+		loaded = sum(s == 'OK' for s in statuses.values())
+	elapsed = time.perf_counter() - begin
+	print('%i of %i symbols loaded in %.1f s (%.2f symbols/s)' % (loaded, len(symbols), elapsed, len(symbols) / max(elapsed, 1e-9)))
+
+#===============================================================================
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,327 @@
+# -*- coding: utf-8 -*-
+
+################################################################################
+
+# Opt-in instrumentation of pipeline stages. Entry points of modules common,
+# moving and render are decorated by function stage. While recording is
+# enabled (see functions enable and recording) every call of a stage records
+# wall time, number of processed rows, symbol and optionally peak memory.
+# Disabled stages cost one flag check per call.
+#
+# Example:
+#   with instrument.recording():
+#       history = common.load_history('history')
+#       common.enrich(history, workers = 1)
+#   instrument.summary()
+#   instrument.export_chrome_trace('trace.json')
+#
+# Stages running in worker processes (for example common.enrich with several
+# workers) are not recorded, only the calling stage is.
+
+import numpy as np
+import pandas as pd
+import collections.abc
+import functools
+import inspect
+import json
+import os
+import threading
+import time
+import tracemalloc
+
+################################################################################
+
+## Columns of DataFrame returned by function records
+RECORD_COLUMNS = ['stage', 'symbol', 'begin', 'time', 'self time', 'rows', 'peak memory', 'depth', 'parent', 'thread']
+
+__enabled = False
+__memory = False
+__tracing = False
+__records = []
+__symbols = {}
+__local = threading.local()
+
+#-------------------------------------------------------------------------------
+
+## Starts recording of stages
+#
+# @param[in] memory -- trace peak memory of every stage by tracemalloc. It slows down stages a lot. Default: False
+def enable(memory = False):
+	global __enabled, __memory, __tracing
+	__memory = memory
+	if memory and not tracemalloc.is_tracing():
+		tracemalloc.start()
+		__tracing = True
+	__enabled = True
+
+## Stops recording of stages. Recorded stages are kept, see function reset.
+def disable():
+	global __enabled, __memory, __tracing
+	__enabled = False
+	if __tracing:
+		tracemalloc.stop()
+		__tracing = False
+	__memory = False
+
+## Returns True if recording is enabled
+def is_enabled():
+	return __enabled
+
+## Removes recorded stages
+def reset():
+	del __records[:]
+	__symbols.clear()
+
+## Context manager recording stages inside it
+#
+# @param[in] memory -- trace peak memory of every stage, see function enable. Default: False
+# @param[in] clear  -- remove previously recorded stages. Default: True
+class recording:
+	def __init__(self, memory = False, clear = True):
+		self.memory = memory
+		self.clear = clear
+
+	def __enter__(self):
+		if self.clear:
+			reset()
+		enable(self.memory)
+		return self
+
+	def __exit__(self, *exc):
+		disable()
+		return False
+
+#-------------------------------------------------------------------------------
+
+## Decorator of stage function. Stage name is 'module.function' by default.
+# Number of rows is taken from the first argument being DataFrame, array or
+# dictionary Symbol -> DataFrame, otherwise from result. Symbol is taken from
+# 'symbol' argument, from DataFrame argument being a value of dictionary
+# passed to enclosing stage, from 'file_path' argument (file name) or from
+# enclosing stage or symbol context (see function symbol).
+#
+# @param[in] name -- stage name. Default: None - 'module.function'
+def stage(name = None):
+	def decorator(f):
+		stage_name = name or '%s.%s' % (f.__module__, f.__name__.lstrip('_'))
+		parameters = list(inspect.signature(f).parameters)
+		symbol_n = parameters.index('symbol') if 'symbol' in parameters else None
+		file_n = parameters.index('file_path') if 'file_path' in parameters else None
+
+		@functools.wraps(f)
+		def wrapper(*args, **kwargs):
+			if not __enabled:
+				return f(*args, **kwargs)
+			return __call(stage_name, f, args, kwargs, symbol_n, file_n)
+		return wrapper
+	return decorator
+
+## Context manager setting symbol of stages called inside it. Costs nothing
+# when recording is disabled.
+#
+# @param[in] name -- symbol
+def symbol(name):
+	return _Symbol(name, __stack()) if __enabled else __NO_SYMBOL
+
+class _Symbol:
+	def __init__(self, name, stack):
+		self.name = name
+		self.stack = stack
+
+	def __enter__(self):
+		self.stack.append(('', self.name, None))
+		return self
+
+	def __exit__(self, *exc):
+		self.stack.pop()
+		return False
+
+class _NoSymbol:
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		return False
+
+__NO_SYMBOL = _NoSymbol()
+
+def __stack():
+	if not hasattr(__local, 'stack'):
+		__local.stack = []
+	return __local.stack
+
+def __call(stage_name, f, args, kwargs, symbol_n, file_n):
+	stack = __stack()
+	parent = next((entry for entry in reversed(stack) if entry[2] is not None), None)
+	history = next((value for value in list(args) + list(kwargs.values()) if __is_history(value)), None)
+	symbol_name = __symbol(args, kwargs, symbol_n, file_n, stack)
+	rows = __rows(history[symbol_name] if history is not None and symbol_name in history else next((value for value in args if __rows(value) is not None), None))
+	registered = []
+	if history is not None:
+		registered = [id(h) for h in history.values() if id(h) not in __symbols]
+		__symbols.update((id(h), s) for (s, h) in history.items() if id(h) not in __symbols)
+
+	record = {'stage': stage_name, 'symbol': symbol_name, 'rows': rows, 'depth': len([entry for entry in stack if entry[2] is not None])
+		, 'parent': parent[2] if parent else -1, 'thread': threading.get_ident(), 'peak memory': None}
+	__records.append(record)
+	n = len(__records) - 1
+	stack.append((stage_name, symbol_name, n))
+	peaks = getattr(__local, 'peaks', None)
+	if __memory:
+		(current, peak) = tracemalloc.get_traced_memory()
+		if peaks:
+			peaks[-1] = max(peaks[-1], peak)
+		__local.peaks = (peaks or []) + [current]
+		record['memory begin'] = current
+		if hasattr(tracemalloc, 'reset_peak'):
+			tracemalloc.reset_peak()
+	begin = time.perf_counter()
+	try:
+		res = f(*args, **kwargs)
+	finally:
+		record['begin'] = begin
+		record['time'] = time.perf_counter() - begin
+		stack.pop()
+		for i in registered:
+			del __symbols[i]
+		if __memory and tracemalloc.is_tracing() and __local.peaks:
+			peak = max(__local.peaks.pop(), tracemalloc.get_traced_memory()[1])
+			record['peak memory'] = peak - record.pop('memory begin')
+			if __local.peaks:
+				__local.peaks[-1] = max(__local.peaks[-1], peak)
+	if record['rows'] is None:
+		record['rows'] = __rows(res)
+	return res
+
+def __is_history(value):
+	return isinstance(value, collections.abc.Mapping) and len(value) > 0 and isinstance(next(iter(value.values())), pd.DataFrame)
+
+def __rows(value):
+	if isinstance(value, (pd.DataFrame, pd.Series, np.ndarray)):
+		return len(value)
+	if __is_history(value):
+		return sum(len(h) for h in value.values())
+	return None
+
+def __symbol(args, kwargs, symbol_n, file_n, stack):
+	if 'symbol' in kwargs:
+		return kwargs['symbol']
+	if symbol_n is not None and symbol_n < len(args):
+		return args[symbol_n]
+	for value in list(args) + list(kwargs.values()):
+		if isinstance(value, pd.DataFrame) and id(value) in __symbols:
+			return __symbols[id(value)]
+	file_path = kwargs.get('file_path', args[file_n] if file_n is not None and file_n < len(args) else None)
+	if isinstance(file_path, str):
+		return os.path.splitext(os.path.basename(file_path))[0]
+	return stack[-1][1] if stack else None
+
+#-------------------------------------------------------------------------------
+
+## Returns recorded stages as DataFrame with columns RECORD_COLUMNS, row per
+# call in order of calls:
+# - 'begin' and 'time' are start time and duration in seconds
+# - 'self time' is duration without nested stages
+# - 'rows' is number of processed rows, NaN if unknown
+# - 'peak memory' is peak of memory allocated during the call in bytes, NaN if not traced
+# - 'depth' and 'parent' are nesting level and row number of enclosing stage (-1 for top level stages)
+def records():
+	positions = [n for (n, r) in enumerate(__records) if 'time' in r]
+	res = pd.DataFrame([__records[n] for n in positions], index = positions, columns = RECORD_COLUMNS)
+	if not len(res):
+		return res
+	res['rows'] = res['rows'].astype(float)
+	res['peak memory'] = res['peak memory'].astype(float)
+	nested = res['parent'].values >= 0
+	children = np.zeros(len(__records))
+	np.add.at(children, res['parent'].values[nested], res['time'].values[nested])
+	res['self time'] = res['time'].values - children[res.index.values]
+	res['begin'] -= res['begin'].min()
+	return res
+
+## Returns summary table of recorded stages sorted by total time: 'calls',
+# 'time', 'self time', 'max time', 'rows', 'rows/s' and 'peak memory' for
+# every group.
+#
+# @param[in] by -- grouping: 'stage', 'symbol' or ['stage', 'symbol']. Default: 'stage'
+def summary(by = 'stage'):
+	return __summary(records(), by)
+
+## Returns the slowest symbols of stage: summary table by symbol (see function
+# summary) for calls of one stage.
+#
+# @param[in] stage_name -- stage name. Example: 'common.enrich_arrays'
+# @param[in] n          -- number of symbols. Default: 10
+def outliers(stage_name, n = 10):
+	res = records()
+	if len(res):
+		res = res[(res['stage'] == stage_name) & res['symbol'].notnull()]
+	return __summary(res, 'symbol').head(n)
+
+__SUMMARY_COLUMNS = ['calls', 'time', 'self time', 'max time', 'rows', 'rows/s', 'peak memory']
+
+def __summary(res, by):
+	if not len(res):
+		return pd.DataFrame(columns = __SUMMARY_COLUMNS)
+	groups = res.groupby(by, sort = False)
+	table = pd.DataFrame({'calls': groups.size()
+		, 'time': groups['time'].sum()
+		, 'self time': groups['self time'].sum()
+		, 'max time': groups['time'].max()
+		, 'rows': groups['rows'].sum(min_count = 1)
+		, 'peak memory': groups['peak memory'].max()}
+		, columns = __SUMMARY_COLUMNS)
+	table['rows/s'] = table['rows'] / table['time']
+	return table.sort_values('time', ascending = False)
+
+#-------------------------------------------------------------------------------
+
+## Writes recorded stages to JSON file in Chrome trace event format. It can be
+# opened by chrome://tracing, Perfetto or speedscope.
+#
+# @param[in] file_path -- path to output file. Example: "trace.json"
+def export_chrome_trace(file_path):
+	res = records()
+	events = []
+	for r in res.itertuples(index = False):
+		args = {'rows': None if np.isnan(r.rows) else int(r.rows)}
+		if r.symbol is not None:
+			args['symbol'] = r.symbol
+		if not np.isnan(r[RECORD_COLUMNS.index('peak memory')]):
+			args['peak memory'] = int(r[RECORD_COLUMNS.index('peak memory')])
+		name = r.stage if r.symbol is None else '%s %s' % (r.stage, r.symbol)
+		events.append({'name': name, 'cat': r.stage, 'ph': 'X', 'ts': r.begin * 1e6, 'dur': r.time * 1e6
+			, 'pid': os.getpid(), 'tid': r.thread, 'args': args})
+	with open(file_path, 'w') as f:
+		json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+## Writes recorded stages to JSON file in speedscope evented format, profile
+# per thread. See https://www.speedscope.app
+#
+# @param[in] file_path -- path to output file. Example: "profile.speedscope.json"
+def export_speedscope(file_path):
+	res = records()
+	frames = {}
+	profiles = []
+	for (thread, calls) in res.groupby('thread', sort = False):
+		events = []
+		open_calls = []
+		for (n, r) in zip(calls.index, calls.itertuples(index = False)):
+			while open_calls and open_calls[-1][0] != r.parent:
+				events.append({'type': 'C', 'frame': open_calls[-1][1], 'at': open_calls[-1][2]})
+				open_calls.pop()
+			frame = frames.setdefault(r.stage, len(frames))
+			events.append({'type': 'O', 'frame': frame, 'at': r.begin})
+			open_calls.append((n, frame, r.begin + r.time))
+		while open_calls:
+			events.append({'type': 'C', 'frame': open_calls[-1][1], 'at': open_calls[-1][2]})
+			open_calls.pop()
+		profiles.append({'type': 'evented', 'name': 'thread %i' % thread, 'unit': 'seconds'
+			, 'startValue': events[0]['at'], 'endValue': max(e['at'] for e in events), 'events': events})
+	with open(file_path, 'w') as f:
+		json.dump({'$schema': 'https://www.speedscope.app/file-format-schema.json'
+			, 'shared': {'frames': [{'name': name} for name in sorted(frames, key = frames.get)]}
+			, 'profiles': profiles
+			, 'exporter': 'instrument.py'}, f)
+
+################################################################################
@@ -3,58 +3,194 @@
 ################################################################################
 
 import numpy as np
+import pandas as pd
 import sys
+import instrument
 
 ################################################################################
 
+DAY_NS = 24 * 3600 * 10**9
+
+## Returns positions of moving windows for all rows of prices history at once.
+# Window ends at every row. Window begins at the row which date is nearest to
+# (end date - window size), if there are two such rows then the earlier one 
+# is taken. Window is closed if history contains enough items for filling 
+# entire window, begin of open window is the first row.
+# Returns triplet of arrays (begin, end, closed). If list of window sizes 
+# is specified then arrays are 2-D: rows x windows.
+#
+# @param[in] date_ns     -- sorted int64 array of dates in ns since epoch
+# @param[in] window_size -- window size in days or list of window sizes
+# @param[in] since       -- first row to find window ending at. Default: 0
+@instrument.stage()
+def window_positions(date_ns, window_size, since = 0):
+	window_size = np.asarray(window_size)
+	n = len(date_ns)
+	shape = (n - since,) + (1,) * window_size.ndim
+	end = np.arange(since, n).reshape(shape)
+	dates = date_ns[since:].reshape(shape)
+	prev = np.searchsorted(date_ns, dates - np.ceil(window_size).astype(np.int64) * DAY_NS, side='right') - 1
+	end = np.broadcast_to(end, prev.shape).copy()
+	prev = np.minimum(prev, end - 1)
+	closed = prev >= 0
+	prev = np.maximum(prev, 0)
+	current = np.minimum(prev + 1, end)
+	days_from_current = np.abs((dates - date_ns[current]) // DAY_NS - window_size)
+	days_from_prev = np.abs((dates - date_ns[prev]) // DAY_NS - window_size)
+	begin = np.where(days_from_current < days_from_prev, current, prev)
+	begin[~closed] = 0
+	return (begin, end, closed)
+
+## Returns int64 array of dates in ns since epoch for prices history
+#
+# @param[in] history -- DataFrame with prices history
+def date_ns(history):
+	return history.index.values.astype('datetime64[ns]').view('i8')
+
+
 ## Returns list of windows for target prices history and window size.
 # Every window represented by triplet (begin_date, end_date, window_is_closed).
 #
 # @param[in] history	 -- DataFrame with prices history
 # @param[in] window_size -- window size in days
+@instrument.stage()
 def get_windows(history, window_size):
-	return __get_windows([*history.index], window_size)
-
-def __get_windows(history_index, window_size):
-	opened_windows = []	
-	closed_windows_cnt = 0
-	windows = []
-	for row_n in range(len(history_index) - 1, -1, -1):
-		current_date = history_index[row_n]
-		opened_windows.append(current_date)
-
-		prev_date = history_index[row_n-1] if row_n > 0 else current_date		
-		for window_end in opened_windows[closed_windows_cnt:]:
-			if (window_end - prev_date).days < window_size:
-				break
-
-			closed_windows_cnt += 1
-			days_from_current_date_to_window_end = abs((window_end - current_date).days - window_size)
-			days_from_prev_date_to_window_end = abs((window_end - prev_date).days - window_size)
-
-			if days_from_current_date_to_window_end < days_from_prev_date_to_window_end:
-				windows.append((current_date, window_end, True))
-			else:
-				windows.append((prev_date, window_end, True))
-
-
-	for window_end in opened_windows[closed_windows_cnt:]:
-		windows.append((history_index[0], window_end, False))
-	
-	windows.reverse()
-	return windows
+	(begin, end, closed) = window_positions(date_ns(history), window_size)
+	return [*zip(history.index[begin], history.index[end], closed.tolist())]
 
 
 ## Applies target function to moving windows on prices history.
-# Returns list of result values. 
+# Returns list of result values. Functions growth_ratio and avg_growth_ratio
+# are evaluated for all windows at once, see functions moving_growth_ratio 
+# and moving_avg_growth_ratio.
 #
 # @param[in] f		   -- function to apply. Example: see function growth_ratio 
 # @param[in] history	 -- DataFrame with prices history
 # @param[in] window_size -- window size in days. Default: 365
+@instrument.stage()
 def moving_f(f, history, window_size = 365):
+	if f is growth_ratio:
+		return moving_growth_ratio(history, window_size).tolist()
+	if f is avg_growth_ratio:
+		return moving_avg_growth_ratio(history, window_size).tolist()
 	return [f(history, begin, end, closed) for (begin, end, closed) in get_windows(history, window_size)]
 
 
+## Returns array of growth ratios for all moving windows on prices history.
+# See functions window_positions and growth_ratio.
+#
+# @param[in] history	 -- DataFrame with prices history
+# @param[in] window_size -- window size in days. Default: 365
+@instrument.stage()
+def moving_growth_ratio(history, window_size = 365):
+	(begin, end, closed) = window_positions(date_ns(history), window_size)
+	return __growth_ratio(history['open'].values, history['close'].values, begin, end, closed)
+
+## Returns array of average growth ratios for all moving windows on prices history.
+# See functions window_positions and avg_growth_ratio.
+#
+# @param[in] history	 -- DataFrame with prices history
+# @param[in] window_size -- window size in days. Default: 365
+# @param[in] avg_period  -- averaging period in days. Defautl: 365
+@instrument.stage()
+def moving_avg_growth_ratio(history, window_size = 365, avg_period = 365):
+	dates = date_ns(history)
+	(begin, end, closed) = window_positions(dates, window_size)
+	ratio = __growth_ratio(history['open'].values, history['close'].values, begin, end, closed)
+	return __avg_growth_ratio(ratio, dates, begin, end, avg_period)
+
+## Metrics supported by function moving_batch:
+# - 'growth_ratio'     -- see function growth_ratio
+# - 'avg_growth_ratio' -- see function avg_growth_ratio
+# - 'min'              -- minimal close price inside the window
+# - 'max'              -- maximal close price inside the window
+METRICS = ['growth_ratio', 'avg_growth_ratio', 'min', 'max']
+
+## Evaluates metrics for moving windows of several sizes in one pass.
+# Window positions for all sizes are found by one searchsorted call.
+# Returns dictionary Metric -> 2-D array rows x windows. Values for 
+# open windows are NaN. See functions window_positions and METRICS.
+#
+# @param[in] history	  -- DataFrame with prices history
+# @param[in] window_sizes -- list of window sizes in days. Example: [30, 90, 180, 270, 360]
+# @param[in] metrics      -- list of metrics to evaluate. Default: ['growth_ratio']
+# @param[in] avg_period   -- averaging period in days for 'avg_growth_ratio'. Defautl: 365
+@instrument.stage()
+def moving_batch(history, window_sizes, metrics = ['growth_ratio'], avg_period = 365):
+	return batch(date_ns(history), history['open'].values, history['close'].values, window_sizes, metrics, avg_period)
+
+## The same as function moving_batch but works with prices arrays.
+#
+# @param[in] date_ns      -- sorted int64 array of dates in ns since epoch
+# @param[in] open_price   -- array of open prices
+# @param[in] close        -- array of close prices
+# @param[in] window_sizes -- list of window sizes in days. Example: [30, 90, 180, 270, 360]
+# @param[in] metrics      -- list of metrics to evaluate. Default: ['growth_ratio']
+# @param[in] avg_period   -- averaging period in days for 'avg_growth_ratio'. Defautl: 365
+# @param[in] since        -- first row to evaluate metrics for. Default: 0
+@instrument.stage()
+def batch(date_ns, open_price, close, window_sizes, metrics = ['growth_ratio'], avg_period = 365, since = 0):
+	unknown = set(metrics) - set(METRICS)
+	if unknown:
+		raise ValueError('Unknown metrics: %s' % ', '.join(sorted(unknown)))
+	(begin, end, closed) = window_positions(date_ns, list(window_sizes), since)
+	res = {}
+	if 'growth_ratio' in metrics or 'avg_growth_ratio' in metrics:
+		ratio = __growth_ratio(open_price, close, begin, end, closed)
+		if 'growth_ratio' in metrics:
+			res['growth_ratio'] = ratio
+		if 'avg_growth_ratio' in metrics:
+			res['avg_growth_ratio'] = __avg_growth_ratio(ratio, date_ns, begin, end, avg_period)
+	if 'min' in metrics:
+		res['min'] = np.where(closed, __range_reduce(np.fmin, close, begin, end), np.nan)
+	if 'max' in metrics:
+		res['max'] = np.where(closed, __range_reduce(np.fmax, close, begin, end), np.nan)
+	return res
+
+## Returns long-format DataFrame with growth ratios for several window sizes.
+# Rows of prices history are repeated for every window, 'growth' column
+# contains metric value and 'growth-window' column contains window size.
+#
+# @param[in] history	  -- DataFrame with prices history
+# @param[in] window_sizes -- list of window sizes in days. Default: [30, 90, 180, 270, 360]
+# @param[in] metric       -- metric to evaluate, see METRICS. Default: 'growth_ratio'
+@instrument.stage()
+def growing_ratios(history, window_sizes = [30, 90, 180, 270, 360], metric = 'growth_ratio'):
+	window_sizes = list(window_sizes)
+	values = moving_batch(history, window_sizes, metrics = [metric])[metric]
+	rows = np.tile(np.arange(len(history)), len(window_sizes))
+	res = pd.DataFrame(index = history.index[rows])
+	if 'datenum' in history:
+		res['datenum'] = history['datenum'].values[rows]
+	res['growth'] = values.T.ravel()
+	res['growth-window'] = np.repeat(np.array(window_sizes, dtype=int), len(history))
+	return res
+
+# Sparse table range query: reduces values[begin:end+1] for every pair of positions.
+def __range_reduce(ufunc, values, begin, end):
+	length = end - begin + 1
+	table = [values]
+	step = 1
+	while step * 2 <= length.max(initial=0):
+		prev = table[-1]
+		table.append(np.concatenate([ufunc(prev[:-step], prev[step:]), prev[-step:]]))
+		step *= 2
+	level = np.floor(np.log2(np.maximum(length, 1))).astype(np.int64)
+	table = np.stack(table)
+	return ufunc(table[level, begin], table[level, end - (1 << level) + 1])
+
+def __growth_ratio(open_price, close, begin, end, closed):
+	open_begin = open_price[begin]
+	valid = closed & (np.abs(open_begin) >= sys.float_info.epsilon)
+	with np.errstate(divide='ignore', invalid='ignore'):
+		return np.where(valid, close[end] / open_begin, np.nan)
+
+def __avg_growth_ratio(ratio, date_ns, begin, end, avg_period):
+	period_in_years = ((date_ns[end] - date_ns[begin]) // DAY_NS) / float(avg_period)
+	with np.errstate(divide='ignore', invalid='ignore'):
+		return np.where(period_in_years > 0, ratio ** (1. / period_in_years), np.nan)
+
+
 ## Returns growth ratio for target moving window. 
 # See function get_windows.
 #
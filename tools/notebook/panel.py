@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+
+################################################################################
+
+import numpy as np
+import pandas as pd
+import common
+
+################################################################################
+
+## Aligned representation of prices history of all symbols. Every field is
+# stored as one matrix dates x symbols, dates are union of dates of all
+# symbols. Matrix cells for dates missing in symbol history are NaN, see mask.
+class Panel:
+	dates = None    # DatetimeIndex of all dates
+	symbols = None  # list of symbols
+	fields = None   # dictionary Field -> 2-D array dates x symbols
+	mask = None     # bool 2-D array dates x symbols, True for dates present in symbol history
+
+	## Builds panel from loaded history.
+	#
+	# @param[in] history -- dictionary Symbol -> Price History DataFrame. See function common.load_history(history_dir)
+	# @param[in] fields  -- list of DataFrame columns to put into panel. Default: all columns
+	def __init__(self, history, fields = None):
+		self.symbols = list(history)
+		if fields is None:
+			fields = list(next(iter(history.values())).columns) if history else []
+		lengths = np.array([len(h) for h in history.values()], dtype=np.int64)
+		date_ns = np.concatenate([h.index.values.astype('datetime64[ns]').view('i8') for h in history.values()]) if history else np.zeros(0, dtype=np.int64)
+		(unique_dates, rows) = np.unique(date_ns, return_inverse=True)
+		columns = np.repeat(np.arange(len(self.symbols)), lengths)
+		self.dates = pd.DatetimeIndex(unique_dates.view('datetime64[ns]'), name='date')
+		self.mask = np.zeros((len(unique_dates), len(self.symbols)), dtype=bool)
+		self.mask[rows, columns] = True
+		self.fields = {}
+		for field in fields:
+			values = np.full(self.mask.shape, np.nan)
+			values[rows, columns] = np.concatenate([h[field].values for h in history.values()])
+			self.fields[field] = values
+
+	def __repr__(self):
+		return 'panel.Panel(%i dates x %i symbols: %s)' % (len(self.dates), len(self.symbols), ', '.join(self.fields))
+
+	## Returns field matrix as DataFrame dates x symbols without copying
+	#
+	# @param[in] field -- field name. Example: 'close'
+	def frame(self, field):
+		return pd.DataFrame(self.fields[field], index=self.dates, columns=self.symbols, copy=False)
+
+	#---------------------------------------------------------------------------
+
+	## Returns row numbers of first dates of symbols history
+	def first_rows(self):
+		return self.mask.argmax(axis=0)
+
+	## Returns first dates of symbols history
+	def first_dates(self):
+		return pd.Series(self.dates[self.first_rows()], index=self.symbols)
+
+	## Returns bool mask of symbols which history started after specified border date.
+	# See function common.younger_than.
+	#
+	# @param[in] date -- border date
+	def younger_than(self, date):
+		return self.first_dates().values > np.datetime64(pd.Timestamp(date))
+
+	## Returns bool mask of symbols which history started before specified border date.
+	# See function common.older_than.
+	#
+	# @param[in] date -- border date
+	def older_than(self, date):
+		return ~self.younger_than(date)
+
+	## Returns pair (rows, symbols) for specified absolute period, where rows is
+	# a slice of dates and symbols is bool mask of symbols which history starts
+	# not later than 31 days after begin of period. No symbols are selected if
+	# no dates are in the period.
+	# See function common.prepare_history_abs_period.
+	#
+	# @param[in] since -- begin of period - pandas.datetime
+	# @param[in] to    -- end of period - pandas.datetime
+	def abs_period(self, since, to):
+		rows = slice(self.dates.searchsorted(since, side='left'), self.dates.searchsorted(to, side='right'))
+		mask = self.mask[rows]
+		if not len(mask):
+			return (rows, np.zeros(len(self.symbols), dtype=bool))
+		present = mask.any(axis=0)
+		first_dates = self.dates[rows][mask.argmax(axis=0)]
+		return (rows, present & ((first_dates - pd.Timestamp(since)).days <= 31))
+
+	## Returns bool mask dates x symbols for specified relative period.
+	# See function common.prepare_history_period.
+	#
+	# @param[in] since -- begin of period - float between 0.0 and 1.0. Default: 0.0
+	# @param[in] to    -- end of period - float between 0.0 and 1.0. Default: 1.0
+	def period_mask(self, since = 0., to = 1.):
+		row_n = np.cumsum(self.mask, axis=0) - 1
+		lengths = self.mask.sum(axis=0)
+		begin_n = (lengths * since).astype(np.int64)
+		end_n = (lengths * to).astype(np.int64)
+		end_n[end_n == 0] = lengths[end_n == 0]
+		return self.mask & (row_n >= begin_n) & (row_n < end_n)
+
+	#---------------------------------------------------------------------------
+
+	## Appends 'price-ratio', 'max-prev', 'price-drop', 'drop-period' and
+	# 'drop-min' fields computed column-wise for all symbols at once. Values
+	# are the same as ones of function common.drawdown for every symbol.
+	#
+	# @param[in] mask -- bool mask dates x symbols of rows to use, for example
+	#                    see function period_mask. Default: None - all rows
+	def append_drawdown_fields(self, mask = None):
+		mask = self.mask if mask is None else mask & self.mask
+		mask_t = mask.T
+		start = np.zeros(mask.shape, dtype=bool)
+		start[mask.argmax(axis=0), np.arange(len(self.symbols))] = True
+		date_ns = np.broadcast_to(self.dates.values.view('i8')[:, None], mask.shape)
+		values = common.drawdown(self.fields['open'].T[mask_t], self.fields['close'].T[mask_t], date_ns.T[mask_t], start.T[mask_t])
+		for (field, field_values) in values.items():
+			res = np.full(mask.shape, np.nan)
+			res.T[mask_t] = field_values
+			self.fields[field] = res
+
+	## Returns row numbers of last dates not later than specified date for
+	# every symbol, -1 if symbol has no history before the date.
+	#
+	# @param[in] date -- target date
+	def last_rows(self, date):
+		row = self.dates.searchsorted(pd.Timestamp(date), side='right') - 1
+		if row < 0:
+			return np.full(len(self.symbols), -1)
+		present = self.mask[:row + 1]
+		last = row - present[::-1].argmax(axis=0)
+		return np.where(present.any(axis=0), last, -1)
+
+	## Returns field values of all symbols as of specified date. Last known
+	# value is taken if symbol has no entry for exactly this date.
+	#
+	# @param[in] field -- field name. Example: 'drop-period'
+	# @param[in] date  -- target date
+	def cross_section(self, field, date):
+		rows = self.last_rows(date)
+		values = self.fields[field][np.maximum(rows, 0), np.arange(len(self.symbols))]
+		return pd.Series(np.where(rows >= 0, values, np.nan), index=self.symbols, name=field)
+
+	## Returns growth ratio of all symbols for specified number of years before
+	# specified date: ratio of close price at the date to open price at the
+	# date years ago. NaN for symbols with shorter history.
+	#
+	# @param[in] years -- number of years
+	# @param[in] date  -- target date. Default: None - last date
+	def growth(self, years, date = None):
+		date = self.dates[-1] if date is None else pd.Timestamp(date)
+		begin_rows = self.last_rows(date - pd.Timedelta(days = int(365 * years)))
+		end_rows = self.last_rows(date)
+		columns = np.arange(len(self.symbols))
+		growth = self.fields['close'][end_rows, columns] / self.fields['open'][np.maximum(begin_rows, 0), columns]
+		return pd.Series(np.where((begin_rows >= 0) & (end_rows >= 0), growth, np.nan), index=self.symbols, name='growth-%gy' % years)
+
+################################################################################
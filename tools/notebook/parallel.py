@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+
+################################################################################
+
+# Process pool helpers. Functions and arguments are passed to worker
+# processes by pickling, so functions should be module level functions or
+# functools.partial of them.
+
+import multiprocessing
+import os
+
+################################################################################
+
+## Returns number of processes functions map and imap use for items,
+# 1 means items are processed by the calling process.
+#
+# @param[in] items   -- list of arguments
+# @param[in] workers -- number of processes, None - number of CPUs. Default: 1
+def count(items, workers = 1):
+	return min(workers or os.cpu_count() or 1, len(items))
+
+## Returns list [f(item) for item in items] evaluated by pool of processes.
+# Order of results is the same as order of items.
+#
+# @param[in] f       -- function to apply, it should be picklable
+# @param[in] items   -- list of arguments
+# @param[in] workers -- number of processes, None - number of CPUs. Default: 1
+def map(f, items, workers = 1):
+	workers = count(items, workers)
+	if workers <= 1:
+		return [f(item) for item in items]
+	with multiprocessing.Pool(workers) as pool:
+		return pool.map(f, items, chunksize = max(1, len(items) // (workers * 4)))
+
+## The same as function map but returns iterator of results, so results are
+# produced one by one in order of items.
+#
+# @param[in] f       -- function to apply, it should be picklable
+# @param[in] items   -- list of arguments
+# @param[in] workers -- number of processes, None - number of CPUs. Default: 1
+def imap(f, items, workers = 1):
+	workers = count(items, workers)
+	if workers <= 1:
+		for item in items:
+			yield f(item)
+		return
+	with multiprocessing.Pool(workers) as pool:
+		for res in pool.imap(f, items):
+			yield res
+
+################################################################################
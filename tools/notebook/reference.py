@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+
+################################################################################
+
+# Reference implementations of optimized functions of modules common, moving
+# and stock. They are the former straightforward loops kept to check that
+# optimized functions return the same values (see benchmark.py). They are
+# slow and should not be used for analysis.
+
+import pandas as pd
+import datetime
+import moving
+
+################################################################################
+
+## Reference of function common.values__max_prev
+def values__max_prev(h):
+	mp = []
+	for price_ration in h['price-ratio']:
+		if mp:
+			mp.append(max(price_ration, mp[-1]))
+		else:
+			mp.append(price_ration)
+	return mp
+
+## Reference of function common.values__price_drop_period
+def values__price_drop_period(h):
+	last_max_price_date = h.index[0]
+	price_dorp = h['price-drop'].values
+	pdp = [0]
+	for date_n in range(1, len(h)):
+		date = h.index[date_n]
+		if price_dorp[date_n] == 1.:
+			last_max_price_date = date
+		pdp.append((date - last_max_price_date).days)
+	return pdp
+
+## Reference of function common.values__drop_min
+def values__drop_min(h):
+	price_ratio = h['price-ratio'].values
+	price_dorp = h['price-drop'].values
+	dm = [price_ratio[0]]
+	for date_n in range(1, len(h)):
+		if price_dorp[date_n] == 1.:
+			dm.append(price_ratio[date_n])
+		else:
+			dm.append(min(dm[-1], price_ratio[date_n]))
+	return dm
+
+## Reference of function common.values__price_growth_ratio
+def values__price_growth_ratio(h, window_size = 365, avg_period = 365):
+	avg_growth_ratio__closure = lambda history, begin, end, closed, avg_period = avg_period: \
+		moving.avg_growth_ratio(history, begin, end, closed, avg_period)
+	return moving_f(avg_growth_ratio__closure, h, window_size = window_size)
+
+#-------------------------------------------------------------------------------
+
+## Reference of function common.drop_periods
+def drop_periods(h):
+	in_drop = (h['drop-period'] > 0).values
+	drop_intervals = []
+	last_i = 0
+	for i in range(1, len(in_drop)):
+		if in_drop[last_i] != in_drop[i]:
+			drop_intervals.append((last_i, i, in_drop[last_i]))
+			last_i = i
+	drop_intervals.append((last_i, len(h), in_drop[last_i]))
+	return drop_intervals
+
+## Reference of function common.periods
+def periods(h):
+	ps = drop_periods(h)
+	price_ratio = h['price-ratio']
+	data = {'begin': [], 'end': [], 'type': [], 'extremum': [], 'extremum-date': []}
+	for (begin_i, end_i, in_drop) in ps:
+		price_ratio_slice = price_ratio.iloc[begin_i:end_i]
+		extremum_date = price_ratio_slice.idxmin() if in_drop else price_ratio_slice.idxmax()
+		extremum = price_ratio.loc[extremum_date]
+
+		if not in_drop and len(data['extremum-date']):
+			data['begin'].append(data['extremum-date'][-1])
+			data['end'].append(h.index[begin_i-1])
+			data['type'].append('growth')
+			data['extremum'].append(extremum)
+			data['extremum-date'].append(extremum_date)
+
+		data['begin'].append(h.index[begin_i])
+		if in_drop:
+			data['end'].append(extremum_date)
+		else:
+			data['end'].append(h.index[end_i-1])
+		data['type'].append('drop' if in_drop else 'takeoff')
+		data['extremum'].append(extremum)
+		data['extremum-date'].append(extremum_date)
+
+	return pd.DataFrame(data = data)
+
+#-------------------------------------------------------------------------------
+
+## Reference of function moving.get_windows
+def get_windows(history, window_size):
+	history_index = [*history.index]
+	opened_windows = []
+	closed_windows_cnt = 0
+	windows = []
+	for row_n in range(len(history_index) - 1, -1, -1):
+		current_date = history_index[row_n]
+		opened_windows.append(current_date)
+
+		prev_date = history_index[row_n-1] if row_n > 0 else current_date
+		for window_end in opened_windows[closed_windows_cnt:]:
+			if (window_end - prev_date).days < window_size:
+				break
+
+			closed_windows_cnt += 1
+			days_from_current_date_to_window_end = abs((window_end - current_date).days - window_size)
+			days_from_prev_date_to_window_end = abs((window_end - prev_date).days - window_size)
+
+			if days_from_current_date_to_window_end < days_from_prev_date_to_window_end:
+				windows.append((current_date, window_end, True))
+			else:
+				windows.append((prev_date, window_end, True))
+
+	for window_end in opened_windows[closed_windows_cnt:]:
+		windows.append((history_index[0], window_end, False))
+
+	windows.reverse()
+	return windows
+
+## Reference of function moving.moving_f
+def moving_f(f, history, window_size = 365):
+	return [f(history, begin, end, closed) for (begin, end, closed) in get_windows(history, window_size)]
+
+#-------------------------------------------------------------------------------
+
+## Reference of function stock.period_delta. Series is dictionary date -> TSEntry.
+def period_delta(series, period):
+	timeline = sorted(series.items(), reverse = True)
+	last = timeline[0]
+	deltas = []
+	for (date, entry) in timeline:
+		if last[0] - date >= period:
+			deltas.append( (date, last[0], last[1].close / entry.open) )
+			last = (date, entry)
+	return deltas
+
+## Reference of function stock.years_are_positive. Series is dictionary date -> TSEntry.
+def years_are_positive(series, limit = datetime.timedelta(365*5)):
+	year = datetime.timedelta(365)
+	timeline = sorted(series.items(), reverse = True)
+	for (date, entry) in timeline:
+		year_before = date - year
+		if year_before + limit < timeline[0][0]: continue
+		if year_before in series and entry.close < series[year_before].open:
+			return (date, entry.close, year_before, series[year_before].open)
+	return True
+
+################################################################################
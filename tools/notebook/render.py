@@ -3,10 +3,20 @@
 ################################################################################
 
 import matplotlib.pyplot as plt
-import seaborn as sns
+import matplotlib.collections
+import matplotlib.colors
+import matplotlib.figure
 import numpy as np
 import pandas as pd
+import os
 import common
+import instrument
+
+## Width of curves, the same as seaborn.pointplot draws with scale=0.5
+LINE_WIDTH = 1.8 * 0.5 * plt.rcParams['lines.linewidth']
+
+## Maximal number of date ticks on x axis, tick step grows for longer histories
+MAX_TICKS = 60
 
 ## Draws few curves on one chart showing history of specified symbol:
 # - black color curve shows specified column values for all hisory
@@ -15,101 +25,173 @@ import common
 # - tiny red vertical lines show target period in all history period (see 'period' parameter)
 # - light green and red strips show drop periods (see 'common.drop_periods' function and 'add' parameter)
 #
-# Also it shows average price growth ratio per year for target period and for 
+# Also it shows average price growth ratio per year for target period and for
 # last year. One can see it in char title.
 #
-# @param[in] history -- dictionary Symbol -> Price History DataFrame. See function load_history(history_dir)
-# @param[in] symbol  -- target symbol
-# @param[in] company -- full company name for taget symbol
-# @paran[in] column  -- DataFrame column name to draw. Default: 'price-ratio'
-# @param[in] period  -- pair of dates to draw the period larger on the same chart. Example: ('2016', '2100'). Defaut: None
-# @paran[in] add     -- list of additional things to draw on the same chart. Can contain values 'drop-periods'. Default: []
-def draw_column(history, symbol, company, column = 'price-ratio', period = None, add = []):
+# Every history entry has its own x position (as categorical x axis of
+# seaborn.pointplot has), so days without trading are not shown.
+#
+# @param[in] history    -- dictionary Symbol -> Price History DataFrame. See function load_history(history_dir)
+# @param[in] symbol     -- target symbol
+# @param[in] company    -- full company name for taget symbol
+# @paran[in] column     -- DataFrame column name to draw. Default: 'price-ratio'
+# @param[in] period     -- pair of dates to draw the period larger on the same chart. Example: ('2016', '2100'). Defaut: None
+# @paran[in] add        -- list of additional things to draw on the same chart. Can contain values 'drop-periods'. Default: []
+# @param[in] max_points -- maximal number of points of every curve, longer curves are downsampled
+#                          keeping minimums and maximums (see function downsample). None - draw all points. Default: None
+# @param[in] output     -- file to save chart to (format is taken from extension: png, svg, ...),
+#                          None - show chart. Default: None
+@instrument.stage()
+def draw_column(history, symbol, company, column = 'price-ratio', period = None, add = [], max_points = None, output = None):
 	h = history[symbol]
-	
-	fig, ax = plt.subplots()
+
+	fig = plt.figure() if output is None else matplotlib.figure.Figure()
+	ax = fig.subplots()
 	fig.set_size_inches(16, 6)
 
-	p = sns.pointplot(x='datenum', y=column, data=h, ax=ax, color='black', scale=0.5, markers='', linestyles='-')	
-	p.axes.axhline(1, color='black', linewidth=0.5)
-	p.axes.set_xlabel('')
-	index_size = h.index.unique().size
-	x_locs = np.arange(index_size - 1, -1, -12)[::-1]
-	plt.xticks(x_locs, h.index.take(x_locs).map(lambda x: x.strftime('%Y-%m-%d')), rotation=90)
+	__plot(ax, h[column].values, 'black', max_points)
+	ax.set_ylabel(column)
+	ax.axhline(1, color='black', linewidth=0.5)
+	x_locs = np.arange(len(h) - 1, -1, -max(12, -(-len(h) // MAX_TICKS)))[::-1]
+	ax.set_xticks(x_locs)
+	ax.set_xticklabels(h.index.take(x_locs).strftime('%Y-%m-%d'), rotation=90)
+	ax.set_xlim(-.5, len(h) - .5, auto=None)
 	title = '{} ({})'.format(company, symbol)
 
 	if 'periods' in add:
-		draw_periods(h, p, ax, add)
+		draw_periods(h, ax, ax, add)
 
 	if 'drop-periods' in add:
 		periods = common.drop_periods(h)
 		ylim = ax.get_ylim()
-		label_y_shift_step = 0
-		height = ax.get_ylim()[1] - ax.get_ylim()[0]
-		label_y_shift = height / 25
-		for (begin_i, end_i, in_drop) in periods:
-			color = 'red' if in_drop else 'green'
-			start_x = begin_i-1
-			width = end_i - begin_i
-			p.bar(start_x, ax.get_ylim()[1], width, 0, align='edge', color=color, alpha=0.1)
-			ax.set_ylim(ylim)
-			if 'drop-periods-labels' in add:
-				text_y = (ax.get_ylim()[0] + ax.get_ylim()[1])//2 + label_y_shift  * (label_y_shift_step % 3)
-				p.text(start_x, text_y, '%i'%(end_i-begin_i))
-				label_y_shift_step += 1
-	
-	if period:		
+		begin_i = np.array([p[0] for p in periods], dtype=np.int64)
+		end_i = np.array([p[1] for p in periods], dtype=np.int64)
+		in_drop = np.array([p[2] for p in periods], dtype=bool)
+		__shade(ax, begin_i - 1, end_i - begin_i, ylim[1], np.where(in_drop, 'red', 'green'), 0.1)
+		ax.set_ylim(ylim)
+		if 'drop-periods-labels' in add:
+			label_y_shift = (ylim[1] - ylim[0]) / 25
+			for (i, (start_x, width)) in enumerate(zip(begin_i - 1, end_i - begin_i)):
+				ax.text(start_x, (ylim[0] + ylim[1])//2 + label_y_shift * (i % 3), '%i'%width)
+
+	if period:
 		(begin, end) = period
 		begin_date = max(pd.to_datetime(begin), h.index.min())
 		end_date = min(pd.to_datetime(end), h.index.max())
-		growth_ratio = (h['price-ratio'].loc[begin:end][-1] / h['price-ratio'].loc[begin:end][0])
+		growth_ratio = (h['price-ratio'].loc[begin:end].iloc[-1] / h['price-ratio'].loc[begin:end].iloc[0])
 		period_in_years = (end_date - begin_date).days / 365.
 		avg_growth_ratio = growth_ratio ** (1./period_in_years)
-		title += '        avg growth ratio: %.2f (%.2f for last year)' % (avg_growth_ratio, h['price-growth-1y'][-1])
+		title += '        avg growth ratio: %.2f (%.2f for last year)' % (avg_growth_ratio, h['price-growth-1y'].iloc[-1])
 		if begin in h.index:
-			p.axes.axvline(h.index.get_loc(begin).start, color='red', linewidth=0.5)
+			ax.axvline(h.index.searchsorted(pd.Timestamp(begin)), color='red', linewidth=0.5)
 		if end in h.index:
-			p.axes.axvline(h.index.get_loc(end).start, color='red', linewidth=0.5)
+			ax.axvline(h.index.searchsorted(pd.Timestamp(end)), color='red', linewidth=0.5)
 		with plt.rc_context({'xtick.color':'red', 'ytick.color':'red'}):
 			ax = ax.twiny()
 			period_h = h.loc[begin:end]
-			p = sns.pointplot(x='datenum', y=column, data=period_h, ax=ax, color='red', scale=0.5, markers='', linestyles='-')		
-			p.axes.set_xlabel('')
-			index_size = period_h.index.unique().size
-			x_locs = np.arange(index_size - 1, -1, -4)[::-1]
-			plt.xticks(x_locs, period_h.index.take(x_locs).map(lambda x: x.strftime('%Y-%m-%d')), rotation=90)	
+			__plot(ax, period_h[column].values, 'red', max_points)
+			x_locs = np.arange(len(period_h) - 1, -1, -max(4, -(-len(period_h) // MAX_TICKS)))[::-1]
+			ax.set_xticks(x_locs)
+			ax.set_xticklabels(period_h.index.take(x_locs).strftime('%Y-%m-%d'), rotation=90)
+			ax.set_xlim(-.5, len(period_h) - .5, auto=None)
 	else:
-		title += '        growth ratio: %.2f' % (h['price-ratio'][-1]/h['price-ratio'][0])
-			
-	p.set_title(title)
-	
-	plt.show()
+		title += '        growth ratio: %.2f' % (h['price-ratio'].iloc[-1]/h['price-ratio'].iloc[0])
+
+	ax.set_title(title)
+
+	if output is None:
+		plt.show()
+	else:
+		fig.savefig(output, bbox_inches='tight')
+
+#-------------------------------------------------------------------------------
+
+## Draws charts of specified symbols to files without showing them.
+# Returns list of written files.
+#
+# @param[in] history    -- dictionary Symbol -> Price History DataFrame. See function load_history(history_dir)
+# @param[in] symbols    -- list of symbols
+# @param[in] companies  -- dictionary Symbol -> full company name, for example stocks['Name']
+# @param[in] output_dir -- directory to write files to
+# @param[in] fmt        -- file format: 'png', 'svg', ... Default: 'png'
+# @param[in] max_points -- maximal number of points of every curve. Default: 2000
+# @param[in] kwargs     -- other arguments of function draw_column. Example: add = ['periods']
+@instrument.stage()
+def draw_columns(history, symbols, companies, output_dir, fmt = 'png', max_points = 2000, **kwargs):
+	os.makedirs(output_dir, exist_ok=True)
+	files = []
+	for symbol in symbols:
+		if symbol not in history:
+			continue
+		path = os.path.join(output_dir, '%s.%s' % (symbol, fmt))
+		draw_column(history, symbol, companies[symbol] if symbol in companies else symbol, max_points = max_points, output = path, **kwargs)
+		files.append(path)
+	return files
 
 #-------------------------------------------------------------------------------
 
+@instrument.stage()
 def draw_periods(h, picture, ax, add):
 	periods = common.periods(h)
 	ylim = ax.get_ylim()
-	label_y_shift_step = 0
-	height = ax.get_ylim()[1] - ax.get_ylim()[0]
-	label_y_shift = height / 25
-	for index, period in periods.iterrows():
-		begin_i = h.index.get_loc(period['begin'])
-		if period['type'] == 'growth':
-			begin_i += 1
-		end_i = h.index.get_loc(period['end']) + 1		
-		color = 'red' if period['type'] == 'drop' else 'green'
-		alpha = 0.1 if period['type'] in ['drop', 'growth'] else 0.175
-		start_x = begin_i-1
-		width = end_i - begin_i
-		picture.bar(start_x, ax.get_ylim()[1], width, 0, align='edge', color=color, alpha=alpha)
-		ax.set_ylim(ylim)
-		
-		extremum_i = h.index.get_loc(period['extremum-date'])
-		picture.axes.axvline(extremum_i, color=color, linewidth=0.5)
-		if 'periods-labels' in add:
-			text_y = (ax.get_ylim()[0] + ax.get_ylim()[1])/2. + label_y_shift  * (label_y_shift_step % 3)
-			picture.text(start_x, text_y, '%i'%(end_i - begin_i))
-			label_y_shift_step += 1
-		
+	begin_i = h.index.searchsorted(periods['begin'].values) + (periods['type'].values == 'growth')
+	end_i = h.index.searchsorted(periods['end'].values) + 1
+	colors = np.where(periods['type'].values == 'drop', 'red', 'green')
+	alpha = np.where(periods['type'].values == 'takeoff', 0.175, 0.1)
+	__shade(picture, begin_i - 1, end_i - begin_i, ylim[1], colors, alpha)
+	ax.set_ylim(ylim)
+
+	extremum_i = h.index.searchsorted(periods['extremum-date'].values)
+	lines = np.zeros((len(periods), 2, 2))
+	lines[:, :, 0] = extremum_i[:, None]
+	lines[:, 1, 1] = 1
+	picture.add_collection(matplotlib.collections.LineCollection(lines, colors=colors, linewidths=0.5, transform=picture.get_xaxis_transform()))
+	if 'periods-labels' in add:
+		label_y_shift = (ylim[1] - ylim[0]) / 25
+		for (i, (start_x, width)) in enumerate(zip(begin_i - 1, end_i - begin_i)):
+			picture.text(start_x, (ylim[0] + ylim[1])/2. + label_y_shift * (i % 3), '%i'%width)
+
+#-------------------------------------------------------------------------------
+
+## Returns pair (x, y) of points to draw instead of specified curve. Curve is
+# divided into max_points/2 buckets and only minimal and maximal points of
+# every bucket are kept, so peaks and drops of the curve stay visible.
+#
+# @param[in] x          -- x values
+# @param[in] y          -- y values
+# @param[in] max_points -- maximal number of returned points
+@instrument.stage()
+def downsample(x, y, max_points):
+	n = len(y)
+	if n <= max_points:
+		return (x, y)
+	size = -(-n // max(max_points // 2, 1))
+	padded = np.full(-(-n // size) * size, np.nan)
+	padded[:n] = y
+	padded = padded.reshape(-1, size)
+	base = np.arange(len(padded)) * size
+	i_min = base + np.where(np.isnan(padded), np.inf, padded).argmin(axis=1)
+	i_max = base + np.where(np.isnan(padded), -np.inf, padded).argmax(axis=1)
+	i = np.unique(np.concatenate([i_min, i_max, [0, n - 1]]))
+	i = i[i < n]
+	return (x[i], y[i])
+
+def __plot(ax, y, color, max_points):
+	(x, y) = (np.arange(len(y)), y)
+	if max_points:
+		(x, y) = downsample(x, y, max_points)
+	ax.plot(x, y, color=color, linewidth=LINE_WIDTH)
+	ax.set_xlabel('')
+	ax.xaxis.grid(False)
+
+def __shade(ax, start_x, width, top, colors, alpha):
+	verts = np.zeros((len(start_x), 4, 2))
+	verts[:, 0, 0] = verts[:, 1, 0] = start_x
+	verts[:, 2, 0] = verts[:, 3, 0] = start_x + width
+	verts[:, 1, 1] = verts[:, 2, 1] = top
+	face_colors = matplotlib.colors.to_rgba_array(colors)
+	face_colors[:, 3] = alpha
+	ax.add_collection(matplotlib.collections.PolyCollection(verts, facecolors=face_colors, edgecolors='none'))
+	ax.autoscale_view(scaley=False)
+
 ################################################################################
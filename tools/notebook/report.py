@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+################################################################################
+
+import matplotlib
+matplotlib.use('Agg')
+
+import pandas as pd
+import argparse
+import html
+import json
+import os
+import time
+import cache
+import common
+import parallel
+import render
+
+################################################################################
+
+## Enrichment steps needed by charts
+STEPS = ['price-ratio', 'max-prev', 'price-drop', 'drop-period', 'price-growth']
+
+## Version of report charts. It is a part of symbol fingerprints, so it
+# should be changed when charts change.
+REPORT_VERSION = 1
+
+__MANIFEST = 'manifest.json'
+
+################################################################################
+
+## Builds report with charts of specified symbols: image per symbol plus
+# index.html and index.md. Charts are rendered by pool of processes.
+# Symbol is skipped if its prices history, company name and chart options
+# are the same as in the previous run and its image exists.
+# Returns dictionary with numbers of 'rendered', 'skipped' and 'missing' symbols.
+#
+# @param[in] history_dir -- path to directory with CSV files. Example: "./history"
+# @param[in] symbols     -- list of symbols
+# @param[in] companies   -- dictionary Symbol -> full company name, for example stocks['Name']
+# @param[in] output_dir  -- directory to write report to
+# @param[in] title       -- report title. Default: 'Prices history'
+# @param[in] fmt         -- image format: 'png', 'svg', ... Default: 'png'
+# @param[in] workers     -- number of processes, None - number of CPUs. Default: None
+# @param[in] force       -- render all symbols even unchanged ones. Default: False
+# @param[in] windows     -- list windows sizes in years for 'price-growth' step. Default: [1,2,3,4,5]
+# @param[in] cache_dir   -- directory of derived metrics cache, see module cache. Default: None - no caching
+# @param[in] cache_size  -- cache size limit in bytes, None - do not evict entries. Default: cache.MAX_SIZE
+# @param[in] chart       -- arguments of function render.draw_column. Example: {'add': ['periods']}
+def build(history_dir, symbols, companies, output_dir, title = 'Prices history', fmt = 'png', workers = None, force = False
+		, windows = range(1,6), cache_dir = None, cache_size = cache.MAX_SIZE, **chart):
+	os.makedirs(output_dir, exist_ok=True)
+	history = common.load_history(history_dir)
+	missing = [symbol for symbol in symbols if symbol not in history]
+	symbols = [symbol for symbol in symbols if symbol in history]
+	windows = list(windows)
+
+	previous = __load_manifest(output_dir) if not force else {}
+	manifest = {}
+	changed = {}
+	for symbol in symbols:
+		key = cache.key(REPORT_VERSION, STEPS, windows, fmt, chart, companies.get(symbol, symbol), history[symbol])
+		image = '%s.%s' % (symbol, fmt)
+		manifest[symbol] = {'key': key, 'image': image}
+		if previous.get(symbol) != manifest[symbol] or not os.path.isfile(os.path.join(output_dir, image)):
+			changed[symbol] = history[symbol]
+
+	if changed:
+		common.enrich(changed, steps = STEPS, windows = windows, workers = workers, cache_dir = cache_dir, max_size = cache_size)
+		tasks = [(symbol, companies.get(symbol, symbol), changed[symbol], os.path.join(output_dir, manifest[symbol]['image']), chart) for symbol in changed]
+		parallel.map(_render, tasks, workers)
+
+	__write_index(output_dir, title, symbols, companies, manifest, missing)
+	with open(os.path.join(output_dir, __MANIFEST + '.tmp'), 'w') as f:
+		json.dump(manifest, f, indent = 1, sort_keys = True)
+	os.replace(os.path.join(output_dir, __MANIFEST + '.tmp'), os.path.join(output_dir, __MANIFEST))
+	return {'rendered': len(changed), 'skipped': len(symbols) - len(changed), 'missing': len(missing)}
+
+## Worker of function build. Renders chart of one symbol to file.
+def _render(task):
+	(symbol, company, h, path, chart) = task
+	(base, ext) = os.path.splitext(path)
+	render.draw_column({symbol: h}, symbol, company, output = base + '.tmp' + ext, **chart)
+	os.replace(base + '.tmp' + ext, path)
+	return path
+
+def __load_manifest(output_dir):
+	path = os.path.join(output_dir, __MANIFEST)
+	if not os.path.isfile(path):
+		return {}
+	with open(path) as f:
+		return json.load(f)
+
+def __write_index(output_dir, title, symbols, companies, manifest, missing):
+	names = dict((symbol, '{} ({})'.format(companies.get(symbol, symbol), symbol)) for symbol in symbols)
+	with open(os.path.join(output_dir, 'index.html'), 'w') as f:
+		f.write('<!DOCTYPE html>\n<html>\n<head><meta charset="utf-8"><title>%s</title></head>\n<body>\n' % html.escape(title))
+		f.write('<h1>%s</h1>\n' % html.escape(title))
+		f.write('<ul>\n%s</ul>\n' % ''.join('<li><a href="#%s">%s</a></li>\n' % (html.escape(symbol), html.escape(names[symbol])) for symbol in symbols))
+		for symbol in symbols:
+			f.write('<h2 id="%s">%s</h2>\n<img src="%s" alt="%s">\n' % (html.escape(symbol), html.escape(names[symbol]), html.escape(manifest[symbol]['image']), html.escape(symbol)))
+		if missing:
+			f.write('<p>No prices history for: %s</p>\n' % html.escape(', '.join(missing)))
+		f.write('</body>\n</html>\n')
+	with open(os.path.join(output_dir, 'index.md'), 'w') as f:
+		f.write('# %s\n\n' % title)
+		for symbol in symbols:
+			f.write('## %s\n\n![%s](%s)\n\n' % (names[symbol], symbol, manifest[symbol]['image']))
+		if missing:
+			f.write('No prices history for: %s\n' % ', '.join(missing))
+
+#===============================================================================
+
+def main():
+	parser = argparse.ArgumentParser(description = 'Builds report with prices history charts')
+	parser.add_argument('--history', default = 'history', help = 'directory with CSV files. Default: history')
+	parser.add_argument('--shortlist', default = 'data/shortlist', help = 'file with one symbol per line. Default: data/shortlist')
+	parser.add_argument('--stocks', default = 'data/stocks.tcs', help = 'stocks list with company names. Default: data/stocks.tcs')
+	parser.add_argument('--output', default = 'report', help = 'report directory. Default: report')
+	parser.add_argument('--title', default = 'Prices history', help = 'report title')
+	parser.add_argument('--format', default = 'png', help = 'image format: png, svg, ... Default: png')
+	parser.add_argument('--column', default = 'price-ratio', help = 'column to draw. Default: price-ratio')
+	parser.add_argument('--add', nargs = '*', default = ['periods', 'periods-labels'], help = 'additional things to draw, see function render.draw_column. Default: periods periods-labels')
+	parser.add_argument('--period', nargs = 2, metavar = ('BEGIN', 'END'), help = 'period to draw larger. Example: 2016 2100')
+	parser.add_argument('--max-points', type = int, default = 2000, help = 'maximal number of points of every curve, 0 - all points. Default: 2000')
+	parser.add_argument('--workers', type = int, help = 'number of processes. Default: number of CPUs')
+	parser.add_argument('--cache', default = cache.CACHE_DIR, help = 'derived metrics cache directory, empty - no caching. Default: %s' % cache.CACHE_DIR)
+	parser.add_argument('--cache-size', type = int, default = cache.MAX_SIZE, help = 'cache size limit in bytes. Default: %i' % cache.MAX_SIZE)
+	parser.add_argument('--force', action = 'store_true', help = 'render all symbols even unchanged ones')
+	args = parser.parse_args()
+
+	with open(args.shortlist) as f:
+		symbols = [s.strip() for s in f if s.strip()]
+	companies = pd.read_csv(args.stocks, index_col=0)['Name'].to_dict() if os.path.isfile(args.stocks) else {}
+	chart = {'column': args.column, 'add': args.add, 'max_points': args.max_points or None}
+	if args.period:
+		chart['period'] = tuple(args.period)
+	begin = time.perf_counter()
+	res = build(args.history, symbols, companies, args.output, args.title, args.format, args.workers, args.force, cache_dir = args.cache or None, cache_size = args.cache_size, **chart)
+	print('%i symbols rendered, %i unchanged, %i missing in %.1f s. Report: %s' % (res['rendered'], res['skipped'], res['missing'], time.perf_counter() - begin, os.path.join(args.output, 'index.html')))
+
+#===============================================================================
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+################################################################################
+
+# Resampling of prices history to coarser resolutions. Bars of every bucket
+# (day, week, month, ...) are aggregated as open - first, high - maximum,
+# low - minimum, close - last and volume - sum, and the bucket bar is dated
+# by the day of its last bar, as monthly history files are. Buckets are
+# found by one pass over int64 dates and aggregated by reduceat, so one
+# downloaded resolution (see module fetch) feeds all coarser ones:
+#
+#   python resample.py --source history_daily --target history_weekly --resolution week
+#
+# Coarser files are updated incrementally: only buckets since the last
+# stored one are recomputed.
+
+import numpy as np
+import pandas as pd
+import argparse
+import functools
+import os
+import time
+import common
+import moving
+import parallel
+
+################################################################################
+
+## Supported resolutions. Weeks begin on Monday.
+RESOLUTIONS = ['day', 'week', 'month', 'quarter', 'year']
+
+## Returns int64 array of bucket numbers of dates. Bucket numbers grow with
+# dates, dates of one bucket have the same number.
+#
+# @param[in] date_ns    -- int64 array of dates in ns since epoch
+# @param[in] resolution -- see RESOLUTIONS
+def bucket_keys(date_ns, resolution):
+	days = np.asarray(date_ns, dtype=np.int64) // moving.DAY_NS
+	if resolution == 'day':
+		return days
+	if resolution == 'week':
+		# 1970-01-01 is Thursday
+		return (days + 3) // 7
+	months = days.astype('datetime64[D]').astype('datetime64[M]').view(np.int64)
+	if resolution == 'month':
+		return months
+	if resolution == 'quarter':
+		return months // 3
+	if resolution == 'year':
+		return months // 12
+	raise ValueError('Unknown resolution "%s", expected one of: %s' % (resolution, ', '.join(RESOLUTIONS)))
+
+## Returns the first day (datetime64[D]) of bucket, see function bucket_keys
+#
+# @param[in] key        -- bucket number
+# @param[in] resolution -- see RESOLUTIONS
+def bucket_begin(key, resolution):
+	if resolution == 'day':
+		return np.datetime64(int(key), 'D')
+	if resolution == 'week':
+		return np.datetime64(int(key) * 7 - 3, 'D')
+	months = {'month': 1, 'quarter': 3, 'year': 12}.get(resolution)
+	if months is None:
+		raise ValueError('Unknown resolution "%s", expected one of: %s' % (resolution, ', '.join(RESOLUTIONS)))
+	return np.datetime64(int(key) * months, 'M').astype('datetime64[D]')
+
+## Returns dictionary Column -> array of bars of coarser resolution with
+# 'date' (datetime64[D]), 'open', 'high', 'low', 'close' and 'volume'
+# columns. Bars should be sorted by date. Volume of bucket is sum of known
+# volumes, NaN volumes are counted as 0.
+#
+# @param[in] date_ns    -- int64 array of bars dates in ns since epoch
+# @param[in] columns    -- dictionary Column -> array with 'open', 'high', 'low', 'close' and 'volume' columns
+# @param[in] resolution -- see RESOLUTIONS
+def resample_columns(date_ns, columns, resolution):
+	keys = bucket_keys(date_ns, resolution)
+	if not len(keys):
+		return dict([('date', np.zeros(0, dtype='datetime64[D]'))] + [(column, np.asarray(columns[column])[:0]) for column in ['open', 'high', 'low', 'close', 'volume']])
+	first = np.ones(len(keys), dtype=bool)
+	first[1:] = keys[1:] != keys[:-1]
+	begins = np.flatnonzero(first)
+	ends = np.append(begins[1:], len(keys))
+	return {'date': (np.asarray(date_ns, dtype=np.int64)[ends - 1] // moving.DAY_NS).astype('datetime64[D]')
+		, 'open': np.asarray(columns['open'])[begins]
+		, 'high': np.fmax.reduceat(np.asarray(columns['high']), begins)
+		, 'low': np.fmin.reduceat(np.asarray(columns['low']), begins)
+		, 'close': np.asarray(columns['close'])[ends - 1]
+		, 'volume': np.add.reduceat(np.nan_to_num(np.asarray(columns['volume'])), begins)}
+
+## Returns prices history of coarser resolution: DataFrame indexed by date
+# with 'open', 'close', 'volume', 'high' and 'low' columns.
+#
+# @param[in] h          -- prices history DataFrame. See function common.load_history_dataframe(file_path)
+# @param[in] resolution -- see RESOLUTIONS
+def resample(h, resolution):
+	h = h.sort_index()
+	bars = resample_columns(moving.date_ns(h), h, resolution)
+	return pd.DataFrame(dict((column, bars[column]) for column in __BAR_COLUMNS)
+		, index = pd.DatetimeIndex(bars['date'].astype('datetime64[ns]'), name = 'date'), columns = __BAR_COLUMNS)
+
+__BAR_COLUMNS = ['open', 'close', 'volume', 'high', 'low']
+
+#-------------------------------------------------------------------------------
+
+## Updates CSV file of coarser resolution by bars of finer one. Buckets since
+# the last stored bucket are recomputed: if the first given bar is later than
+# the last stored bar, the stored bar is aggregated with the given bars of
+# its bucket (so only new bars can be given), otherwise bars should cover the
+# last stored bucket entirely: begin not later than its first weekday.
+# ValueError is raised if bars overlap the last stored bar but begin later,
+# since fine bars of the bucket before them are not known (give bars since
+# the previous bucket if the first weekday is a holiday). File is replaced
+# atomically.
+# Returns number of written bars which are new or changed.
+#
+# @param[in] bars       -- prices history DataFrame of finer resolution, at least new bars
+# @param[in] file_path  -- path to CSV file of coarser resolution. Example: "history_weekly/ADBE.csv"
+# @param[in] symbol     -- target symbol
+# @param[in] resolution -- see RESOLUTIONS
+def update_file(bars, file_path, symbol, resolution):
+	bars = bars.sort_index()
+	stored = common.load_history_dataframe(file_path, datenum = False) if os.path.isfile(file_path) else pd.DataFrame()
+	if len(stored):
+		last_key = bucket_keys(moving.date_ns(stored.iloc[-1:]), resolution)[0]
+		tail = bars[bucket_keys(moving.date_ns(bars), resolution) >= last_key]
+		if len(tail) and tail.index[0] > stored.index[-1]:
+			tail = pd.concat([stored.iloc[-1:][__BAR_COLUMNS], tail[__BAR_COLUMNS]])
+		elif len(tail):
+			first_weekday = np.busday_offset(bucket_begin(last_key, resolution), 0, roll='forward')
+			if bars.index[0] > pd.Timestamp(first_weekday):
+				raise ValueError('Bars of "%s" since %s overlap the last stored bar of %s but do not cover its %s since %s'
+					% (symbol, bars.index[0].date(), stored.index[-1].date(), resolution, first_weekday))
+		kept = bucket_keys(moving.date_ns(stored), resolution) < last_key
+		keep = stored[kept][__BAR_COLUMNS]
+	else:
+		(tail, keep) = (bars, None)
+	new = resample(tail, resolution)
+	if not len(new) or (keep is not None and __same_bars(stored[~kept], new)):
+		return 0
+	res = pd.concat([keep, new]) if keep is not None else new
+	columns = dict((column, res[column].values) for column in __BAR_COLUMNS)
+	columns['date'] = res.index.values.astype('datetime64[D]')
+	# volumes are integer in history files, compiled store keeps them as floats
+	columns['volume'] = columns['volume'].astype(np.int64)
+	common.save_history_file(file_path, symbol, columns)
+	return len(new)
+
+def __same_bars(stored, new):
+	return len(stored) == len(new) and (stored.index.values == new.index.values).all() \
+		and np.allclose(stored[__BAR_COLUMNS].values.astype(np.float64), new[__BAR_COLUMNS].values.astype(np.float64), rtol = 1e-12, atol = 0., equal_nan = True)
+
+## Updates CSV files of coarser resolution by CSV files of finer resolution,
+# see function update_file. Returns dictionary Symbol -> number of written
+# bars which are new or changed.
+#
+# @param[in] source_dir -- directory with CSV files of finer resolution. Example: "history_daily"
+# @param[in] target_dir -- directory with CSV files of coarser resolution. Example: "history_weekly"
+# @param[in] resolution -- see RESOLUTIONS
+# @param[in] symbols    -- list of symbols to update. Default: None - all files of source directory
+# @param[in] workers    -- number of worker processes, None - number of CPUs. Default: 1
+def update(source_dir, target_dir, resolution, symbols = None, workers = 1):
+	if resolution not in RESOLUTIONS:
+		raise ValueError('Unknown resolution "%s", expected one of: %s' % (resolution, ', '.join(RESOLUTIONS)))
+	os.makedirs(target_dir, exist_ok=True)
+	if symbols is None:
+		symbols = sorted(os.path.splitext(f)[0] for f in os.listdir(source_dir) if f.lower().endswith('.csv'))
+	written = parallel.map(functools.partial(_update_symbol, source_dir, target_dir, resolution), symbols, workers)
+	return dict(zip(symbols, written))
+
+def _update_symbol(source_dir, target_dir, resolution, symbol):
+	h = common.load_history_dataframe(os.path.join(source_dir, symbol + '.csv'), datenum = False)
+	if not len(h):
+		return 0
+	return update_file(h, os.path.join(target_dir, symbol + '.csv'), symbol, resolution)
+
+#===============================================================================
+
+def main():
+	parser = argparse.ArgumentParser(description = 'Builds prices history of coarser resolution from finer one')
+	parser.add_argument('--source', default = 'history_daily', help = 'directory with CSV files of finer resolution. Default: history_daily')
+	parser.add_argument('--target', required = True, help = 'directory with CSV files of coarser resolution to update')
+	parser.add_argument('--resolution', choices = RESOLUTIONS, required = True, help = 'resolution of target files')
+	parser.add_argument('--workers', type = int, default = 1, help = 'number of worker processes, 0 - number of CPUs. Default: 1')
+	parser.add_argument('symbols', nargs = '*', help = 'symbols to update. Default: all files of source directory')
+	args = parser.parse_args()
+	begin = time.perf_counter()
+	written = update(args.source, args.target, args.resolution, args.symbols or None, args.workers or None)
+	print('%i symbols, %i bars written to "%s" in %.1f s' % (len(written), sum(written.values()), args.target, time.perf_counter() - begin))
+
+#===============================================================================
+
+if __name__ == "__main__":
+	main()
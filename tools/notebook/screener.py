@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+
+################################################################################
+
+# Screening of entire universe of loaded symbols. Rules of functions
+# stock.years_are_positive and stock.period_delta are evaluated for all
+# symbols at once over flat arrays of timerange.TimeRangeIndex:
+#
+#   s = screener.Screener(common.load_history('history'))
+#   s.screen(years = 5, year_min = 1., delta_min = 1.1, max_drawdown = 0.3)
+#
+# Metrics are computed once per (years, delta_years, tolerance_days) and
+# cached, so trying other thresholds costs only filtering of the table.
+# Dates a year (or a period) before are matched to the nearest trading day
+# of the symbol within tolerance, see TimeRangeIndex.nearest_rows.
+
+import numpy as np
+import pandas as pd
+import common
+import instrument
+import moving
+import timerange
+
+################################################################################
+
+## Columns of DataFrame returned by Screener.metrics
+METRIC_COLUMNS = ['last-date', 'annual-growth', 'year-min', 'year-fails', 'years-checked', 'delta-min', 'deltas', 'max-drawdown']
+
+## Screener of prices history of all symbols
+class Screener:
+	index = None  # timerange.TimeRangeIndex of screened history
+	__open = None
+	__close = None
+	__metrics = None
+
+	## Builds screener of prices history. Prices history should not be changed
+	# while the screener is used.
+	#
+	# @param[in] history -- dictionary Symbol -> Price History DataFrame. See function common.load_history(history_dir)
+	# @param[in] index   -- timerange.TimeRangeIndex of the history to reuse. Default: None - built for the history
+	def __init__(self, history, index = None):
+		self.index = index if index is not None else timerange.TimeRangeIndex(history, windows = [])
+		frames = [history[symbol] for symbol in self.index.symbols]
+		self.__open = np.concatenate([h['open'].values for h in frames]) if frames else np.zeros(0)
+		self.__close = np.concatenate([h['close'].values for h in frames]) if frames else np.zeros(0)
+		self.__metrics = {}
+
+	def __repr__(self):
+		return 'screener.Screener(%i symbols, %i metrics computed)' % (len(self.index.symbols), len(self.__metrics))
+
+	#---------------------------------------------------------------------------
+
+	## Returns DataFrame symbols x METRIC_COLUMNS with metrics of last 'years'
+	# years of every symbol history (up to the last date of the symbol):
+	# - 'last-date' is the last date of symbol history
+	# - 'annual-growth' is average annual growth ratio: close price at the last
+	#   date to open price 'years' years before, powered by 1/years. NaN if
+	#   history is shorter
+	# - 'year-min' is the minimal ratio of close price to open price a year
+	#   before over dates checked by function stock.years_are_positive,
+	#   'year-fails' is the number of ratios below 1 and 'years-checked' is the
+	#   number of dates having a date a year before
+	# - 'delta-min' is the minimal growth ratio of consecutive periods of
+	#   'delta_years' years going back from the last date (see function
+	#   stock.period_delta) which begin during last 'years' years, 'deltas'
+	#   is the number of such periods
+	# - 'max-drawdown' is maximal drop of close price from the previous
+	#   maximum, 0.25 means 25% drop. See function common.drawdown
+	#
+	# @param[in] years          -- number of last years to screen. Default: 5
+	# @param[in] delta_years    -- period of 'delta-min' in years. Default: 1
+	# @param[in] tolerance_days -- maximal distance in days from date a year (period) before to trading day. Default: 16 - half a month, so monthly histories match
+	@instrument.stage()
+	def metrics(self, years = 5, delta_years = 1, tolerance_days = 16):
+		key = (years, delta_years, tolerance_days)
+		if key not in self.__metrics:
+			self.__metrics[key] = self._metrics(years, delta_years, tolerance_days)
+		return self.__metrics[key]
+
+	## Returns symbols which metrics (see function metrics) pass all specified
+	# rules ranked by 'annual-growth'. Symbols with history shorter than
+	# 'years' years are skipped. Rule is not checked if its threshold is None.
+	#
+	# @param[in] years          -- number of last years to screen. Default: 5
+	# @param[in] year_min       -- minimal ratio of close price to open price a year before. Default: 1.0 - every year is positive
+	# @param[in] delta_min      -- minimal growth ratio of every period of 'delta_years' years. Default: 1.0
+	# @param[in] max_drawdown   -- maximal drawdown, for example 0.3 for 30%. Default: None
+	# @param[in] delta_years    -- period of 'delta_min' rule in years. Default: 1
+	# @param[in] tolerance_days -- maximal distance in days from date a year (period) before to trading day. Default: 16 - half a month, so monthly histories match
+	def screen(self, years = 5, year_min = 1., delta_min = 1., max_drawdown = None, delta_years = 1, tolerance_days = 16):
+		res = self.metrics(years, delta_years, tolerance_days)
+		passed = res['annual-growth'].notnull().values
+		if year_min is not None:
+			passed &= (res['year-min'] >= year_min).values
+		if delta_min is not None:
+			passed &= (res['delta-min'] >= delta_min).values
+		if max_drawdown is not None:
+			passed &= (res['max-drawdown'] <= max_drawdown).values
+		return res[passed].sort_values('annual-growth', ascending = False)
+
+	#---------------------------------------------------------------------------
+
+	def _metrics(self, years, delta_years, tolerance_days):
+		index = self.index
+		(date_ns, offsets) = (index.date_ns, index.offsets)
+		(open_price, close) = (self.__open, self.__close)
+		lengths = np.diff(offsets)
+		present = np.flatnonzero(lengths > 0)
+		symbol_of_row = np.repeat(np.arange(len(index.symbols)), lengths)
+		last = offsets[1:] - 1
+		last_ns = np.where(lengths > 0, date_ns[np.maximum(last, 0)] if len(date_ns) else 0, 0)
+		tolerance = None if tolerance_days is None else int(tolerance_days * moving.DAY_NS)
+		span = int(365 * years) * moving.DAY_NS
+		year = 365 * moving.DAY_NS
+		res = dict((column, np.full(len(index.symbols), np.nan)) for column in METRIC_COLUMNS)
+
+		res['last-date'] = np.where(lengths > 0, last_ns, np.datetime64('NaT').view('i8')).view('datetime64[ns]')
+		begin = index.nearest_rows(present, last_ns[present] - span, tolerance)
+		with np.errstate(divide = 'ignore', invalid = 'ignore'):
+			growth = close[last[present]] / open_price[np.maximum(begin, 0)]
+			res['annual-growth'][present] = np.where(begin >= 0, growth ** (1. / years), np.nan)
+
+		# rolling years which begin during last years, see stock.years_are_positive
+		rows = np.flatnonzero(date_ns - year + span >= last_ns[symbol_of_row])
+		prev = index.nearest_rows(symbol_of_row[rows], date_ns[rows] - year, tolerance)
+		found = (prev >= 0) & (prev < rows)
+		(rows, prev) = (rows[found], prev[found])
+		with np.errstate(divide = 'ignore', invalid = 'ignore'):
+			ratio = close[rows] / open_price[prev]
+		checked = np.bincount(symbol_of_row[rows], minlength = len(index.symbols))
+		year_min = np.full(len(index.symbols), np.inf)
+		np.minimum.at(year_min, symbol_of_row[rows], ratio)
+		res['year-min'] = np.where(checked > 0, year_min, np.nan)
+		res['year-fails'] = np.bincount(symbol_of_row[rows], weights = ratio < 1., minlength = len(index.symbols))
+		res['years-checked'] = checked.astype(np.float64)
+
+		# consecutive periods going back from the last date, see stock.period_delta
+		period = int(365 * delta_years) * moving.DAY_NS
+		delta_min = np.full(len(index.symbols), np.inf)
+		deltas = np.zeros(len(index.symbols))
+		(symbol_n, current) = (present, last[present])
+		while len(symbol_n):
+			prev = index.nearest_rows(symbol_n, date_ns[current] - period, tolerance)
+			found = (prev >= 0) & (prev < current)
+			found[found] = date_ns[prev[found]] >= last_ns[symbol_n[found]] - span - (tolerance or 0)
+			(symbol_n, current, prev) = (symbol_n[found], current[found], prev[found])
+			with np.errstate(divide = 'ignore', invalid = 'ignore'):
+				delta_min[symbol_n] = np.minimum(delta_min[symbol_n], close[current] / open_price[prev])
+			deltas[symbol_n] += 1
+			current = prev
+		res['delta-min'] = np.where(deltas > 0, delta_min, np.nan)
+		res['deltas'] = deltas
+
+		rows = np.flatnonzero(date_ns + span >= last_ns[symbol_of_row])
+		if len(rows):
+			start = np.ones(len(rows), dtype=bool)
+			start[1:] = symbol_of_row[rows[1:]] != symbol_of_row[rows[:-1]]
+			with np.errstate(divide = 'ignore', invalid = 'ignore'):
+				price_drop = common.drawdown(open_price[rows], close[rows], date_ns[rows], start)['price-drop']
+			res['max-drawdown'][symbol_of_row[rows[start]]] = 1. - np.fmin.reduceat(price_drop, np.flatnonzero(start))
+		return pd.DataFrame(res, index = pd.Index(index.symbols, name = 'symbol'), columns = METRIC_COLUMNS)
+
+################################################################################
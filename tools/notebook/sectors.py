@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+
+################################################################################
+
+# Sector and industry statistics of prices history. Symbols of aligned prices
+# history (see module panel) are mapped to integer codes of groups from
+# stocks list once, then every aggregate of a field is computed for all
+# groups and all dates at once: sums and means by one product of field
+# matrix dates x symbols with one-hot matrix symbols x groups, minimums and
+# maximums by reduction of contiguous group columns.
+#
+# Example:
+#   common.enrich(history, steps = ['price-ratio', 'max-prev', 'price-drop', 'drop-period'])
+#   sectors = sectors.Grouping(panel.Panel(history, ['close', 'drop-period']), sectors.load_stocks())
+#   sectors.aggregate('drop-period', 'median')
+#   sectors.index(weighted = True)
+
+import numpy as np
+import pandas as pd
+import warnings
+import instrument
+
+################################################################################
+
+## Columns of stocks list symbols can be grouped by
+GROUP_COLUMNS = ['Sector', 'Industry']
+
+## Aggregates supported by Grouping.aggregate
+AGGREGATES = ['count', 'sum', 'mean', 'median', 'min', 'max']
+
+## Loads stocks list with 'Name', 'MarketCap', 'Sector', 'Industry' and other
+# columns indexed by symbol.
+#
+# @param[in] file_path -- path to stocks list CSV file. Default: data/stocks.tcs
+def load_stocks(file_path = 'data/stocks.tcs'):
+	return pd.read_csv(file_path, index_col=0)
+
+#===============================================================================
+
+## Grouping of symbols of aligned prices history by stocks list column.
+# Symbols missing in stocks list or without group are not included in any group.
+class Grouping:
+	panel = None    # panel.Panel with grouped symbols
+	column = None   # column of stocks list, see GROUP_COLUMNS
+	names = None    # list of group names sorted by name, group code is position in the list
+	codes = None    # int64 array of group codes of panel symbols, -1 for symbols without group
+	caps = None     # float array of MarketCap of panel symbols, NaN if unknown
+	__order = None
+	__bounds = None
+	__one_hot = None
+
+	## Builds grouping of panel symbols.
+	#
+	# @param[in] panel  -- panel.Panel of prices history
+	# @param[in] stocks -- stocks list DataFrame indexed by symbol. See function load_stocks
+	# @param[in] column -- column of stocks list to group by. Default: 'Sector'
+	def __init__(self, panel, stocks, column = 'Sector'):
+		self.panel = panel
+		self.column = column
+		stocks = stocks[~stocks.index.duplicated()]
+		(codes, names) = pd.factorize(stocks[column].reindex(panel.symbols).values, sort = True)
+		self.codes = codes.astype(np.int64)
+		self.names = list(names)
+		self.caps = stocks['MarketCap'].reindex(panel.symbols).values.astype(np.float64) if 'MarketCap' in stocks else np.full(len(panel.symbols), np.nan)
+		grouped = np.flatnonzero(self.codes >= 0)
+		self.__order = grouped[np.argsort(self.codes[grouped], kind='stable')]
+		self.__bounds = np.searchsorted(self.codes[self.__order], np.arange(len(self.names) + 1))
+		self.__one_hot = np.zeros((len(panel.symbols), len(self.names)))
+		self.__one_hot[grouped, self.codes[grouped]] = 1.
+
+	def __repr__(self):
+		return 'sectors.Grouping(%i symbols by "%s" into %i groups)' % (len(self.__order), self.column, len(self.names))
+
+	## Returns Series Group -> number of symbols
+	def sizes(self):
+		return pd.Series(np.diff(self.__bounds), index=self.__group_index())
+
+	## Returns Series Symbol -> group name for grouped symbols
+	def groups(self):
+		return pd.Series(np.array(self.names, dtype=object)[self.codes[self.__order]], index=np.array(self.panel.symbols, dtype=object)[self.__order])
+
+	#---------------------------------------------------------------------------
+
+	## Returns DataFrame dates x groups with aggregate of field values of
+	# group symbols at every date. Dates missing in symbol history, NaN and
+	# infinite values (for example returns after zero price) are skipped.
+	# Aggregate of date without values is NaN ('count' is 0).
+	#
+	# @param[in] field   -- panel field name or matrix dates x symbols. Example: 'drop-period'
+	# @param[in] how     -- aggregate, see AGGREGATES. Default: 'median'
+	# @param[in] weights -- weights of 'sum' and 'mean': 'cap' (see function market_caps), array of symbols weights or matrix dates x symbols. Default: None - equal weights
+	@instrument.stage()
+	def aggregate(self, field, how = 'median', weights = None):
+		if how not in AGGREGATES:
+			raise ValueError('Unknown aggregate "%s", expected one of: %s' % (how, ', '.join(AGGREGATES)))
+		if weights is not None and how not in ['sum', 'mean']:
+			raise ValueError('Aggregate "%s" can not be weighted' % how)
+		values = self.panel.fields[field] if isinstance(field, str) else np.asarray(field, dtype=np.float64)
+		present = np.isfinite(values)
+		if weights is not None:
+			weights = self.market_caps() if isinstance(weights, str) and weights == 'cap' else np.broadcast_to(np.asarray(weights, dtype=np.float64), values.shape)
+			present &= np.isfinite(weights)
+		if how in ['count', 'sum', 'mean']:
+			count = present.astype(np.float64) if weights is None else np.where(present, weights, 0.)
+			total = count.dot(self.__one_hot)
+			if how == 'count':
+				res = total
+			else:
+				res = np.where(present, values if weights is None else values * weights, 0.).dot(self.__one_hot)
+				if how == 'mean':
+					with np.errstate(divide = 'ignore', invalid = 'ignore'):
+						res = np.where(total != 0., res / total, np.nan)
+				else:
+					res[present.astype(np.float64).dot(self.__one_hot) == 0.] = np.nan
+		else:
+			res = self.__reduce(np.where(present, values, np.nan)[:, self.__order], self.__bounds, how)
+		return pd.DataFrame(res, index=self.panel.dates, columns=self.__group_index())
+
+	## Returns Series Group -> aggregate of field values of group symbols over
+	# all dates, for example median 'drop-period' of sector since begin of
+	# history. See function aggregate.
+	#
+	# @param[in] field -- panel field name or matrix dates x symbols. Example: 'drop-period'
+	# @param[in] how   -- aggregate, see AGGREGATES. Default: 'median'
+	@instrument.stage()
+	def overall(self, field, how = 'median'):
+		if how not in AGGREGATES:
+			raise ValueError('Unknown aggregate "%s", expected one of: %s' % (how, ', '.join(AGGREGATES)))
+		values = self.panel.fields[field] if isinstance(field, str) else np.asarray(field, dtype=np.float64)
+		values = np.where(np.isfinite(values), values, np.nan)
+		# values of every group are reduced as one row
+		grouped = values[:, self.__order].T.reshape(1, -1)
+		res = self.__reduce(grouped, self.__bounds * len(values), how)[0]
+		return pd.Series(res, index=self.__group_index(), name=how)
+
+	## Returns DataFrame dates x groups with indices of groups: product of
+	# mean returns of group symbols since the first date, 1.0 at the first
+	# date. Return of symbol is ratio of close price to close price at the
+	# previous date of symbol history.
+	#
+	# @param[in] weighted -- weight returns by market capitalization at the previous date (see function market_caps). Default: False - equal weights
+	@instrument.stage()
+	def index(self, weighted = False):
+		close = self.panel.fields['close']
+		prev_close = self.__previous(close)
+		with np.errstate(divide = 'ignore', invalid = 'ignore'):
+			returns = close / prev_close
+			weights = self.caps * prev_close / self.__last(close) if weighted else None
+		mean = self.aggregate(returns, 'mean', weights).values
+		return pd.DataFrame(np.cumprod(np.where(np.isnan(mean), 1., mean), axis=0), index=self.panel.dates, columns=self.__group_index())
+
+	## Returns matrix dates x symbols of market capitalization: MarketCap of
+	# stocks list scaled by ratio of close price to the last close price of
+	# symbol. NaN for dates missing in symbol history and unknown MarketCap.
+	def market_caps(self):
+		close = self.panel.fields['close']
+		with np.errstate(divide = 'ignore', invalid = 'ignore'):
+			return self.caps * close / self.__last(close)
+
+	#---------------------------------------------------------------------------
+
+	def __group_index(self):
+		return pd.Index(self.names, name=self.column)
+
+	# Reduces contiguous columns of every group: columns [bounds[g], bounds[g+1])
+	# of ordered values are values of group g
+	def __reduce(self, ordered, bounds, how):
+		res = np.full((len(ordered), len(self.names)), np.nan)
+		if not ordered.shape[1]:
+			return np.zeros(res.shape) if how == 'count' else res
+		present = ~np.isnan(ordered)
+		if how in ['count', 'sum']:
+			res = np.add.reduceat(np.where(present, ordered, 0.) if how == 'sum' else present.astype(np.float64), bounds[:-1], axis=1)
+			if how == 'sum':
+				res[np.add.reduceat(present, bounds[:-1], axis=1) == 0] = np.nan
+		elif how == 'mean':
+			with np.errstate(divide = 'ignore', invalid = 'ignore'):
+				res = np.add.reduceat(np.where(present, ordered, 0.), bounds[:-1], axis=1) / np.add.reduceat(present, bounds[:-1], axis=1)
+		elif how == 'min':
+			res = np.fmin.reduceat(ordered, bounds[:-1], axis=1)
+		elif how == 'max':
+			res = np.fmax.reduceat(ordered, bounds[:-1], axis=1)
+		else:
+			with warnings.catch_warnings():
+				warnings.simplefilter('ignore', RuntimeWarning)
+				for (g, (begin, end)) in enumerate(zip(bounds[:-1], bounds[1:])):
+					res[:, g] = np.nanmedian(ordered[:, begin:end], axis=1)
+		return res
+
+	# Previous value of symbol before every date, NaN for the first date of symbol
+	def __previous(self, values):
+		mask = self.panel.mask
+		rows = np.where(mask, np.arange(len(mask))[:, None], -1)
+		prev = np.full(mask.shape, -1)
+		if len(mask):
+			prev[1:] = np.maximum.accumulate(rows, axis=0)[:-1]
+		res = values[np.maximum(prev, 0), np.arange(mask.shape[1])]
+		res[prev < 0] = np.nan
+		return res
+
+	# Last value of every symbol
+	def __last(self, values):
+		mask = self.panel.mask
+		last = len(mask) - 1 - mask[::-1].argmax(axis=0)
+		return np.where(mask.any(axis=0), values[np.maximum(last, 0), np.arange(mask.shape[1])], np.nan)
+
+################################################################################
@@ -3,6 +3,8 @@
 
 import requests
 import datetime
+import numpy as np
+import pandas as pd
 import keys
 
 #===============================================================================
@@ -21,10 +23,15 @@ def __response_error(response):
 	return type(()) == type(response) and response[0] == 'error'
 
 def parse_time_series(time_series):
-	return dict(map(lambda items: (__parse_date(items[0]), __parse_time_series_entry(items[1])), time_series.items()))
+	return TimeSeries(parse_time_series_columns(time_series))
 
 def parse_daily_time_series(time_series):
-	return dict(map(lambda items: (__parse_datetime(items[0]), __parse_time_series_entry(items[1])), time_series.items()))
+	return TimeSeries(parse_time_series_columns(time_series))
+
+## Parses time series to dictionary date -> TSEntry. It is the former
+# implementation of function parse_time_series kept for reference.
+def parse_time_series_entries(time_series):
+	return dict(map(lambda items: (__parse_date(items[0]), __parse_time_series_entry(items[1])), time_series.items()))
 
 def __parse_date(date):
 	[year, month, day] = map(int, date.split('-'))
@@ -57,6 +64,55 @@ def __parse_time_series_entry(entry):
 			, 'close': eval(entry['4. close'])
 			, 'volume': eval(entry['5. volume'])})
 
+## Parses time series to dictionary Column -> numpy array with 'date', 'open',
+# 'high', 'low', 'close' and 'volume' columns. It is a bulk alternative to
+# function parse_time_series: numbers are parsed by numpy float parser and
+# adjusted close correction is applied to entire columns. Values are the same
+# as values of TSEntry objects returned by parse_time_series. Rows are kept
+# in time series order (newest first for AlphaVantage responses).
+#
+# @param[in] time_series -- AlphaVantage time series dictionary. Example: data['Time Series (Daily)']
+def parse_time_series_columns(time_series):
+	entries = list(time_series.values())
+	def column(name):
+		return np.array([entry[name] for entry in entries], dtype=np.float64)
+	dates = np.array(list(time_series.keys()))
+	columns = {'date': dates.astype('datetime64[s]' if len(dates) and ' ' in dates[0] else 'datetime64[D]')
+		, 'open': column('1. open')
+		, 'high': column('2. high')
+		, 'low': column('3. low')
+		, 'close': column('4. close')}
+	if entries and '5. adjusted close' in entries[0]:
+		columns['volume'] = column('6. volume')
+		close = columns['close']
+		k = column('5. adjusted close') / close
+		no_adjust = (k > 0.9) & (columns['open'] / close >= 2.0)
+		for name in ['open', 'high']:
+			columns[name] = np.where(no_adjust, close, columns[name] * k)
+		for name in ['low', 'close']:
+			columns[name] = np.where(no_adjust, columns[name], columns[name] * k)
+	else:
+		columns['volume'] = column('5. volume')
+	columns['volume'] = columns['volume'].astype(np.int64)
+	return columns
+
+## Returns DataFrame in the layout of history CSV files (columns 'symbol', 
+# 'date', 'open', 'close', 'volume', 'high', 'low'). Saved by DataFrame.to_csv
+# it can be loaded by function common.load_history_dataframe.
+#
+# @param[in] symbol      -- target symbol
+# @param[in] time_series -- AlphaVantage time series dictionary or result of function parse_time_series_columns
+def time_series_dataframe(symbol, time_series):
+	columns = time_series if 'date' in time_series else parse_time_series_columns(time_series)
+	return pd.DataFrame({'symbol': symbol
+		, 'date': columns['date']
+		, 'open': columns['open']
+		, 'close': columns['close']
+		, 'volume': columns['volume']
+		, 'high': columns['high']
+		, 'low': columns['low']}
+		, columns = ['symbol', 'date', 'open', 'close', 'volume', 'high', 'low'])
+
 #===============================================================================
 
 class TSEntry:
@@ -86,15 +142,131 @@ class TSEntry:
 
 #===============================================================================
 
+## Time series stored as sorted arrays of dates and prices. It behaves like
+# dictionary date -> TSEntry (see functions keys, items, __getitem__), but
+# rows are TSRow views to the arrays.
+class TimeSeries:
+	__slots__ = ('dates', 'open', 'high', 'low', 'close', 'volume')
+
+	## Creates time series from columns.
+	#
+	# @param[in] columns -- dictionary with 'date', 'open', 'high', 'low', 'close', 'volume' arrays, 
+	#                       see function parse_time_series_columns, or dictionary date -> TSEntry
+	def __init__(self, columns):
+		if columns and not isinstance(next(iter(columns.values())), np.ndarray):
+			entries = list(columns.values())
+			columns = {'date': np.array(list(columns.keys()), dtype='datetime64[s]' if isinstance(next(iter(columns)), datetime.datetime) else 'datetime64[D]')
+				, 'open': np.array([e.open for e in entries], dtype=np.float64)
+				, 'high': np.array([e.high for e in entries], dtype=np.float64)
+				, 'low': np.array([e.low for e in entries], dtype=np.float64)
+				, 'close': np.array([e.close for e in entries], dtype=np.float64)
+				, 'volume': np.array([e.volume for e in entries], dtype=np.int64)}
+		elif not columns:
+			columns = {'date': np.array([], dtype='datetime64[D]')}
+		order = np.argsort(columns['date'], kind='mergesort')
+		self.dates = columns['date'][order]
+		for name in ['open', 'high', 'low', 'close']:
+			setattr(self, name, columns[name][order] if name in columns else np.zeros(len(order)))
+		self.volume = columns['volume'][order] if 'volume' in columns else np.zeros(len(order), dtype=np.int64)
+
+	def __repr__(self):
+		return 'stock.TimeSeries(%i entries)' % len(self)
+	def __str__(self):
+		return self.__repr__()
+
+	def __len__(self):
+		return len(self.dates)
+
+	def __iter__(self):
+		return iter(self.keys())
+
+	def __contains__(self, date):
+		return self.position(date) >= 0
+
+	def __getitem__(self, date):
+		i = self.position(date)
+		if i < 0:
+			raise KeyError(date)
+		return TSRow(self, i)
+
+	## Returns row for date or default value if there is no such date
+	def get(self, date, default = None):
+		i = self.position(date)
+		return TSRow(self, i) if i >= 0 else default
+
+	## Returns list of dates (datetime.date or datetime.datetime objects) in ascending order
+	def keys(self):
+		return self.dates.astype(object).tolist()
+
+	## Returns list of rows in ascending order of dates
+	def values(self):
+		return [TSRow(self, i) for i in range(len(self))]
+
+	## Returns list of pairs (date, row) in ascending order of dates
+	def items(self):
+		return [*zip(self.keys(), self.values())]
+
+	## Returns position of date in time series or -1 if there is no such date.
+	# Binary search is used.
+	#
+	# @param[in] date -- datetime.date or datetime.datetime
+	def position(self, date):
+		key = np.datetime64(date).astype(self.dates.dtype)
+		i = np.searchsorted(self.dates, key)
+		return int(i) if i < len(self.dates) and self.dates[i] == key else -1
+
+	## Returns date at position as datetime.date or datetime.datetime object
+	def date(self, i):
+		return self.dates[i].astype(object)
+
+#===============================================================================
+
+## Row of TimeSeries. It has the same attributes as TSEntry.
+class TSRow:
+	__slots__ = ('series', 'i')
+
+	def __init__(self, series, i):
+		self.series = series
+		self.i = i
+
+	def __repr__(self):
+		return 'stock.TSRow(%s)' % str({'open': self.open, 'high': self.high, 'low': self.low, 'close': self.close, 'volume': self.volume})
+	def __str__(self):
+		return self.__repr__()
+
+	open = property(lambda self: float(self.series.open[self.i]))
+	high = property(lambda self: float(self.series.high[self.i]))
+	low = property(lambda self: float(self.series.low[self.i]))
+	close = property(lambda self: float(self.series.close[self.i]))
+	volume = property(lambda self: int(self.series.volume[self.i]))
+
+#===============================================================================
+
 class AlphaVantage:
 
-	__apikey = None
+	## Default AlphaVantage query URL
+	URL = 'https://www.alphavantage.co/query'
 
-	def __init__(self, apikey = ALPHA_VANTAGE_APIKEY):
+	## Default request timeout in seconds
+	TIMEOUT = 30
+
+	__apikey = None
+	__url = None
+	__session = None
+	__timeout = None
+
+	## @param[in] apikey  -- AlphaVantage API key. Default: keys.ALPHA_VANTAGE_APIKEY
+	# @param[in] url     -- query URL, for example URL of local server with recorded responses. Default: URL
+	# @param[in] session -- requests.Session to reuse connections, None - new session. Default: None
+	# @param[in] timeout -- request timeout in seconds. Default: TIMEOUT
+	def __init__(self, apikey = ALPHA_VANTAGE_APIKEY, url = URL, session = None, timeout = TIMEOUT):
 		self.__apikey = apikey
+		self.__url = url
+		self.__session = session if session is not None else requests.Session()
+		self.__timeout = timeout
 
 	def intraday(self, symbol = 'MSFT', interval = '1min', outputsize = 'compact', datatype = 'json'):
-		r = requests.get('https://www.alphavantage.co/query?function=TIME_SERIES_INTRADAY&symbol=%s&apikey=%s&datatype=%s&outputsize=%s&interval=%s' %(symbol, self.__apikey, datatype, outputsize, interval))
+		r = self.query('TIME_SERIES_INTRADAY', symbol, datatype, outputsize = outputsize, interval = interval)
 		if r.status_code != 200:
 			return 'Status code: %i' % r.status_code
 		data = r.json()
@@ -106,10 +278,10 @@ class AlphaVantage:
 			return ('error', exc, data)		
 
 	def daily(self, symbol = 'MSFT', outputsize = 'full', datatype = 'json'):
-		return self.__request('TIME_SERIES_DAILY', 'Time Series (Daily)', symbol, datatype)
+		return self.__request('TIME_SERIES_DAILY', 'Time Series (Daily)', symbol, datatype, outputsize = outputsize)
 
 	def daily_adjusted(self, symbol = 'MSFT', outputsize = 'full', datatype = 'json'):
-		return self.__request('TIME_SERIES_DAILY_ADJUSTED', 'Time Series (Daily)', symbol, datatype)
+		return self.__request('TIME_SERIES_DAILY_ADJUSTED', 'Time Series (Daily)', symbol, datatype, outputsize = outputsize)
     
 	def weekly(self, symbol = 'MSFT', datatype = 'json'):
 		return self.__request('TIME_SERIES_WEEKLY', 'Weekly Time Series', symbol, datatype)
@@ -122,9 +294,19 @@ class AlphaVantage:
 
 	def monthly_adjusted(self, symbol = 'MSFT', datatype = 'json'):
 		return self.__request('TIME_SERIES_MONTHLY_ADJUSTED', 'Monthly Adjusted Time Series', symbol, datatype)
+
+	## Sends query to AlphaVantage and returns requests.Response
+	#
+	# @param[in] function -- AlphaVantage function. Example: 'TIME_SERIES_DAILY_ADJUSTED'
+	# @param[in] symbol   -- target symbol
+	# @param[in] datatype -- 'json' or 'csv'. Default: 'json'
+	# @param[in] params   -- other query parameters. Example: outputsize = 'compact'
+	def query(self, function, symbol, datatype = 'json', **params):
+		params.update({'function': function, 'symbol': symbol, 'apikey': self.__apikey, 'datatype': datatype})
+		return self.__session.get(self.__url, params = params, timeout = self.__timeout)
 		
-	def __request(self, function, response_key, symbol, datatype):
-		r = requests.get('https://www.alphavantage.co/query?function=' + function + '&symbol=%s&apikey=%s&datatype=%s' %(symbol, self.__apikey, datatype))
+	def __request(self, function, response_key, symbol, datatype, **params):
+		r = self.query(function, symbol, datatype, **params)
 		if r.status_code != 200:
 			return 'Status code: %i' % r.status_code
 		data = r.json()
@@ -141,26 +323,58 @@ class AlphaVantage:
 def year_delta(series):
 	return period_delta(series, datetime.timedelta(365))
 
+## Returns list of triplets (begin_date, end_date, growth_ratio) for consecutive
+# periods going back from the last date. Period begins at the last date which
+# is at least 'period' before its end. Raises ZeroDivisionError if open price
+# at period begin is 0.
+#
+# @param[in] series -- TimeSeries or dictionary date -> TSEntry
+# @param[in] period -- datetime.timedelta
 def period_delta(series, period):
-	timeline = sorted(series.items(), reverse = True)
-	last = timeline[0]
+	series = time_series(series)
+	if not len(series):
+		raise IndexError('empty time series')
+	period = np.timedelta64(period)
+	last = len(series) - 1
 	deltas = []
-	for (date, entry) in timeline:
-		if last[0] - date >= period:
-			deltas.append( (date, last[0], last[1].close / entry.open) )
-			last = (date, entry)
+	while True:
+		i = np.searchsorted(series.dates, series.dates[last] - period, side='right') - 1
+		if i < 0:
+			break
+		if series.open[i] == 0:
+			raise ZeroDivisionError('zero open price at %s' % series.date(i))
+		deltas.append( (series.date(i), series.date(last), float(series.close[last] / series.open[i])) )
+		last = i
 	return deltas
 
 
+## Checks that close price of every date during last 'limit' period is not less
+# than open price of the date a year before. Returns True or quadruplet 
+# (date, close, year_before, open) for the latest failed date. Only dates 
+# having exactly the same date a year before are checked.
+#
+# @param[in] series -- TimeSeries or dictionary date -> TSEntry
+# @param[in] limit  -- checked period. Default: 5 years
 def years_are_positive(series, limit = datetime.timedelta(365*5)):
-	year = datetime.timedelta(365)
-	timeline = sorted(series.items(), reverse = True)
-	for (date, entry) in timeline:
-		year_before = date - year
-		if year_before + limit < timeline[0][0]: continue
-		if year_before in series and entry.close < series[year_before].open:
-			return (date, entry.close, year_before, series[year_before].open)
-	return True
+	series = time_series(series)
+	if not len(series):
+		return True
+	year_before = series.dates - np.timedelta64(datetime.timedelta(365))
+	i = np.searchsorted(series.dates, year_before)
+	found = i < len(series.dates)
+	i = np.minimum(i, len(series.dates) - 1)
+	found &= series.dates[i] == year_before
+	checked = year_before + np.timedelta64(limit) >= series.dates[-1]
+	failed = np.flatnonzero(checked & found & (series.close < series.open[i]))
+	if not len(failed):
+		return True
+	last = failed[-1]
+	return (series.date(last), float(series.close[last]), series.date(i[last]), float(series.open[i[last]]))
+
+## Returns TimeSeries for TimeSeries or dictionary date -> TSEntry
+def time_series(series):
+	return series if isinstance(series, TimeSeries) else TimeSeries(series)
+
 
 #===============================================================================
 
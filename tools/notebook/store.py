@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+
+################################################################################
+
+import numpy as np
+import pandas as pd
+import json
+import os
+import parallel
+
+################################################################################
+
+## Name of the compiled store directory inside the history directory
+STORE_DIR = '.store'
+
+## Columns of the store values matrix. All of them are kept as float64,
+# so 'volume' comes back as float64 too.
+COLUMNS = ['open', 'close', 'volume', 'high', 'low', 'datenum']
+
+__MANIFEST = 'manifest.json'
+__VALUES = 'values.npy'
+__DATES = 'dates.npy'
+__OFFSETS = 'offsets.npy'
+
+################################################################################
+
+## Returns path to compiled store directory for target history directory
+#
+# @param[in] history_dir -- path to directory with CSV files. Example: "./history"
+def store_path(history_dir):
+	return os.path.join(history_dir, STORE_DIR)
+
+
+## Returns dictionary CSV file name -> [mtime in ns, size] for target history directory
+#
+# @param[in] history_dir -- path to directory with CSV files. Example: "./history"
+def source_files(history_dir):
+	files = {}
+	for f in sorted(os.listdir(history_dir)):
+		path = os.path.join(history_dir, f)
+		if os.path.isfile(path) and f.lower().endswith('.csv'):
+			st = os.stat(path)
+			files[f] = [st.st_mtime_ns, st.st_size]
+	return files
+
+
+## Returns store manifest or None if store was not built yet
+#
+# @param[in] history_dir -- path to directory with CSV files. Example: "./history"
+def manifest(history_dir):
+	path = os.path.join(store_path(history_dir), __MANIFEST)
+	if not os.path.isfile(path):
+		return None
+	with open(path) as f:
+		return json.load(f)
+
+
+## Returns True if compiled store exists and all source CSV files are unchanged
+#
+# @param[in] history_dir -- path to directory with CSV files. Example: "./history"
+def is_actual(history_dir):
+	m = manifest(history_dir)
+	return m is not None and m['columns'] == COLUMNS and m['files'] == source_files(history_dir)
+
+
+#-------------------------------------------------------------------------------
+
+
+## Builds (or rebuilds) compiled store for target history directory.
+# Only CSV files with changed mtime or size are parsed again, all other
+# symbols are copied from the previous store. Symbols are written to disk
+# one by one, so histories larger than memory can be compiled.
+# Returns number of parsed files.
+#
+# @param[in] history_dir    -- path to directory with CSV files. Example: "./history"
+# @param[in] load_dataframe -- function file_path -> DataFrame. See function common.load_history_dataframe(file_path)
+# @param[in] workers        -- number of processes parsing CSV files, None - number of CPUs. Default: 1
+def build(history_dir, load_dataframe, workers = 1):
+	files = source_files(history_dir)
+	old = {}
+	m = manifest(history_dir)
+	if m is not None and m['columns'] == COLUMNS:
+		(symbols, offsets, dates, values) = open_store(history_dir)
+		for (f, symbol, begin, end) in zip(m['symbol-files'], symbols, offsets[:-1], offsets[1:]):
+			if m['files'].get(f) == files.get(f):
+				old[f] = (symbol, dates[begin:end], values[begin:end])
+
+	changed = [f for f in files if f not in old]
+	loaded = parallel.imap(load_dataframe, [os.path.join(history_dir, f) for f in changed], workers)
+	path = store_path(history_dir)
+	os.makedirs(path, exist_ok=True)
+	symbol_files = []
+	symbols = []
+	lengths = []
+	with open(os.path.join(path, __DATES + '.raw'), 'wb') as dates_file, open(os.path.join(path, __VALUES + '.raw'), 'wb') as values_file:
+		for f in files:
+			if f in old:
+				(symbol, symbol_dates, symbol_values) = old[f]
+			else:
+				h = next(loaded)
+				if not len(h):
+					continue
+				symbol = h['symbol'].iloc[0]
+				symbol_dates = h.index.values.astype('datetime64[ns]').view('i8')
+				symbol_values = h[COLUMNS].values.astype(np.float64)
+			dates_file.write(np.ascontiguousarray(symbol_dates, dtype=np.int64).tobytes())
+			values_file.write(np.ascontiguousarray(symbol_values, dtype=np.float64).tobytes())
+			symbol_files.append(f)
+			symbols.append(symbol)
+			lengths.append(len(symbol_dates))
+	loaded.close()
+
+	offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+	offsets[1:] = np.cumsum(lengths)
+	__save_raw(os.path.join(path, __DATES), np.int64, (offsets[-1],))
+	__save_raw(os.path.join(path, __VALUES), np.float64, (offsets[-1], len(COLUMNS)))
+	__save(os.path.join(path, __OFFSETS), offsets)
+	with open(os.path.join(path, __MANIFEST + '.tmp'), 'w') as f:
+		json.dump({'columns': COLUMNS
+			, 'files': files
+			, 'symbol-files': symbol_files
+			, 'symbols': symbols}, f)
+	os.replace(os.path.join(path, __MANIFEST + '.tmp'), os.path.join(path, __MANIFEST))
+	return len(changed)
+
+def __save(path, array):
+	with open(path + '.tmp', 'wb') as f:
+		np.save(f, array)
+	os.replace(path + '.tmp', path)
+
+# Converts raw file path + '.raw' to .npy file by blocks
+def __save_raw(path, dtype, shape):
+	raw = np.memmap(path + '.raw', dtype=dtype, mode='r', shape=shape) if shape[0] else np.zeros(shape, dtype=dtype)
+	array = np.lib.format.open_memmap(path + '.tmp', mode='w+', dtype=dtype, shape=shape)
+	for begin in range(0, shape[0], __BLOCK_ROWS):
+		array[begin:begin + __BLOCK_ROWS] = raw[begin:begin + __BLOCK_ROWS]
+	array.flush()
+	del array, raw
+	os.replace(path + '.tmp', path)
+	os.remove(path + '.raw')
+
+__BLOCK_ROWS = 1 << 20
+
+## Opens compiled store memory-mapped in copy-on-write mode and returns
+# tuple (symbols, offsets, dates, values):
+# - symbols -- list of symbols
+# - offsets -- int64 array, rows of symbols[i] are in range [offsets[i], offsets[i+1])
+# - dates   -- int64 array of dates in ns since epoch, sorted inside every symbol
+# - values  -- float64 matrix rows x COLUMNS
+#
+# @param[in] history_dir -- path to directory with CSV files. Example: "./history"
+def open_store(history_dir):
+	path = store_path(history_dir)
+	symbols = manifest(history_dir)['symbols']
+	offsets = np.load(os.path.join(path, __OFFSETS))
+	dates = np.load(os.path.join(path, __DATES), mmap_mode='c')
+	values = np.load(os.path.join(path, __VALUES), mmap_mode='c')
+	return (symbols, offsets, dates, values)
+
+
+## Returns DataFrame for rows [begin, end) of the store without copying data
+#
+# @param[in] dates  -- dates array. See function open_store(history_dir)
+# @param[in] values -- values matrix. See function open_store(history_dir)
+# @param[in] begin  -- first row
+# @param[in] end    -- last row plus one
+def frame(dates, values, begin, end):
+	index = pd.DatetimeIndex(dates[begin:end].view('datetime64[ns]'), name='date')
+	return pd.DataFrame(values[begin:end], index=index, columns=COLUMNS, copy=False)
+
+
+## Loads stock prices history of all symbols from compiled store.
+# Store is (re)built before if it is missing or out of date.
+# Returns dictionary Symbol -> Price History DataFrame. DataFrames share
+# memory with the memory-mapped store.
+#
+# @param[in] history_dir    -- path to directory with CSV files. Example: "./history"
+# @param[in] load_dataframe -- function file_path -> DataFrame. See function common.load_history_dataframe(file_path)
+# @param[in] workers        -- number of processes parsing CSV files, None - number of CPUs. Default: 1
+def load(history_dir, load_dataframe, workers = 1):
+	if not is_actual(history_dir):
+		parsed = build(history_dir, load_dataframe, workers)
+		print('Compiled store "%s" updated, %i files parsed' % (store_path(history_dir), parsed))
+	(symbols, offsets, dates, values) = open_store(history_dir)
+	return dict((symbol, frame(dates, values, begin, end)) for (symbol, begin, end) in zip(symbols, offsets[:-1], offsets[1:]))
+
+################################################################################
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+################################################################################
+
+# Streaming processing of prices history. Unlike common.load_history
+# functions of this module yield symbols or chunks of rows one by one, and
+# stages are chained as generators:
+#
+#   frames = stream.chunks('history_daily', rows = 100000)
+#   stream.write(stream.enrich(frames), 'enriched')
+#
+# so memory is bounded by one symbol history or one chunk, not by universe.
+# CSV files are not sorted by date, so chunks of CSV file are produced after
+# loading the entire file. Compiled store (see module store) is sorted and
+# memory-mapped, so its chunks are read from disk chunk by chunk.
+
+import argparse
+import os
+import time
+import common
+import store
+
+################################################################################
+
+## Yields pairs (symbol, Price History DataFrame) one symbol at a time.
+# DataFrames are the same as function common.load_history returns.
+#
+# @param[in] history_dir -- path to directory with CSV files. Example: "./history"
+# @param[in] use_store   -- read prices from compiled store, it is built if needed. Default: True
+# @param[in] symbols     -- list of symbols to yield. Default: None - all symbols
+def frames(history_dir, use_store = True, symbols = None):
+	for (symbol, h) in __sources(history_dir, use_store, symbols):
+		yield (symbol, h())
+
+## Yields pairs (symbol, DataFrame) with chunks of symbols prices history.
+# Chunk contains at most 'rows' rows, chunks of every symbol are consecutive
+# and sorted by date, so they can be enriched by function enrich.
+#
+# @param[in] history_dir -- path to directory with CSV files. Example: "./history"
+# @param[in] rows        -- maximal number of rows in chunk. Example: 100000
+# @param[in] use_store   -- read prices from compiled store, it is built if needed. Default: True
+# @param[in] symbols     -- list of symbols to yield. Default: None - all symbols
+def chunks(history_dir, rows, use_store = True, symbols = None):
+	if rows < 1:
+		raise ValueError('Chunk should contain at least one row: %r' % rows)
+	for (symbol, h) in __sources(history_dir, use_store, symbols):
+		h = h()
+		for begin in range(0, len(h), rows):
+			yield (symbol, h.iloc[begin:begin + rows])
+
+# Yields pairs (symbol, function returning DataFrame), so frames of skipped
+# symbols are not created
+def __sources(history_dir, use_store, symbols):
+	selected = set(symbols) if symbols is not None else None
+	if use_store:
+		if not store.is_actual(history_dir):
+			parsed = store.build(history_dir, common.load_history_dataframe)
+			print('Compiled store "%s" updated, %i files parsed' % (store.store_path(history_dir), parsed))
+		(store_symbols, offsets, dates, values) = store.open_store(history_dir)
+		for (symbol, begin, end) in zip(store_symbols, offsets[:-1], offsets[1:]):
+			if selected is None or symbol in selected:
+				yield (symbol, lambda begin = begin, end = end: store.frame(dates, values, begin, end))
+		return
+
+	for f in sorted(os.listdir(history_dir)):
+		file_path = os.path.join(history_dir, f)
+		if not (os.path.isfile(file_path) and f.lower().endswith('.csv')):
+			continue
+		if selected is not None and os.path.splitext(f)[0] not in selected:
+			continue
+		h = common.load_history_dataframe(file_path)
+		if not len(h):
+			continue
+		symbol = h['symbol'].iloc[0]
+		del h['symbol']
+		yield (symbol, lambda h = h: h)
+
+#-------------------------------------------------------------------------------
+
+## Enriches pairs (symbol, DataFrame) produced by functions frames or chunks
+# and yields pairs (symbol, enriched DataFrame). Columns are the same as
+# function common.enrich appends to entire history. Next chunk of a symbol
+# is enriched by function common.extend_history from tail of previous
+# chunks (see function common.history_tail), so only the tail is kept
+# between chunks.
+#
+# @param[in] frames  -- iterable of pairs (symbol, DataFrame), chunks of every symbol should be consecutive
+# @param[in] steps   -- list of enrichment steps, see common.ENRICH_STEPS. Default: common.ENRICH_STEPS
+# @param[in] windows -- list windows sizes in years for 'price-growth' step. Default: [1,2,3,4,5]
+def enrich(frames, steps = common.ENRICH_STEPS, windows = range(1,6)):
+	windows = list(windows)
+	(last_symbol, tail) = (None, None)
+	for (symbol, h) in frames:
+		if not len(h):
+			continue
+		if symbol != last_symbol:
+			h = common.history_view(h, 0, len(h))
+			common.enrich({symbol: h}, steps = steps, windows = windows, workers = 1)
+			res = h
+			tail = common.history_tail(h)
+		else:
+			if 'price-growth' in steps and not windows:
+				raise ValueError('"price-growth" step without windows depends on the last row, symbol "%s" can not be enriched by chunks' % symbol)
+			res = common.extend_history(tail, h)
+			tail = common.history_tail(res)
+			res = res.iloc[len(res) - len(h):]
+		last_symbol = symbol
+		yield (symbol, res)
+
+#-------------------------------------------------------------------------------
+
+## Writes pairs (symbol, DataFrame) to CSV files 'output_dir/SYMBOL.csv'
+# with 'date' column and all DataFrame columns. Chunks of a symbol are
+# appended to its file one by one. File is written to temporary file first
+# and replaces the previous one when all chunks of the symbol are written.
+# Returns dictionary Symbol -> number of written rows.
+#
+# @param[in] frames     -- iterable of pairs (symbol, DataFrame), chunks of every symbol should be consecutive
+# @param[in] output_dir -- directory to write files to
+def write(frames, output_dir):
+	os.makedirs(output_dir, exist_ok = True)
+	written = {}
+	last_symbol = None
+	try:
+		for (symbol, h) in frames:
+			if symbol != last_symbol:
+				__finish(output_dir, last_symbol)
+				if symbol in written:
+					raise ValueError('Chunks of symbol "%s" are not consecutive' % symbol)
+				written[symbol] = 0
+				last_symbol = symbol
+			path = os.path.join(output_dir, symbol + '.csv.tmp')
+			h.to_csv(path, mode = 'a' if written[symbol] else 'w', header = not written[symbol], index_label = 'date')
+			written[symbol] += len(h)
+		__finish(output_dir, last_symbol)
+	finally:
+		if last_symbol is not None and os.path.isfile(os.path.join(output_dir, last_symbol + '.csv.tmp')):
+			os.remove(os.path.join(output_dir, last_symbol + '.csv.tmp'))
+	return written
+
+def __finish(output_dir, symbol):
+	if symbol is not None:
+		path = os.path.join(output_dir, symbol + '.csv')
+		os.replace(path + '.tmp', path)
+
+#===============================================================================
+
+def main():
+	parser = argparse.ArgumentParser(description = 'Enriches prices history symbol by symbol and writes results to CSV files')
+	parser.add_argument('--history', default = 'history', help = 'directory with CSV files. Default: history')
+	parser.add_argument('--output', default = 'enriched', help = 'directory to write enriched histories to. Default: enriched')
+	parser.add_argument('--rows', type = int, help = 'process histories by chunks of this number of rows. Default: entire histories')
+	parser.add_argument('--csv', action = 'store_true', help = 'read CSV files instead of compiled store')
+	parser.add_argument('--steps', nargs = '*', default = common.ENRICH_STEPS, help = 'enrichment steps. Default: all')
+	parser.add_argument('--windows', nargs = '*', type = int, default = [1, 2, 3, 4, 5], help = 'price growth windows in years. Default: 1 2 3 4 5')
+	args = parser.parse_args()
+	begin = time.perf_counter()
+	source = chunks(args.history, args.rows, not args.csv) if args.rows else frames(args.history, not args.csv)
+	written = write(enrich(source, args.steps, args.windows), args.output)
+	print('%i symbols, %i rows written to "%s" in %.1f s' % (len(written), sum(written.values()), args.output, time.perf_counter() - begin))
+
+#===============================================================================
+
+if __name__ == "__main__":
+	main()
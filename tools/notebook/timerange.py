@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+
+################################################################################
+
+import numpy as np
+import pandas as pd
+import collections.abc
+import common
+import instrument
+import moving
+
+################################################################################
+
+## Index of dates of all symbols for slicing prices history into periods.
+# Period boundaries of all symbols are found by one searchsorted call over
+# dates of all symbols ordered by (symbol, date). Period histories are views
+# of prices history (see function common.history_view) with enrichment columns
+# (see function common.enrich) computed for all symbols at once:
+# - 'price-ratio', 'max-prev', 'price-drop', 'drop-period', 'drop-min' are
+#   computed for concatenated periods of all symbols by function common.drawdown
+# - 'price-growth-[YEARS]y' are taken from moving windows of entire history,
+#   which are computed once per index. Window fits into period if it begins
+#   not before the period, otherwise the window is open and value is NaN as
+#   function common.enrich gives for the period history.
+# So evaluating many periods costs little more than evaluating one.
+class TimeRangeIndex:
+	history = None   # dictionary Symbol -> Price History DataFrame
+	symbols = None   # list of symbols
+	windows = None   # list windows sizes in years of 'price-growth' columns
+	offsets = None   # int64 array, rows of symbol n are rows [offsets[n], offsets[n+1]) of flat arrays
+	date_ns = None   # flat int64 array of dates of all symbols in ns since epoch
+	calendar = None  # sorted int64 array of unique dates of all symbols
+	keys = None      # flat int64 array symbol_n * len(calendar) + date rank, sorted
+	__open = None
+	__close = None
+	__growth = None
+
+	## Builds index of prices history. Prices history should not be changed
+	# while the index is used.
+	#
+	# @param[in] history -- dictionary Symbol -> Price History DataFrame. See function common.load_history(history_dir)
+	# @param[in] windows -- list windows sizes in years of 'price-growth' columns. Default: [1,2,3,4,5]
+	def __init__(self, history, windows = range(1,6)):
+		self.history = history
+		self.symbols = list(history)
+		self.windows = list(windows)
+		frames = [history[symbol] for symbol in self.symbols]
+		lengths = np.array([len(h) for h in frames], dtype=np.int64)
+		self.offsets = np.zeros(len(frames) + 1, dtype=np.int64)
+		self.offsets[1:] = np.cumsum(lengths)
+		self.date_ns = np.concatenate([moving.date_ns(h) for h in frames]) if frames else np.zeros(0, dtype=np.int64)
+		(self.calendar, rank) = np.unique(self.date_ns, return_inverse=True)
+		self.keys = np.repeat(np.arange(len(frames), dtype=np.int64), lengths) * len(self.calendar) + rank
+		self.__open = np.concatenate([h['open'].values for h in frames]) if frames else np.zeros(0)
+		self.__close = np.concatenate([h['close'].values for h in frames]) if frames else np.zeros(0)
+
+	def __repr__(self):
+		return 'timerange.TimeRangeIndex(%i symbols, %i rows since %s to %s)' % (len(self.symbols), len(self.date_ns)
+			, pd.Timestamp(self.calendar[0]) if len(self.calendar) else None, pd.Timestamp(self.calendar[-1]) if len(self.calendar) else None)
+
+	#---------------------------------------------------------------------------
+
+	## Returns pair (begin, end) of int64 arrays of positions of period in
+	# histories of all symbols: period of symbol n is rows [begin[n], end[n]).
+	# Period contains dates in range [since, to].
+	#
+	# @param[in] since -- begin of period - pandas.datetime
+	# @param[in] to    -- end of period - pandas.datetime
+	def bounds(self, since, to):
+		first = np.arange(len(self.symbols), dtype=np.int64) * len(self.calendar)
+		begin = np.searchsorted(self.keys, first + np.searchsorted(self.calendar, pd.Timestamp(since).value, side='left'))
+		end = np.searchsorted(self.keys, first + np.searchsorted(self.calendar, pd.Timestamp(to).value, side='right'))
+		return (begin - self.offsets[:-1], np.maximum(end, begin) - self.offsets[:-1])
+
+	## Returns pair (begin, end) of int64 arrays of positions of relative period
+	# in histories of all symbols, see function bounds. Positions are the same
+	# as function common.prepare_history_period takes: if the end rounds down
+	# to 0, period ends at the end of history.
+	#
+	# @param[in] since -- begin of period - float between 0.0 and 1.0. Default: 0.0
+	# @param[in] to    -- end of period - float between 0.0 and 1.0. Default: 1.0
+	def relative_bounds(self, since = 0., to = 1.):
+		lengths = np.diff(self.offsets)
+		begin = (lengths * since).astype(np.int64)
+		end = (lengths * to).astype(np.int64)
+		end[end == 0] = lengths[end == 0]
+		return (begin, np.maximum(end, begin))
+
+	## Returns int64 array of flat rows (see offsets) of trading days nearest
+	# to target dates: row of symbol_n[i] history which date is the nearest to
+	# date_ns[i], the earlier one of two equally near dates. Row is -1 if
+	# symbol history is empty or the nearest date is farther than tolerance.
+	#
+	# @param[in] symbol_n  -- int array of symbol numbers
+	# @param[in] date_ns   -- int64 array of target dates in ns since epoch
+	# @param[in] tolerance -- maximal distance to target date in ns. Default: None - any distance
+	def nearest_rows(self, symbol_n, date_ns, tolerance = None):
+		symbol_n = np.asarray(symbol_n, dtype=np.int64)
+		date_ns = np.asarray(date_ns, dtype=np.int64)
+		if not len(self.date_ns):
+			return np.full(len(symbol_n), -1, dtype=np.int64)
+		(begin, end) = (self.offsets[symbol_n], self.offsets[symbol_n + 1])
+		after = np.searchsorted(self.keys, symbol_n * len(self.calendar) + np.searchsorted(self.calendar, date_ns, side='left'))
+		before = after - 1
+		has_after = after < end
+		has_before = before >= begin
+		last = len(self.date_ns) - 1
+		after_distance = np.where(has_after, self.date_ns[np.minimum(after, last)] - date_ns, np.iinfo(np.int64).max)
+		before_distance = np.where(has_before, date_ns - self.date_ns[np.maximum(before, 0)], np.iinfo(np.int64).max)
+		rows = np.where(has_before & (before_distance <= after_distance), before, np.where(has_after, after, -1))
+		if tolerance is not None:
+			rows[np.minimum(after_distance, before_distance) > tolerance] = -1
+		return rows
+
+	#---------------------------------------------------------------------------
+
+	## Returns enriched views of prices history for specified relative period,
+	# see function views.
+	# Result is the same as common.enrich(common.prepare_history_period(history, since, to), steps, windows)
+	# gives, where windows are windows of the index.
+	#
+	# @param[in] since -- begin of period - float between 0.0 and 1.0. Default: 0.0
+	# @param[in] to    -- end of period - float between 0.0 and 1.0. Default: 1.0
+	# @param[in] steps -- list of enrichment steps, see common.ENRICH_STEPS. Default: common.ENRICH_STEPS
+	@instrument.stage()
+	def period(self, since = 0., to = 1., steps = common.ENRICH_STEPS):
+		(begin, end) = self.relative_bounds(since, to)
+		return self.views(begin, end, steps)
+
+	## Returns enriched views of prices history for specified absolute period,
+	# see function views. Symbols which history begins more than a month after the period begin
+	# are skipped. Result is the same as
+	# common.enrich(common.prepare_history_abs_period(history, since, to), steps, windows)
+	# gives, where windows are windows of the index.
+	#
+	# @param[in] since -- begin of period - pandas.datetime
+	# @param[in] to    -- end of period - pandas.datetime
+	# @param[in] steps -- list of enrichment steps, see common.ENRICH_STEPS. Default: common.ENRICH_STEPS
+	@instrument.stage()
+	def abs_period(self, since, to, steps = common.ENRICH_STEPS):
+		(begin, end) = self.bounds(since, to)
+		first_ns = self.date_ns[np.minimum(self.offsets[:-1] + begin, max(len(self.date_ns) - 1, 0))] if len(self.date_ns) else begin
+		keep = (end > begin) & (first_ns - pd.Timestamp(since).value < 32 * moving.DAY_NS)
+		return self.views(begin, end, steps, keep)
+
+	## Returns period history (see class PeriodHistory): dictionary Symbol ->
+	# enriched view of rows [begin[n], end[n]) of symbol n history, see 
+	# functions bounds and common.history_view.
+	#
+	# @param[in] begin -- int64 array of first rows of symbols periods
+	# @param[in] end   -- int64 array of last rows plus one of symbols periods
+	# @param[in] steps -- list of enrichment steps, see common.ENRICH_STEPS. Default: common.ENRICH_STEPS
+	# @param[in] keep  -- bool array of symbols to return. Default: None - all symbols
+	def views(self, begin, end, steps = common.ENRICH_STEPS, keep = None):
+		unknown = set(steps) - set(common.ENRICH_STEPS)
+		if unknown:
+			raise ValueError('Unknown enrichment steps: %s' % ', '.join(sorted(unknown)))
+		symbol_n = np.arange(len(self.symbols)) if keep is None else np.flatnonzero(keep)
+		lengths = (end - begin)[symbol_n]
+		starts = np.zeros(len(symbol_n) + 1, dtype=np.int64)
+		starts[1:] = np.cumsum(lengths)
+		rows = np.arange(starts[-1], dtype=np.int64) + np.repeat(self.offsets[symbol_n] + begin[symbol_n] - starts[:-1], lengths)
+		start = np.zeros(len(rows), dtype=bool)
+		start[starts[:-1][lengths > 0]] = True
+		columns = self._columns(rows, start, starts, steps)
+		return PeriodHistory(self, symbol_n, begin, end, columns, starts)
+
+	# Enrichment columns of concatenated periods
+	def _columns(self, rows, start, starts, steps):
+		columns = {}
+		if not steps:
+			return columns
+		values = common.drawdown(self.__open[rows], self.__close[rows], self.date_ns[rows], start)
+		for step in common.ENRICH_STEPS:
+			if step in steps and step != 'price-growth':
+				columns[step] = values[step]
+		if 'price-growth' in steps:
+			if self.windows:
+				growth = self._growth()[rows]
+				date_ns = self.date_ns[rows]
+				first_ns = date_ns[np.maximum.accumulate(np.where(start, np.arange(len(rows)), 0))]
+				for (i, years) in enumerate(self.windows):
+					closed = date_ns - int(365 * years) * moving.DAY_NS >= first_ns
+					columns['price-growth-%iy' % years] = np.where(closed, growth[:, i], np.nan)
+			else:
+				price_ratio = values['price-ratio']
+				lengths = np.diff(starts)
+				nonempty = lengths > 0
+				ratio = price_ratio[starts[1:][nonempty] - 1] / price_ratio[starts[:-1][nonempty]]
+				columns['price-growth'] = np.repeat(ratio, lengths[nonempty])
+		return columns
+
+	# Average growth ratios of moving windows of entire history, rows x windows
+	def _growth(self):
+		if self.__growth is None:
+			self.__growth = np.full((len(self.date_ns), len(self.windows)), np.nan)
+			for (begin, end) in zip(self.offsets[:-1], self.offsets[1:]):
+				if end > begin:
+					self.__growth[begin:end] = moving.batch(self.date_ns[begin:end], self.__open[begin:end], self.__close[begin:end]
+						, [int(365 * years) for years in self.windows], metrics = ['avg_growth_ratio'], avg_period = 365)['avg_growth_ratio']
+		return self.__growth
+
+#===============================================================================
+
+## Prices history of period returned by TimeRangeIndex. It behaves like
+# dictionary Symbol -> Price History DataFrame, but DataFrame of symbol is
+# created on first access only, so unused symbols cost nothing. DataFrames
+# are views of prices history and of enrichment columns of all symbols.
+class PeriodHistory(collections.abc.MutableMapping):
+	__index = None
+	__symbols = None
+	__positions = None
+	__columns = None
+	__frames = None
+
+	def __init__(self, index, symbol_n, begin, end, columns, starts):
+		self.__index = index
+		self.__symbols = [index.symbols[n] for n in symbol_n.tolist()]
+		self.__positions = dict((symbol, (int(begin[n]), int(end[n]), row_begin, row_end))
+			for (symbol, n, row_begin, row_end) in zip(self.__symbols, symbol_n.tolist(), starts[:-1].tolist(), starts[1:].tolist()))
+		self.__columns = columns
+		self.__frames = {}
+
+	def __repr__(self):
+		return 'timerange.PeriodHistory(%i symbols, %i created)' % (len(self.__symbols), len(self.__frames))
+
+	def __len__(self):
+		return len(self.__symbols)
+
+	def __iter__(self):
+		return iter(self.__symbols)
+
+	def __contains__(self, symbol):
+		return symbol in self.__positions
+
+	def __getitem__(self, symbol):
+		if symbol not in self.__frames:
+			(b, e, row_begin, row_end) = self.__positions[symbol]
+			h = self.__index.history[symbol]
+			columns = self.__columns
+			data = dict((column, columns[column][row_begin:row_end] if column in columns else h[column].values[b:e]) for column in h.columns)
+			data.update((column, values[row_begin:row_end]) for (column, values) in columns.items() if column not in data)
+			self.__frames[symbol] = pd.DataFrame(data, index = h.index[b:e], copy = False)
+		return self.__frames[symbol]
+
+	def __setitem__(self, symbol, h):
+		if symbol not in self.__positions:
+			self.__symbols.append(symbol)
+			self.__positions[symbol] = None
+		self.__frames[symbol] = h
+
+	def __delitem__(self, symbol):
+		del self.__positions[symbol]
+		self.__symbols.remove(symbol)
+		self.__frames.pop(symbol, None)
+
+################################################################################